@@ -52,6 +52,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -138,11 +139,17 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REDIS_HOST=os.getenv("REDIS_HOST")
 REDIS_PORT=os.getenv("REDIS_PORT")
+# Comma separated "host:port" list of Redis nodes to shard the channel layer over
+REDIS_HOSTS = [
+    tuple(host.strip().rsplit(":", 1)) for host in os.getenv("REDIS_HOSTS", "").split(",") if host.strip()
+] or [(REDIS_HOST, REDIS_PORT)]
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        # channels_redis with batched group sends, sharded over REDIS_HOSTS
+        # by a consistent hash ring, see chat.layers
+        "BACKEND": "chat.layers.ShardedRedisChannelLayer",
         "CONFIG": {
-            "hosts": [(REDIS_HOST, REDIS_PORT)],    
+            "hosts": REDIS_HOSTS,
         },
     },
 }
@@ -156,4 +163,60 @@ REST_FRAMEWORK = {
         'rest_framework_simplejwt.authentication.JWTAuthentication',
         'rest_framework.authentication.TokenAuthentication',
     )
-}
\ No newline at end of file
+}
+
+# Websocket consumers implementation used by chat.routing: "async" or "sync"
+CHAT_CONSUMERS = os.getenv("CHAT_CONSUMERS", "async")
+
+# Online presence, see chat.presence. Without BACKEND, presence is kept in
+# the channel layer Redis, or in-process with the in-memory channel layer
+CHAT_PRESENCE = {
+    "CONFIG": {
+        "ttl": 60,
+        "heartbeat_interval": 20,
+    },
+}
+
+# Websocket frames encoder, see chat.encoders. Set BACKEND to
+# "chat.encoders.OrjsonEncoder" for faster compact JSON (pip install orjson)
+CHAT_JSON_ENCODER = {
+    "BACKEND": os.getenv("CHAT_JSON_ENCODER", "chat.encoders.JSONEncoder"),
+}
+
+# Websocket handshake token -> user cache, see chat.middleware.TokenCache
+CHAT_TOKEN_CACHE = {
+    "CONFIG": {
+        "ttl": 60,
+        "max_size": 10000,
+    },
+}
+
+# Chat message persistence, see chat.persistence. "chat.persistence.BufferedWriter"
+# broadcasts messages before they are written in batches by a background thread
+CHAT_PERSISTENCE = {
+    "BACKEND": os.getenv("CHAT_PERSISTENCE", "chat.persistence.StrictWriter"),
+}
+
+# Recent messages buffers serving socket snapshots and the first API page,
+# see chat.history. Kept like CHAT_PRESENCE without BACKEND
+CHAT_HISTORY = {
+    "CONFIG": {
+        "size": 50,
+        "ttl": 24 * 60 * 60,
+    },
+}
+
+# Cached member lists of group conversations, see chat.membership.
+# Kept like CHAT_PRESENCE without BACKEND
+CHAT_MEMBERSHIP = {
+    "CONFIG": {
+        "ttl": 60 * 60,
+    },
+}
+
+# Token buckets of incoming websocket frames per user and frame type, see
+# chat.ratelimit. "rates" in CONFIG replaces chat.ratelimit.DEFAULT_RATES,
+# (tokens per second, burst) per frame type. Types not listed are not limited
+CHAT_RATE_LIMITS = {
+    "CONFIG": {},
+}
@@ -1,9 +1,14 @@
 from django.contrib import admin
 from django.urls import path, include
-from chat.views import CustomObtainAuthTokenView
+from rest_framework_simplejwt.views import TokenRefreshView
+from chat.views import CustomObtainAuthTokenView, CustomTokenObtainPairView
+from chat.metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path("auth-token/", CustomObtainAuthTokenView.as_view()),
+    path("auth-jwt/", CustomTokenObtainPairView.as_view()),
+    path("auth-jwt/refresh/", TokenRefreshView.as_view()),
     path("api/", include("chat.api_router")),
+    path("metrics", metrics_view, name="metrics"),
 ]
@@ -0,0 +1,57 @@
+"""
+Pluggable backends for realtime state kept outside of the database.
+
+Each backend is configured like CHANNEL_LAYERS, with a dict setting holding
+BACKEND and CONFIG. Without the setting, the Redis implementation is used
+when the default channel layer is Redis and the in-process one otherwise,
+so tests with the in-memory layer get the local stand-ins automatically.
+Redis backends share the channel layer's hosts, connection pools and
+sharding through get_connection().
+"""
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+_backends = {}
+
+
+def get_redis_layer():
+    """Return the default channel layer if it is backed by Redis, else None"""
+    try:
+        from channels_redis.core import RedisChannelLayer
+    except ImportError:
+        return None
+    layer = get_channel_layer()
+    return layer if isinstance(layer, RedisChannelLayer) else None
+
+
+def get_connection(key):
+    """Return the Redis client of the channel layer host owning key"""
+    layer = get_channel_layer()
+    return layer.connection(layer.consistent_hash(key))
+
+
+def redis_key(*parts):
+    """Build a key namespaced by the channel layer prefix"""
+    return ":".join([get_channel_layer().prefix, "chat", *parts])
+
+
+def get_backend(setting_name, redis_backend, local_backend):
+    """Return the process-wide backend instance configured by setting_name"""
+    if setting_name not in _backends:
+        config = getattr(settings, setting_name, None) or {}
+        backend = config.get("BACKEND")
+        if backend is None:
+            backend = redis_backend if get_redis_layer() is not None else local_backend
+        _backends[setting_name] = import_string(backend)(**config.get("CONFIG", {}))
+    return _backends[setting_name]
+
+
+@receiver(setting_changed)
+def reset_backends(setting, **kwargs):
+    if setting == "CHANNEL_LAYERS":
+        _backends.clear()
+    else:
+        _backends.pop(setting, None)
@@ -0,0 +1,8 @@
+"""
+Benchmarks of chat hot paths, run with
+``python manage.py chat_benchmark <suite> [options]``.
+
+Every suite module has add_arguments(parser) for its options and a
+run(options, stdout) function.
+"""
+SUITES = ["serialization", "load", "fanout", "multiplex"]
@@ -0,0 +1,98 @@
+"""
+Channel layer round trips of sending one event to many groups: a
+group_send per group against one group_send_many batch (see chat.layers),
+for every --recipients count.
+
+Every recipient is a group with one channel, like the notification group
+of a user. Runs against the default channel layer's backend and hosts
+under a separate prefix, so point CHANNEL_LAYERS at Redis to measure
+round trips; the in-memory layer makes none.
+"""
+import time
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.utils.module_loading import import_string
+from channels_redis.core import RedisChannelLayer
+from chat.encoders import encode_event
+from chat.layers import group_send_many
+
+PREFIX = "chat-benchmark"
+
+
+def add_arguments(parser):
+    parser.add_argument("--recipients", default="1,10,100,1000", help="Comma separated recipient counts")
+    parser.add_argument("--repeat", type=int, default=5)
+
+
+class RoundTripCounter:
+    """Count Redis commands sent on their own and pipelines while active"""
+
+    def __enter__(self):
+        from redis.asyncio.client import Pipeline, Redis
+        self.count = 0
+        self.patched = [(Redis, "execute_command"), (Pipeline, "execute")]
+        self.originals = [getattr(cls, name) for cls, name in self.patched]
+        for (cls, name), original in zip(self.patched, self.originals):
+            setattr(cls, name, self.counted(original))
+        return self
+
+    def __exit__(self, *exc_info):
+        for (cls, name), original in zip(self.patched, self.originals):
+            setattr(cls, name, original)
+
+    def counted(self, original):
+        async def method(client, *args, **kwargs):
+            self.count += 1
+            return await original(client, *args, **kwargs)
+        return method
+
+
+def make_layer():
+    config = settings.CHANNEL_LAYERS["default"]
+    backend = import_string(config["BACKEND"])
+    kwargs = dict(config.get("CONFIG", {}))
+    if issubclass(backend, RedisChannelLayer):
+        kwargs["prefix"] = PREFIX
+    return backend(**kwargs)
+
+
+async def measure(layer, recipients, repeat):
+    groups = [f"bench_fanout_{i}" for i in range(recipients)]
+    for group in groups:
+        await layer.group_add(group, await layer.new_channel())
+    event = encode_event({"type": "new_message_group_notification", "name": "bench", "message": {}})
+    results = {}
+    for name, send in (
+        ("group_send", lambda: _send_each(layer, groups, event)),
+        ("group_send_many", lambda: group_send_many(layer, [(group, event) for group in groups])),
+    ):
+        with RoundTripCounter() as round_trips:
+            started = time.perf_counter()
+            for _ in range(repeat):
+                await send()
+            seconds = (time.perf_counter() - started) / repeat
+        results[name] = (round_trips.count // repeat, seconds)
+    await layer.flush()
+    return results
+
+
+async def _send_each(layer, groups, event):
+    for group in groups:
+        await layer.group_send(group, event)
+
+
+async def measure_all(options, stdout):
+    layer = make_layer()
+    # Every channel gets 2 * repeat messages
+    layer.capacity = max(layer.capacity, 2 * options["repeat"])
+    for recipients in [int(count) for count in options["recipients"].split(",")]:
+        results = await measure(layer, recipients, options["repeat"])
+        (loop_trips, loop_seconds), (batch_trips, batch_seconds) = results.values()
+        stdout.write(
+            f"{recipients} recipients: group_send {loop_trips} round trips in {loop_seconds * 1000:.2f} ms, "
+            f"group_send_many {batch_trips} round trips in {batch_seconds * 1000:.2f} ms"
+        )
+
+
+def run(options, stdout):
+    async_to_sync(measure_all)(options, stdout)
@@ -0,0 +1,274 @@
+"""
+Websocket load benchmark of one worker.
+
+Simulates --users users paired into private chats and split into groups of
+--group-size, each with a notification, a private chat and a group chat
+socket, all in this process with the in-memory channel layer and a
+throwaway test database. Chat messages are sent at --rate messages per
+second for --duration seconds, a --group-share of them to group chats, and
+every frame they cause is timed on arrival.
+
+The JSON report has p50/p95/p99 delivery latency of message echoes and
+notifications, throughput, database queries and RSS per connection, plus
+the parameters and revision to compare runs across versions.
+"""
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import time
+import django
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from chat import services
+
+User = get_user_model()
+
+MARK = "bench:"
+ECHO = "chat_message_echo"
+NOTIFICATIONS = ("new_message_notification", "new_message_group_notification")
+
+
+def add_arguments(parser):
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--group-size", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=100, help="Messages per second")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of sending")
+    parser.add_argument("--group-share", type=float, default=0.5, help="Share of group messages")
+    parser.add_argument("--consumers", choices=["sync", "async"], default=None)
+    parser.add_argument("--drain-timeout", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Write the JSON report to this file")
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return None
+    def percentile(p):
+        return round(values[round(p / 100 * (len(values) - 1))] * 1000, 3)
+    return {"p50": percentile(50), "p95": percentile(95), "p99": percentile(99), "max": percentile(100)}
+
+
+def get_rss():
+    """Current resident set size in bytes"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=settings.BASE_DIR, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class QueryCounter:
+    """
+    Counts queries of the current thread's connection and of connections
+    opened meanwhile. Enter it in the thread that runs the consumers' sync
+    code, which is the thread calling async_to_sync.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        self.install(connection)
+        connection_created.connect(self.install)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection_created.disconnect(self.install)
+        connection.execute_wrappers.remove(self)
+
+
+class LoadBenchmark:
+    def __init__(self, options):
+        from chat.routing import CONSUMERS
+        self.options = options
+        consumers = options.get("consumers") or settings.CHAT_CONSUMERS
+        self.chat_consumer, self.notification_consumer, self.group_chat_consumer = CONSUMERS[consumers]
+        self.random = random.Random(options["seed"])
+        self.sockets = []
+        self.private_senders = []
+        self.group_senders = []
+        self.latencies = {"echo": [], "notification": []}
+        self.frames = 0
+        self.expected = 0
+        self.delivered = 0
+        self.queries = None
+
+    def build_dataset(self):
+        """Create users, private conversations and groups, return sockets to open"""
+        users = [
+            User.objects.create(username=f"bench_{i}", first_name=f"Bench {i}")
+            for i in range(self.options["users"])
+        ]
+        sockets = []
+        for user in users:
+            sockets.append((self.notification_consumer, "/notifications/", {}, user, None))
+        for first, second in zip(users[::2], users[1::2]):
+            name = "__".join(sorted((first.username, second.username)))
+            services.get_or_create_conversation(name)
+            for user in (first, second):
+                sockets.append((
+                    self.chat_consumer, f"/chats/{name}/", {"conversation_name": name}, user, 2,
+                ))
+        group_size = self.options["group_size"]
+        for start in range(0, len(users), group_size):
+            members = users[start:start + group_size]
+            conversation, _ = services.get_or_create_group_conversation(f"bench_group_{start}", members[0])
+            for member in members[1:]:
+                services.add_member(conversation, member.username)
+            for user in members:
+                sockets.append((
+                    self.group_chat_consumer, f"/group_chats/{conversation.name}/",
+                    {"group_chat_name": conversation.name}, user, len(members),
+                ))
+        return sockets
+
+    async def read(self, communicator):
+        while True:
+            message = await communicator.output_queue.get()
+            received = time.perf_counter()
+            if message["type"] != "websocket.send":
+                return
+            self.frames += 1
+            frame = json.loads(message["text"])
+            if frame["type"] == ECHO:
+                kind = "echo"
+            elif frame["type"] in NOTIFICATIONS:
+                kind = "notification"
+            else:
+                continue
+            content = frame["message"]["content"]
+            if content.startswith(MARK):
+                self.latencies[kind].append(received - float(content[len(MARK):]))
+                self.delivered += 1
+
+    async def connect(self, consumer, path, kwargs, user):
+        communicator = WebsocketCommunicator(consumer.as_asgi(), path)
+        communicator.scope["user"] = user
+        communicator.scope["url_route"] = {"kwargs": kwargs}
+        connected, _ = await communicator.connect(timeout=30)
+        if not connected:
+            raise RuntimeError(f"{user} could not connect to {path}")
+        return communicator
+
+    async def send(self, senders):
+        communicator, members = self.random.choice(senders)
+        # The echo reaches every member's socket, the notification all but the sender
+        self.expected += members + members - 1
+        await communicator.send_to(text_data=json.dumps({
+            "type": "chat_message",
+            "message": f"{MARK}{time.perf_counter()}",
+        }))
+
+    def run(self, sockets):
+        with QueryCounter() as self.queries:
+            return async_to_sync(self.run_sockets)(sockets)
+
+    async def run_sockets(self, sockets):
+        rss = get_rss()
+        started = time.perf_counter()
+        readers = []
+        for consumer, path, kwargs, user, members in sockets:
+            communicator = await self.connect(consumer, path, kwargs, user)
+            self.sockets.append(communicator)
+            readers.append(asyncio.create_task(self.read(communicator)))
+            if members is not None:
+                senders = self.private_senders if consumer is self.chat_consumer else self.group_senders
+                senders.append((communicator, members))
+        connect_seconds = time.perf_counter() - started
+        rss_per_connection = (get_rss() - rss) / max(len(self.sockets), 1)
+        await asyncio.sleep(0.5) # Let join events and history settle
+
+        queries = self.queries.count
+        count = int(self.options["rate"] * self.options["duration"])
+        started = time.perf_counter()
+        for i in range(count):
+            delay = started + i / self.options["rate"] - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            group = self.group_senders and (
+                not self.private_senders or self.random.random() < self.options["group_share"]
+            )
+            await self.send(self.group_senders if group else self.private_senders)
+        send_seconds = time.perf_counter() - started
+        deadline = time.perf_counter() + self.options["drain_timeout"]
+        while self.delivered < self.expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        total_seconds = time.perf_counter() - started
+        queries = self.queries.count - queries
+
+        for reader in readers:
+            reader.cancel()
+        for communicator in self.sockets:
+            await communicator.disconnect()
+        return {
+            "connections": len(self.sockets),
+            "connect_seconds": round(connect_seconds, 3),
+            "messages_sent": count,
+            "frames_received": self.frames,
+            "deliveries_expected": self.expected,
+            "deliveries_received": self.delivered,
+            "send_rate": round(count / send_seconds, 1) if send_seconds else None,
+            "delivery_rate": round(self.delivered / total_seconds, 1) if total_seconds else None,
+            "latency_ms": {kind: percentiles(values) for kind, values in self.latencies.items()},
+            "queries": queries,
+            "queries_per_message": round(queries / count, 2) if count else None,
+            "rss_per_connection_kb": round(rss_per_connection / 1024, 1),
+        }
+
+
+def run(options, stdout):
+    benchmark = LoadBenchmark(options)
+    layers = {"default": {"BACKEND": "chat.layers.InMemoryChannelLayer", "CONFIG": {"capacity": 100000}}}
+    old_name = connection.settings_dict["NAME"]
+    # Simulated users send as fast as the benchmark asks, without rate limits
+    rate_limits = {"BACKEND": "chat.ratelimit.LocalRateLimiter", "CONFIG": {"rates": {}}}
+    with override_settings(CHANNEL_LAYERS=layers, CHAT_RATE_LIMITS=rate_limits):
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = benchmark.run(benchmark.build_dataset())
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+    report = {
+        "revision": get_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "database": connection.vendor,
+        "parameters": dict(
+            {key: options[key] for key in ("users", "group_size", "rate", "duration", "group_share", "seed")},
+            consumers=options.get("consumers") or settings.CHAT_CONSUMERS,
+        ),
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if options.get("output"):
+        with open(options["output"], "w") as file:
+            file.write(output)
+    stdout.write(output)
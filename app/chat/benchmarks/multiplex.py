@@ -0,0 +1,119 @@
+"""
+Cost of a client's sockets: one socket per stream against one multiplexed
+socket (see chat.consumers.MultiplexConsumer), for --clients clients of a
+user with --chats private chats and notifications.
+
+The multiplexed socket handles every stream with the same consumer logic,
+sharing one channel, one receive loop and one set of group subscriptions.
+Reports connections, connect time, database queries and memory allocated
+per client for both, with the routed consumers, the in-memory channel
+layer and a throwaway test database.
+"""
+import asyncio
+import time
+import tracemalloc
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import override_settings
+from rest_framework.authtoken.models import Token
+from chat import services
+from chat.benchmarks.load import QueryCounter
+
+User = get_user_model()
+
+
+def add_arguments(parser):
+    parser.add_argument("--chats", type=int, default=10, help="Private chats of every client")
+    parser.add_argument("--clients", type=int, default=20)
+
+
+def build_dataset(chats):
+    """Create the user and its conversations, return its token key and streams"""
+    user = User.objects.create(username="bench_client")
+    streams = ["notifications/"]
+    for i in range(chats):
+        name = f"{user.username}__bench_partner_{i}"
+        User.objects.create(username=f"bench_partner_{i}")
+        services.get_or_create_conversation(name)
+        streams.append(f"chats/{name}/")
+    return Token.objects.create(user=user).key, streams
+
+
+def is_connected(stream, frame):
+    """Whether frame is the last one a stream sends on connect"""
+    return frame["type"] == ("unread_group_count" if stream == "notifications/" else "last_50_messages")
+
+
+async def open_separate(application, token, streams):
+    async def open_socket(stream):
+        communicator = WebsocketCommunicator(application, f"/{stream}?token={token}")
+        connected, _ = await communicator.connect(timeout=30)
+        if not connected:
+            raise RuntimeError(f"Could not connect to {stream}")
+        while not is_connected(stream, await communicator.receive_json_from(timeout=30)):
+            pass
+        return communicator
+    return await asyncio.gather(*(open_socket(stream) for stream in streams))
+
+
+async def open_multiplexed(application, token, streams):
+    communicator = WebsocketCommunicator(application, f"/multiplex/?token={token}")
+    connected, _ = await communicator.connect(timeout=30)
+    if not connected:
+        raise RuntimeError("Could not connect to multiplex/")
+    for stream in streams:
+        await communicator.send_json_to({"type": "subscribe", "stream": stream})
+    pending = set(streams)
+    while pending:
+        frame = await communicator.receive_json_from(timeout=30)
+        if is_connected(frame["stream"], frame["payload"]):
+            pending.discard(frame["stream"])
+    return [communicator]
+
+
+async def measure(open_client, token, streams, clients, queries):
+    from chat import routing
+    from chat.middleware import TokenAuthMiddleware
+    application = TokenAuthMiddleware(URLRouter(routing.websocket_urlpatterns))
+    communicators = []
+    query_count = queries.count
+    tracemalloc.start()
+    started = time.perf_counter()
+    for _ in range(clients):
+        communicators.extend(await open_client(application, token, streams))
+    seconds = time.perf_counter() - started
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    query_count = queries.count - query_count
+    for communicator in communicators:
+        await communicator.disconnect()
+    return {
+        "connections_per_client": len(communicators) / clients,
+        "connect_ms_per_client": round(seconds / clients * 1000, 2),
+        "queries_per_client": round(query_count / clients, 1),
+        "allocated_kb_per_client": round(allocated / clients / 1024, 1),
+    }
+
+
+async def measure_all(options, stdout, token, streams, queries):
+    for name, open_client in (("separate", open_separate), ("multiplexed", open_multiplexed)):
+        results = await measure(open_client, token, streams, options["clients"], queries)
+        stdout.write(f"{name}: " + ", ".join(f"{key} {value}" for key, value in results.items()))
+
+
+def run(options, stdout):
+    layers = {"default": {"BACKEND": "chat.layers.InMemoryChannelLayer", "CONFIG": {"capacity": 100000}}}
+    old_name = connection.settings_dict["NAME"]
+    # Clients subscribe to every stream at once, without rate limits
+    rate_limits = {"BACKEND": "chat.ratelimit.LocalRateLimiter", "CONFIG": {"rates": {}}}
+    with override_settings(CHANNEL_LAYERS=layers, CHAT_RATE_LIMITS=rate_limits):
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            token, streams = build_dataset(options["chats"])
+            with QueryCounter() as queries:
+                async_to_sync(measure_all)(options, stdout, token, streams, queries)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
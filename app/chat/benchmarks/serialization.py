@@ -0,0 +1,104 @@
+"""
+last_50_messages frame: DRF serializers + json.dumps(cls=UUIDEncoder)
+against chat.payloads + the configured encoder, then bytes on the wire
+and encode time of the JSON and compact protocols (see chat.protocols).
+
+Messages are built in memory, so the suite measures serialization only
+and needs no data in the database.
+"""
+import json
+import timeit
+import uuid
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from chat import payloads
+from chat.encoders import UUIDEncoder, encode_json
+from chat.protocols import decode_compact, encode_compact
+from chat.models import Conversation, Message, GroupConversation, GroupMessage
+from chat.serializers import MessageSerializer, GroupMessageSerializer
+from chat.services import LAST_MESSAGES_COUNT
+
+User = get_user_model()
+
+
+def build_messages():
+    users = [User(id=1, username="alice", first_name="Alice"), User(id=2, username="bob", first_name="Bob")]
+    conversation = Conversation(id=uuid.uuid4(), name="alice__bob")
+    group_conversation = GroupConversation(id=uuid.uuid4(), name="group_chat_with__alice__1")
+    now = timezone.now()
+    messages, group_messages = [], []
+    for i in range(LAST_MESSAGES_COUNT):
+        timestamp = now - timedelta(seconds=i)
+        messages.append(Message(
+            id=uuid.uuid4(), conversation=conversation, from_user=users[i % 2],
+            to_user=users[(i + 1) % 2], content=f"Message {i}", timestamp=timestamp, read=i > 10,
+        ))
+        group_messages.append(GroupMessage(
+            id=uuid.uuid4(), group_conversation=group_conversation, from_user=users[i % 2],
+            content=f"Message {i}", timestamp=timestamp,
+        ))
+    read_watermarks = [(1, now), (2, now - timedelta(seconds=10))]
+    return messages, group_messages, read_watermarks
+
+
+def add_arguments(parser):
+    parser.add_argument("--iterations", type=int, default=1000)
+
+
+def run(options, stdout):
+    iterations = options["iterations"]
+    messages, group_messages, read_watermarks = build_messages()
+    frames = {
+        "last_50_messages": lambda: {
+            "type": "last_50_messages",
+            "messages": payloads.message_payloads(messages),
+            "has_more": True,
+        },
+        "last_50_group_messages": lambda: {
+            "type": "last_50_group_messages",
+            "group_messages": payloads.group_message_payloads(group_messages, read_watermarks),
+            "has_more": True,
+        },
+    }
+    cases = {
+        "last_50_messages": (
+            lambda: json.dumps({
+                "type": "last_50_messages",
+                "messages": MessageSerializer(messages, many=True).data,
+                "has_more": True,
+            }, cls=UUIDEncoder),
+            lambda: encode_json(frames["last_50_messages"]()),
+        ),
+        "last_50_group_messages": (
+            lambda: json.dumps({
+                "type": "last_50_group_messages",
+                "group_messages": GroupMessageSerializer(
+                    group_messages, many=True, context={"read_watermarks": read_watermarks}
+                ).data,
+                "has_more": True,
+            }, cls=UUIDEncoder),
+            lambda: encode_json(frames["last_50_group_messages"]()),
+        ),
+    }
+    for name, (baseline, fast) in cases.items():
+        same_bytes = baseline() == fast()
+        same_json = json.loads(baseline()) == json.loads(fast())
+        baseline_time = timeit.timeit(baseline, number=iterations) / iterations
+        fast_time = timeit.timeit(fast, number=iterations) / iterations
+        stdout.write(
+            f"{name}: serializer {baseline_time * 1e6:.0f} us, payloads {fast_time * 1e6:.0f} us, "
+            f"x{baseline_time / fast_time:.1f}, same bytes: {same_bytes}, same JSON: {same_json}"
+        )
+    for name, build in frames.items():
+        content = build()
+        json_bytes = len(encode_json(content).encode())
+        compact_bytes = len(encode_compact(content))
+        json_time = timeit.timeit(lambda: encode_json(content), number=iterations) / iterations
+        compact_time = timeit.timeit(lambda: encode_compact(content), number=iterations) / iterations
+        same_content = decode_compact(encode_compact(content)) == json.loads(encode_json(content))
+        stdout.write(
+            f"{name} on the wire: json {json_bytes} B in {json_time * 1e6:.0f} us, "
+            f"compact {compact_bytes} B in {compact_time * 1e6:.0f} us, "
+            f"x{json_bytes / compact_bytes:.1f} smaller, same content: {same_content}"
+        )
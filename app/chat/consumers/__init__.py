@@ -1,9 +1,17 @@
 from .notification_consumer import NotificationConsumer
 from .private_chat_consumer import ChatConsumer
 from .group_chat_consumer import GroupChatConsumer
+from .async_notification_consumer import AsyncNotificationConsumer
+from .async_private_chat_consumer import AsyncChatConsumer
+from .async_group_chat_consumer import AsyncGroupChatConsumer
+from .multiplex_consumer import MultiplexConsumer
 
 __all__ = [
     "NotificationConsumer",
     "ChatConsumer",
     "GroupChatConsumer",
+    "AsyncNotificationConsumer",
+    "AsyncChatConsumer",
+    "AsyncGroupChatConsumer",
+    "MultiplexConsumer",
 ]
\ No newline at end of file
@@ -0,0 +1,263 @@
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.db import database_sync_to_async
+from chat import services
+from chat.metrics import AsyncConsumerMetricsMixin
+from chat.layers import group_send_many
+from chat.ratelimit import AsyncRateLimitMixin
+from chat.protocols import AsyncProtocolMixin
+from chat.encoders import encode_json, encode_event
+from chat.presence import AsyncHeartbeatMixin, get_presence
+from urllib.parse import parse_qs
+
+
+class AsyncGroupChatConsumer(
+    AsyncConsumerMetricsMixin, AsyncRateLimitMixin, AsyncProtocolMixin, AsyncHeartbeatMixin,
+    AsyncJsonWebsocketConsumer,
+):
+    """
+    Async version of GroupChatConsumer.
+    All DB work of an event runs in a single database_sync_to_async call,
+    so idle and waiting sockets don't hold a worker thread.
+    """
+
+    metrics_event_types = (
+        "add_member", "remove_member", "chat_message", "read_group_messages", "sync", "heartbeat"
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.room_name = None
+        self.user = None
+        self.conversation = None
+        self.presence = get_presence()
+
+    @classmethod
+    async def encode_json(cls, content):
+        return encode_json(content)
+
+    @database_sync_to_async
+    def get_conversation_name(self):
+        group_chat_name = self.scope['url_route']['kwargs']['group_chat_name']
+        if group_chat_name == 'new':
+            return f"group_chat_with__{self.user}__{services.get_next_group_conversation_id(self.user)}"
+        return f"{group_chat_name}"
+
+    @database_sync_to_async
+    def open_conversation(self):
+        return services.get_or_create_group_conversation(self.conversation_name, self.user)
+
+    @database_sync_to_async
+    def get_snapshot(self, since):
+        return (
+            services.get_group_messages_frame(self.conversation, since),
+            services.get_members(self.conversation),
+        )
+
+    @database_sync_to_async
+    def get_group_messages_frame(self, since):
+        return services.get_group_messages_frame(self.conversation, since)
+
+    @database_sync_to_async
+    def get_members(self):
+        return services.get_members(self.conversation)
+
+    @database_sync_to_async
+    def change_members(self, change, username):
+        result = change(self.conversation, username)
+        if result is None:
+            return None, None
+        return result
+
+    @database_sync_to_async
+    def create_group_message(self, content):
+        return services.create_group_message(self.conversation, self.user, content)
+
+    @database_sync_to_async
+    def read_group_messages(self):
+        return services.read_group_messages(self.conversation, self.user)
+
+    async def send_members(self, members=None):
+        """Send chat members to frontend"""
+        if members is None:
+            members = await self.get_members()
+        await self.send_json(
+            {
+                "type": "members_list",
+                "users": members,
+            }
+        )
+
+    def member_change_event(self, event_type, member):
+        """member_added / member_removed diff of the members list for the group's sockets"""
+        return self.conversation_name, encode_event({
+            "type": event_type,
+            "user": member,
+        })
+
+    def chat_message_echo_event(self, message):
+        return self.conversation_name, encode_event({
+            "type": "chat_message_echo",
+            "username": self.user.username,
+            "message": message,
+        })
+
+    def get_new_message_group_notification(self, message):
+        return encode_event({
+            "type": "new_message_group_notification",
+            "name": self.user.username,
+            "message": message
+        })
+
+    def group_notification_event(self, message, exclude=()):
+        """
+        New message notification for the notification sockets of all members
+        at once, skipped by the sender's sockets and those of exclude
+        """
+        event = self.get_new_message_group_notification(message)
+        event["exclude"] = [self.user.username, *exclude]
+        return self.conversation.notification_group, event
+
+    def notification_subscription_event(self, event_type, username, notification=None):
+        """
+        Subscribe (group_subscribe) or unsubscribe (group_unsubscribe) the
+        notification sockets of username to the group's notifications,
+        delivering notification to them if given
+        """
+        event = {"type": event_type, "group": self.conversation.notification_group}
+        if notification is not None:
+            event["notification"] = notification
+        return username + "__notifications", event
+
+    async def connect(self):
+        self.user = self.scope['user']
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+        elif self.scope['url_route']['kwargs']['group_chat_name'] == 'undefined':
+            await self.close()
+            return
+
+        await self.accept()
+        self.conversation_name = await self.get_conversation_name()
+        conversation, created = await self.open_conversation()
+        if created: # Redirect to correct group url if group chat has been just created
+            await self.channel_layer.group_send(
+                self.user.username + "__notifications",
+                {"type": "group_subscribe", "group": conversation.notification_group},
+            )
+            await self.send_json(
+                {
+                    "type": "redirect",
+                    "url": conversation.name,
+                }
+            )
+            await self.close()
+            return
+
+        self.conversation = conversation
+        await self.channel_layer.group_add(
+            self.conversation_name,
+            self.channel_name,
+        )
+        went_online = await self.presence.join(
+            self.conversation.presence_key, self.user.username, self.channel_name
+        )
+        if went_online:
+            await self.channel_layer.group_send(
+                self.conversation_name,
+                encode_event({
+                    "type": "user_join",
+                    "user": self.user.username,
+                })
+            )
+        since = parse_qs(self.scope["query_string"].decode()).get("since", [None])[0]
+        group_messages_frame, members = await self.get_snapshot(since)
+        await self.send_json(group_messages_frame)
+        await self.send_members(members)
+
+    async def receive_json(self, content, **kwargs):
+        message_type = content['type']
+        if await self.rate_limited(content):
+            return
+
+        if message_type in ("add_member", "remove_member"):
+            change = services.add_member if message_type == "add_member" else services.remove_member
+            message, member = await self.change_members(change, content['name'])
+            if message is None:
+                return
+            if message_type == "add_member":
+                member_change = self.member_change_event("member_added", member)
+                subscription = self.notification_subscription_event(
+                    "group_subscribe", member["username"], self.get_new_message_group_notification(message)
+                )
+            else:
+                member_change = self.member_change_event("member_removed", member)
+                subscription = self.notification_subscription_event("group_unsubscribe", member["username"])
+            await group_send_many(self.channel_layer, [
+                member_change,
+                self.chat_message_echo_event(message),
+                subscription,
+                self.group_notification_event(message, exclude=[member["username"]]),
+            ])
+
+        elif message_type == "chat_message":
+            message = await self.create_group_message(content["message"])
+            await group_send_many(self.channel_layer, [
+                self.chat_message_echo_event(message),
+                self.group_notification_event(message),
+            ])
+
+        elif message_type == "sync":
+            await self.send_json(await self.get_group_messages_frame(content.get("since")))
+
+        elif message_type == "read_group_messages":
+            unread_group_count = await self.read_group_messages()
+            await self.channel_layer.group_send(
+                self.user.username + "__notifications",
+                encode_event({
+                    "type": "unread_group_count",
+                    "unread_group_count": unread_group_count,
+                }),
+            )
+
+        return await super().receive_json(content, **kwargs)
+
+    async def disconnect(self, code):
+        if self.conversation is not None:
+            await self.channel_layer.group_discard(
+                self.conversation_name,
+                self.channel_name,
+            )
+            went_offline = await self.presence.leave(
+                self.conversation.presence_key, self.user.username, self.channel_name
+            )
+            if went_offline:
+                await self.channel_layer.group_send(
+                    self.conversation_name,
+                    encode_event({
+                        "type": "user_leave",
+                        "user": self.user.username,
+                    }),
+                )
+        return await super().disconnect(code)
+
+    async def user_join(self, event):
+        await self.send_event(event)
+
+    async def user_leave(self, event):
+        await self.send_event(event)
+
+    async def member_added(self, event):
+        await self.send_event(event)
+
+    async def member_removed(self, event):
+        await self.send_event(event)
+
+    async def chat_message_echo(self, event):
+        await self.send_event(event)
+
+    async def new_message_group_notification(self, event):
+        await self.send_event(event)
+
+    async def unread_group_count(self, event):
+        await self.send_event(event)
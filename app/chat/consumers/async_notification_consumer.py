@@ -0,0 +1,98 @@
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.db import database_sync_to_async
+from chat import services
+from chat.metrics import AsyncConsumerMetricsMixin
+from chat.protocols import AsyncProtocolMixin
+from chat.encoders import encode_json
+
+
+class AsyncNotificationConsumer(AsyncConsumerMetricsMixin, AsyncProtocolMixin, AsyncJsonWebsocketConsumer):
+    """Async version of NotificationConsumer"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user = None
+        self.notification_group_name = None
+        self.group_notification_groups = set()
+
+    @classmethod
+    async def encode_json(cls, content):
+        return encode_json(content)
+
+    @database_sync_to_async
+    def get_notification_groups(self):
+        return services.get_notification_groups(self.user)
+
+    @database_sync_to_async
+    def get_unread_counts(self):
+        return services.get_unread_counts(self.user)
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        if not self.user.is_authenticated:
+            return
+        await self.accept()
+
+        self.notification_group_name = self.user.username + "__notifications"
+        await self.channel_layer.group_add(
+            self.notification_group_name,
+            self.channel_name,
+        )
+        for group in await self.get_notification_groups():
+            await self.subscribe(group)
+
+        unread_count, unread_group_count = await self.get_unread_counts()
+        await self.send_json(
+            {
+                "type": "unread_count",
+                "unread_count": unread_count,
+            }
+        )
+        await self.send_json(
+            {
+                "type": "unread_group_count",
+                "unread_group_count": unread_group_count,
+            }
+        )
+
+    async def disconnect(self, code):
+        if self.notification_group_name is not None:
+            await self.channel_layer.group_discard(
+                self.notification_group_name,
+                self.channel_name,
+            )
+        for group in list(self.group_notification_groups):
+            await self.unsubscribe(group)
+        return await super().disconnect(code)
+
+    async def subscribe(self, group):
+        """Receive notifications of a group conversation"""
+        await self.channel_layer.group_add(group, self.channel_name)
+        self.group_notification_groups.add(group)
+
+    async def unsubscribe(self, group):
+        await self.channel_layer.group_discard(group, self.channel_name)
+        self.group_notification_groups.discard(group)
+
+    async def group_subscribe(self, event):
+        """The user has been added to a group"""
+        await self.subscribe(event["group"])
+        if "notification" in event:
+            await self.send_event(event["notification"])
+
+    async def group_unsubscribe(self, event):
+        """The user has been removed from a group"""
+        await self.unsubscribe(event["group"])
+
+    async def new_message_notification(self, event):
+        await self.send_event(event)
+
+    async def new_message_group_notification(self, event):
+        if self.user.username in event.get("exclude", ()):
+            return
+        await self.send_event(event)
+
+    async def unread_count(self, event):
+        await self.send_event(event)
+
+    async def unread_group_count(self, event):
+        await self.send_event(event)
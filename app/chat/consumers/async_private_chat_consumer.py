@@ -0,0 +1,197 @@
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.db import database_sync_to_async
+from chat import services
+from chat.metrics import AsyncConsumerMetricsMixin
+from chat.layers import group_send_many
+from chat.ratelimit import AsyncRateLimitMixin
+from chat.protocols import AsyncProtocolMixin
+from chat.encoders import encode_json, encode_event
+from chat.presence import AsyncHeartbeatMixin, get_presence
+from chat.typing import TypingTracker, TYPING_TIMEOUT
+from urllib.parse import parse_qs
+import asyncio
+
+
+class AsyncChatConsumer(
+    AsyncConsumerMetricsMixin, AsyncRateLimitMixin, AsyncProtocolMixin, AsyncHeartbeatMixin,
+    AsyncJsonWebsocketConsumer,
+):
+    """
+    Async version of ChatConsumer.
+    All DB work of an event runs in a single database_sync_to_async call,
+    so idle and waiting sockets don't hold a worker thread.
+    """
+
+    metrics_event_types = ("chat_message", "typing", "read_messages", "sync", "heartbeat")
+    typing_timeout = TYPING_TIMEOUT
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.room_name = None
+        self.user = None
+        self.conversation = None
+        self.receiver = None
+        self.presence = get_presence()
+        self.typing_tracker = TypingTracker(self.typing_timeout)
+        self.typing_task = None
+
+    @classmethod
+    async def encode_json(cls, content):
+        return encode_json(content)
+
+    @database_sync_to_async
+    def open_conversation(self, since):
+        conversation, created = services.get_or_create_conversation(self.conversation_name)
+        receiver = services.get_receiver(conversation, self.user)
+        return conversation, receiver, created, services.get_messages_frame(conversation, since)
+
+    @database_sync_to_async
+    def get_messages_frame(self, since):
+        return services.get_messages_frame(self.conversation, since)
+
+    @database_sync_to_async
+    def create_message(self, content):
+        return services.create_message(self.conversation, self.user, content, self.receiver)
+
+    @database_sync_to_async
+    def read_messages(self):
+        return services.read_messages(self.conversation, self.user)
+
+    async def connect(self):
+        try:
+            self.user = self.scope["user"]
+        except KeyError:
+            return await self.close()
+        if not self.user.is_authenticated:
+            return
+        await self.accept()
+        self.conversation_name = f"{self.scope['url_route']['kwargs']['conversation_name']}"
+        since = parse_qs(self.scope["query_string"].decode()).get("since", [None])[0]
+        self.conversation, self.receiver, created, messages_frame = await self.open_conversation(since)
+        await self.channel_layer.group_add(
+            self.conversation_name,
+            self.channel_name,
+        )
+        if created:
+            await self.send_json(
+                {
+                    "type": "welcome_message",
+                    "message": "You've started a new chat",
+                }
+            )
+        await self.send_json(
+            {
+                "type": "online_user_list",
+                "users": await self.presence.online(self.conversation.presence_key),
+            }
+        )
+        went_online = await self.presence.join(
+            self.conversation.presence_key, self.user.username, self.channel_name
+        )
+        if went_online:
+            await self.channel_layer.group_send(
+                self.conversation_name,
+                encode_event({
+                    "type": "user_join",
+                    "user": self.user.username,
+                })
+            )
+        await self.send_json(messages_frame)
+
+    async def disconnect(self, code):
+        if self.typing_task is not None:
+            self.typing_task.cancel()
+        if self.conversation is not None:
+            await self.set_typing(False)
+            await self.channel_layer.group_discard(
+                self.conversation_name,
+                self.channel_name,
+            )
+            went_offline = await self.presence.leave(
+                self.conversation.presence_key, self.user.username, self.channel_name
+            )
+            if went_offline:
+                await self.channel_layer.group_send(
+                    self.conversation_name,
+                    encode_event({
+                        "type": "user_leave",
+                        "user": self.user.username,
+                    }),
+                )
+        return await super().disconnect(code)
+
+    async def receive_json(self, content, **kwargs):
+        message_type = content['type']
+        if await self.rate_limited(content):
+            return
+        if message_type == "chat_message":
+            await self.set_typing(False)
+            message, receiver = await self.create_message(content["message"])
+            await group_send_many(self.channel_layer, [
+                (self.conversation_name, encode_event({
+                    "type": "chat_message_echo",
+                    "username": self.user.username,
+                    "message": message
+                })),
+                (receiver.username + "__notifications", encode_event({
+                    "type": "new_message_notification",
+                    "name": self.user.username,
+                    "message": message
+                })),
+            ])
+        elif message_type == "typing":
+            await self.set_typing(bool(content["typing"]))
+        elif message_type == "sync":
+            await self.send_json(await self.get_messages_frame(content.get("since")))
+        elif message_type == "read_messages":
+            unread_count = await self.read_messages()
+            await self.channel_layer.group_send(
+                self.user.username + "__notifications",
+                encode_event({
+                    "type": "unread_count",
+                    "unread_count": unread_count
+                }),
+            )
+
+        return await super().receive_json(content, **kwargs)
+
+    async def set_typing(self, typing):
+        """Broadcast typing state changes, stop typing on timeout"""
+        if self.typing_tracker.update(typing):
+            await self.send_typing(typing)
+            if typing:
+                self.typing_task = asyncio.create_task(self.expire_typing())
+
+    async def expire_typing(self):
+        while self.typing_tracker.typing:
+            await asyncio.sleep(self.typing_tracker.seconds_left())
+            if self.typing_tracker.expire():
+                await self.send_typing(False)
+
+    async def send_typing(self, typing):
+        await self.channel_layer.group_send(
+            self.conversation_name,
+            encode_event({
+                "type": "typing",
+                "user": self.user.username,
+                "typing": typing,
+            }),
+        )
+
+    async def chat_message_echo(self, event):
+        await self.send_event(event)
+
+    async def user_join(self, event):
+        await self.send_event(event)
+
+    async def user_leave(self, event):
+        await self.send_event(event)
+
+    async def typing(self, event):
+        await self.send_event(event)
+
+    async def new_message_notification(self, event):
+        await self.send_event(event)
+
+    async def unread_count(self, event):
+        await self.send_event(event)
@@ -1,74 +1,92 @@
-from typing import Any
 from channels.generic.websocket import JsonWebsocketConsumer
 from asgiref.sync import async_to_sync
-from chat.models import GroupMessage, GroupConversation
 from django.contrib.auth import get_user_model
-from chat.serializers import GroupMessageSerializer, UserSerializer
-import json
-from uuid import UUID
+from chat import services
+from chat.metrics import ConsumerMetricsMixin
+from chat.layers import group_send_many
+from chat.ratelimit import RateLimitMixin
+from chat.protocols import ProtocolMixin
+from chat.encoders import encode_json, encode_event
+from chat.presence import HeartbeatMixin, get_presence
+from urllib.parse import parse_qs
 
 User = get_user_model()
 
-class UUIDEncoder(json.JSONEncoder):
-    def default(self, obj) -> Any:
-        if isinstance(obj, UUID):
-            return obj.hex
-        return json.JSONEncoder.default(self, obj)
-    
-class GroupChatConsumer(JsonWebsocketConsumer):
+
+class GroupChatConsumer(
+    ConsumerMetricsMixin, RateLimitMixin, ProtocolMixin, HeartbeatMixin, JsonWebsocketConsumer
+):
     """
     This consumer is used to implement group chat functional
     """
     
+    metrics_event_types = (
+        "add_member", "remove_member", "chat_message", "read_group_messages", "sync", "heartbeat"
+    )
+    
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.room_name = None
         self.user = None
+        self.conversation = None
+        self.presence = get_presence()
         
     @classmethod
     def encode_json(cls, content):
-        return json.dumps(content, cls=UUIDEncoder)
+        return encode_json(content)
     
     def get_conversation_id(self):
-        group_conversation_count = GroupConversation.objects.filter(admin=self.user).count()
-        return group_conversation_count + 1
+        return services.get_next_group_conversation_id(self.user)
     
     def send_members(self):
         """Send chat members to frontend"""
-        members = self.conversation.members
         self.send_json(
             {
                 "type": "members_list",
-                "users": UserSerializer(members, many=True).data,
+                "users": services.get_members(self.conversation),
             }
         )
         
-    def send_chat_message_echo(self, username, message):
-        """Sending chat message echo"""
-        async_to_sync(self.channel_layer.group_send)(
-                self.conversation_name,
-                {
-                    "type": "chat_message_echo",
-                    "username": username,
-                    "message": message,
-                },
-            )
+    def member_change_event(self, event_type, member):
+        """member_added / member_removed diff of the members list for the group's sockets"""
+        return self.conversation_name, encode_event({
+            "type": event_type,
+            "user": member,
+        })
+        
+    def chat_message_echo_event(self, message):
+        return self.conversation_name, encode_event({
+            "type": "chat_message_echo",
+            "username": self.user.username,
+            "message": message,
+        })
     
-    def send_new_message_group_notification(self, message):
-        """Sending new message notification"""
-        users = self.get_receivers()
-        for user in users:
-            if user == self.user:
-                continue
-            notification_group_name = user.username + "__notifications"
-            async_to_sync(self.channel_layer.group_send)(
-                notification_group_name,
-                {
-                    "type": "new_message_group_notification",
-                    "name": self.user.username,
-                    "message": message
-                }
-            )
+    def get_new_message_group_notification(self, message):
+        return encode_event({
+            "type": "new_message_group_notification",
+            "name": self.user.username,
+            "message": message
+        })
+    
+    def group_notification_event(self, message, exclude=()):
+        """
+        New message notification for the notification sockets of all members
+        at once, skipped by the sender's sockets and those of exclude
+        """
+        event = self.get_new_message_group_notification(message)
+        event["exclude"] = [self.user.username, *exclude]
+        return self.conversation.notification_group, event
+        
+    def notification_subscription_event(self, event_type, username, notification=None):
+        """
+        Subscribe (group_subscribe) or unsubscribe (group_unsubscribe) the
+        notification sockets of username to the group's notifications,
+        delivering notification to them if given
+        """
+        event = {"type": event_type, "group": self.conversation.notification_group}
+        if notification is not None:
+            event["notification"] = notification
+        return username + "__notifications", event
         
     
     def connect(self):
@@ -86,23 +104,18 @@ class GroupChatConsumer(JsonWebsocketConsumer):
         else:
             self.conversation_name = f"{self.scope['url_route']['kwargs']['group_chat_name']}"
         
-        conv = GroupConversation.objects.filter(name=self.conversation_name)
-        created = False
-        if len(conv) == 0:
-            self.conversation = GroupConversation.objects.create(
-                name=self.conversation_name, admin=self.user
-            )
-            created = True
-        else:
-            self.conversation = conv[0]
+        self.conversation, created = services.get_or_create_group_conversation(
+            self.conversation_name, self.user
+        )
             
         async_to_sync(self.channel_layer.group_add)(
             self.conversation_name,
             self.channel_name,
         )
         if created: # Redirect to correct group url if group chat has been just created
-            self.conversation.join_group(self.user)
-            self.conversation.get_members_count()
+            async_to_sync(self.channel_layer.group_send)(
+                *self.notification_subscription_event("group_subscribe", self.user.username)
+            )
             self.send_json(
                 {
                     "type": "redirect",
@@ -111,127 +124,111 @@ class GroupChatConsumer(JsonWebsocketConsumer):
             )
             self.close()
         
-        async_to_sync(self.channel_layer.group_send)(
-            self.conversation_name,
-            {
-                "type": "user_join",
-                "user": self.user.username,
-            }
+        went_online = async_to_sync(self.presence.join)(
+            self.conversation.presence_key, self.user.username, self.channel_name
         )
-        self.conversation.online.add(self.user)
+        if went_online:
+            async_to_sync(self.channel_layer.group_send)(
+                self.conversation_name,
+                encode_event({
+                    "type": "user_join",
+                    "user": self.user.username,
+                })
+            )
         
-        group_messages = self.conversation.group_messages.all().order_by('-timestamp')[:50]
-        group_messages_count = self.conversation.group_messages.all().count()
-        self.send_json(
-            {
-                "type": "last_50_group_messages",
-                "group_messages": GroupMessageSerializer(group_messages, many=True).data,
-                "has_more": group_messages_count > 50,
-            }
-        )
+        since = parse_qs(self.scope["query_string"].decode()).get("since", [None])[0]
+        self.send_json(services.get_group_messages_frame(self.conversation, since))
         self.send_members()
     
     def receive_json(self, content, **kwargs):
         message_type = content['type']
+        if self.rate_limited(content):
+            return
         
         if message_type == "add_member":
-            user = User.objects.filter(username=content['name'])
-            if len(user) == 0:
+            change = services.add_member(self.conversation, content['name'])
+            if change is None:
                 return
-            user = user[0]
-            self.conversation.members.add(user.id)
-            self.send_members()
-            message = GroupMessage.objects.create( # Create message about added member
-                from_user = self.conversation.admin,
-                content = f"User {user.username} was added to the chat",
-                group_conversation = self.conversation
-            )
-            self.send_chat_message_echo(
-                username=self.user.username,
-                message=GroupMessageSerializer(message).data
-            )
-            self.send_new_message_group_notification(
-                message=GroupMessageSerializer(message).data)
+            message, member = change
+            async_to_sync(group_send_many)(self.channel_layer, [
+                self.member_change_event("member_added", member),
+                self.chat_message_echo_event(message),
+                self.notification_subscription_event(
+                    "group_subscribe", member["username"], self.get_new_message_group_notification(message)
+                ),
+                self.group_notification_event(message, exclude=[member["username"]]),
+            ])
             
         elif message_type == "remove_member":
-            user = User.objects.filter(username=content['name'])[0]
-            self.conversation.members.remove(user.id)
-            self.send_members()
-            message = GroupMessage.objects.create( # Create message about removed member
-                from_user = self.conversation.admin,
-                content = f"User {user.username} was removed from the chat",
-                group_conversation = self.conversation
-            )
-            self.send_chat_message_echo(
-                username=self.user.username,
-                message=GroupMessageSerializer(message).data
-            )
-            self.send_new_message_group_notification(
-                message=GroupMessageSerializer(message).data)
+            change = services.remove_member(self.conversation, content['name'])
+            if change is None:
+                return
+            message, member = change
+            async_to_sync(group_send_many)(self.channel_layer, [
+                self.member_change_event("member_removed", member),
+                self.chat_message_echo_event(message),
+                self.notification_subscription_event("group_unsubscribe", member["username"]),
+                self.group_notification_event(message, exclude=[member["username"]]),
+            ])
             
         elif message_type == "chat_message":
-            message = GroupMessage.objects.create(
-                from_user = self.user,
-                content = content["message"],
-                group_conversation = self.conversation
-            )
-            message.read.add(self.user)
-            self.send_chat_message_echo(
-                self.user.username,
-                GroupMessageSerializer(message).data
-            )
-            self.send_new_message_group_notification(
-                message=GroupMessageSerializer(message).data
+            message = services.create_group_message(
+                self.conversation, self.user, content["message"]
             )
+            async_to_sync(group_send_many)(self.channel_layer, [
+                self.chat_message_echo_event(message),
+                self.group_notification_event(message),
+            ])
 
             
+        elif message_type == "sync":
+            self.send_json(services.get_group_messages_frame(self.conversation, content.get("since")))
+            
         elif message_type == "read_group_messages":
-            messages = self.conversation.group_messages.all()
-            for message in messages:
-                message.read.add(self.user)
-                
-            unread_group_count = (
-                GroupMessage.objects.filter(group_conversation__members=self.user)
-                                    .exclude(read=self.user)
-                                    .count()
-            )
+            unread_group_count = services.read_group_messages(self.conversation, self.user)
             async_to_sync(self.channel_layer.group_send)(
                 self.user.username + "__notifications",
-                {
+                encode_event({
                     "type": "unread_group_count",
                     "unread_group_count": unread_group_count,
-                },
+                }),
             )
             
         return super().receive_json(content, **kwargs)
         
     
     def disconnect(self, code):
-        print("Disconnected!")
-        if self.user.is_authenticated:
-            self.send_json(
-                {
-                    "type": "user_leave",
-                    "user": self.user.username,
-                }
+        if self.conversation is not None:
+            went_offline = async_to_sync(self.presence.leave)(
+                self.conversation.presence_key, self.user.username, self.channel_name
             )
-        try:
-            self.conversation.online.remove(self.user)
-        except:
-            pass
+            if went_offline:
+                async_to_sync(self.channel_layer.group_send)(
+                    self.conversation_name,
+                    encode_event({
+                        "type": "user_leave",
+                        "user": self.user.username,
+                    })
+                )
         return super().disconnect(code)
     
     def user_join(self, event):
-        self.send_json(event)
+        self.send_event(event)
+        
+    def user_leave(self, event):
+        self.send_event(event)
+        
+    def member_added(self, event):
+        self.send_event(event)
+        
+    def member_removed(self, event):
+        self.send_event(event)
         
     def chat_message_echo(self, event):
-        self.send_json(event)
+        self.send_event(event)
         
     def new_message_group_notification(self, event):
-        self.send_json(event)
+        self.send_event(event)
     
     def unread_group_count(self, event):
-        self.send_json(event)
-        
-    def get_receivers(self):
-        return User.objects.filter(group_members=self.conversation)
\ No newline at end of file
+        self.send_event(event)
\ No newline at end of file
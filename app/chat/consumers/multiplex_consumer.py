@@ -0,0 +1,222 @@
+from channels.consumer import get_handler_name
+from channels.exceptions import StopConsumer
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from asgiref.sync import async_to_sync
+from chat.metrics import AsyncConsumerMetricsMixin, MeasuredChannelLayer
+from chat.ratelimit import AsyncRateLimitMixin
+from chat.encoders import encode_json
+from chat.presence import AsyncHeartbeatMixin, get_presence
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class StreamLayer(MeasuredChannelLayer):
+    """
+    Channel layer of a stream's consumer. The consumer uses the socket's
+    channel, its group subscriptions are counted by the socket and events it
+    sends to its own channel are delivered to it alone.
+    """
+
+    def __init__(self, socket, stream):
+        super().__init__(socket.channel_layer.layer)
+        self.socket = socket
+        self.stream = stream
+
+    async def group_add(self, group, channel):
+        await self.socket.stream_group_add(self.stream, group)
+
+    async def group_discard(self, group, channel):
+        await self.socket.stream_group_discard(self.stream, group)
+
+    async def send(self, channel, message):
+        if channel == self.socket.channel_name:
+            message = dict(message, to_stream=self.stream)
+        await self.layer.send(channel, message)
+
+
+class MultiplexConsumer(
+    AsyncConsumerMetricsMixin, AsyncRateLimitMixin, AsyncHeartbeatMixin, AsyncJsonWebsocketConsumer
+):
+    """
+    One socket carrying notifications and any number of chats.
+
+    Streams are the paths of the single purpose sockets, e.g.
+    "notifications/", "chats/<conversation_name>/?since=<message id>" or
+    "group_chats/<group_chat_name>/". The client sends
+    {"type": "subscribe" | "unsubscribe", "stream": <path>} and
+    {"stream": <path>, "payload": <frame>}, the server sends
+    {"stream": <path>, "payload": <frame>}, where frames are those of the
+    stream's own socket.
+
+    Every stream is handled by an instance of the consumer routed for its
+    path, with this socket's scope, so it behaves like a separate socket.
+    The instances do not run as ASGI applications: this socket dispatches
+    their frames and events to them one at a time, and they share its
+    channel, receive loop and presence heartbeats. Group subscriptions are
+    counted per group, and group events are passed to the streams of the
+    group they were sent to, which the channel layers of chat.layers
+    deliver with them. Events of other layers go to every stream handling
+    their type. Streams always use the JSON protocol.
+    """
+
+    metrics_event_types = ("subscribe", "unsubscribe")
+    # URL patterns routing stream paths, set by as_asgi(streams=...)
+    streams = ()
+    max_streams = 50
+
+    def __init__(self, *args, streams=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if streams is not None:
+            self.streams = streams
+        self.presence = get_presence()
+        # stream: consumer
+        self.open_streams = {}
+        # stream: close code of streams whose consumer has closed them
+        self.closing_streams = {}
+        # group: streams subscribed to it
+        self.group_streams = {}
+        self.closed = False
+
+    @classmethod
+    async def encode_json(cls, content):
+        return encode_json(content)
+
+    async def connect(self):
+        if not self.scope["user"].is_authenticated:
+            return
+        await self.accept()
+
+    async def disconnect(self, code):
+        self.closed = True
+        for stream in list(self.open_streams):
+            await self.unsubscribe(stream)
+        return await super().disconnect(code)
+
+    async def dispatch(self, message):
+        if "to_stream" in message:
+            await self.dispatch_stream(message["to_stream"], message)
+        elif "to_group" in message:
+            for stream in list(self.group_streams.get(message["to_group"], ())):
+                await self.dispatch_stream(stream, message)
+        elif message["type"].startswith("websocket.") or hasattr(self, get_handler_name(message)):
+            await super().dispatch(message)
+        else:
+            await self.dispatch_streams(message)
+
+    async def presence_heartbeat(self, event):
+        await self.dispatch_streams(event)
+
+    async def receive_json(self, content, **kwargs):
+        if await self.rate_limited(content):
+            return
+        message_type = content.get("type")
+        if message_type == "subscribe":
+            await self.subscribe(content["stream"])
+        elif message_type == "unsubscribe":
+            await self.unsubscribe(content["stream"].partition("?")[0])
+        elif content.get("stream") in self.open_streams:
+            await self.dispatch_stream(
+                content["stream"], {"type": "websocket.receive", "text": json.dumps(content["payload"])}
+            )
+
+    async def send_stream(self, stream, content):
+        if self.closed:
+            return
+        await self.send_json({"stream": stream, "payload": content})
+
+    def resolve(self, stream):
+        """Return the consumer class, its init kwargs and the URL kwargs of a stream, or None"""
+        for route in self.streams:
+            match = route.pattern.match(stream.lstrip("/"))
+            if match and not match[0]:
+                return route.callback.consumer_class, route.callback.consumer_initkwargs, match[2]
+        return None
+
+    async def subscribe(self, path):
+        stream, _, query_string = path.partition("?")
+        if stream in self.open_streams:
+            return
+        if len(self.open_streams) >= self.max_streams:
+            await self.send_stream(stream, {"type": "error", "message": "Too many streams"})
+            return
+        route = self.resolve(stream)
+        if route is None:
+            await self.send_stream(stream, {"type": "error", "message": "Unknown stream"})
+            await self.send_stream(stream, {"type": "unsubscribed"})
+            return
+        consumer_class, initkwargs, kwargs = route
+        consumer = consumer_class(**initkwargs)
+        consumer.scope = {
+            key: value for key, value in self.scope.items()
+            if key not in ("path_remaining", "url_route", "subprotocols")
+        }
+        consumer.scope.update(
+            path=f"/{stream.lstrip('/')}", query_string=query_string.encode(),
+            url_route={"args": (), "kwargs": kwargs},
+        )
+        consumer.channel_layer = StreamLayer(self, stream)
+        consumer.channel_name = self.channel_name
+
+        async def send(message):
+            if message["type"] == "websocket.send" and message.get("text") is not None and not self.closed:
+                # Frames are forwarded as they are, without decoding them
+                await self.send(text_data=f'{{"stream":{json.dumps(stream)},"payload":{message["text"]}}}')
+            elif message["type"] == "websocket.close":
+                self.closing_streams[stream] = message.get("code", 1000)
+
+        consumer.base_send = async_to_sync(send) if consumer._sync else send
+        self.open_streams[stream] = consumer
+        await self.dispatch_stream(stream, {"type": "websocket.connect"})
+
+    async def unsubscribe(self, stream):
+        await self.dispatch_stream(stream, {"type": "websocket.disconnect", "code": 1000})
+
+    async def dispatch_stream(self, stream, message):
+        """Pass a frame or event to the consumer of a stream, end the stream once it stops"""
+        consumer = self.open_streams.get(stream)
+        if consumer is None:
+            return
+        try:
+            await consumer.dispatch(message)
+        except StopConsumer:
+            await self.end_stream(stream)
+        except Exception:
+            logger.exception("Stream %s failed", stream)
+            await self.end_stream(stream)
+        else:
+            if stream in self.closing_streams:
+                await self.dispatch_stream(
+                    stream, {"type": "websocket.disconnect", "code": self.closing_streams[stream]}
+                )
+
+    async def dispatch_streams(self, message):
+        """Pass an event to every stream handling its type"""
+        handler_name = get_handler_name(message)
+        for stream, consumer in list(self.open_streams.items()):
+            if hasattr(consumer, handler_name):
+                await self.dispatch_stream(stream, message)
+
+    async def end_stream(self, stream):
+        del self.open_streams[stream]
+        self.closing_streams.pop(stream, None)
+        for group, streams in list(self.group_streams.items()):
+            if stream in streams:
+                await self.stream_group_discard(stream, group)
+        await self.send_stream(stream, {"type": "unsubscribed"})
+
+    async def stream_group_add(self, stream, group):
+        streams = self.group_streams.setdefault(group, set())
+        if not streams:
+            await self.channel_layer.group_add(group, self.channel_name)
+        streams.add(stream)
+
+    async def stream_group_discard(self, stream, group):
+        streams = self.group_streams.get(group, set())
+        if stream not in streams:
+            return
+        streams.discard(stream)
+        if not streams:
+            del self.group_streams[group]
+            await self.channel_layer.group_discard(group, self.channel_name)
@@ -1,13 +1,21 @@
 from channels.generic.websocket import JsonWebsocketConsumer
 from asgiref.sync import async_to_sync
-from chat.models import Message, GroupMessage
+from chat import services
+from chat.metrics import ConsumerMetricsMixin
+from chat.protocols import ProtocolMixin
+from chat.encoders import encode_json
     
-class NotificationConsumer(JsonWebsocketConsumer):
+class NotificationConsumer(ConsumerMetricsMixin, ProtocolMixin, JsonWebsocketConsumer):
     """Single endpoint for user's notifications"""
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.user = None
         self.notification_group_name = None
+        self.group_notification_groups = set()
+        
+    @classmethod
+    def encode_json(cls, content):
+        return encode_json(content)
         
     def connect(self):
         self.user = self.scope["user"]
@@ -20,8 +28,10 @@ class NotificationConsumer(JsonWebsocketConsumer):
             self.notification_group_name,
             self.channel_name,
         )
+        for group in services.get_notification_groups(self.user):
+            self.subscribe(group)
         
-        unread_count = Message.objects.filter(to_user=self.user, read=False).count()
+        unread_count, unread_group_count = services.get_unread_counts(self.user)
         self.send_json(
             {
                 "type": "unread_count",
@@ -29,11 +39,6 @@ class NotificationConsumer(JsonWebsocketConsumer):
             }
         )
         
-        unread_group_count = (
-                GroupMessage.objects.filter(group_conversation__members=self.user)
-                                    .exclude(read=self.user)
-                                    .count()
-        )
         self.send_json(
             {
                 "type": "unread_group_count",
@@ -46,16 +51,39 @@ class NotificationConsumer(JsonWebsocketConsumer):
             self.notification_group_name,
             self.channel_name,
         )
+        for group in list(self.group_notification_groups):
+            self.unsubscribe(group)
         return super().disconnect(code)
     
+    def subscribe(self, group):
+        """Receive notifications of a group conversation"""
+        async_to_sync(self.channel_layer.group_add)(group, self.channel_name)
+        self.group_notification_groups.add(group)
+        
+    def unsubscribe(self, group):
+        async_to_sync(self.channel_layer.group_discard)(group, self.channel_name)
+        self.group_notification_groups.discard(group)
+    
+    def group_subscribe(self, event):
+        """The user has been added to a group"""
+        self.subscribe(event["group"])
+        if "notification" in event:
+            self.send_event(event["notification"])
+            
+    def group_unsubscribe(self, event):
+        """The user has been removed from a group"""
+        self.unsubscribe(event["group"])
+    
     def new_message_notification(self, event):
-        self.send_json(event)
+        self.send_event(event)
         
     def new_message_group_notification(self, event):
-        self.send_json(event)
+        if self.user.username in event.get("exclude", ()):
+            return
+        self.send_event(event)
         
     def unread_count(self, event):
-        self.send_json(event)
+        self.send_event(event)
         
     def unread_group_count(self, event):
-        self.send_json(event)
\ No newline at end of file
+        self.send_event(event)
\ No newline at end of file
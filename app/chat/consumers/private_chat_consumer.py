@@ -1,35 +1,44 @@
-from typing import Any
 from channels.generic.websocket import JsonWebsocketConsumer
 from asgiref.sync import async_to_sync
-from chat.models import Conversation, Message, GroupMessage, GroupConversation
 from django.contrib.auth import get_user_model
-from django.db.models import Q
-from chat.serializers import MessageSerializer, GroupMessageSerializer, UserSerializer
-import json
-from uuid import UUID
+from chat import services
+from chat.metrics import ConsumerMetricsMixin
+from chat.layers import group_send_many
+from chat.ratelimit import RateLimitMixin
+from chat.protocols import ProtocolMixin
+from chat.encoders import encode_json, encode_event
+from chat.presence import HeartbeatMixin, get_presence
+from chat.typing import TypingTracker, TYPING_TIMEOUT
+from urllib.parse import parse_qs
+import asyncio
 
 User = get_user_model()
 
-class UUIDEncoder(json.JSONEncoder):
-    def default(self, obj) -> Any:
-        if isinstance(obj, UUID):
-            return obj.hex
-        return json.JSONEncoder.default(self, obj)
-    
-class ChatConsumer(JsonWebsocketConsumer):
+
+class ChatConsumer(
+    ConsumerMetricsMixin, RateLimitMixin, ProtocolMixin, HeartbeatMixin, JsonWebsocketConsumer
+):
     """
     This consumer is used to show user's online status,
     and send notifications.
     """
     
+    metrics_event_types = ("chat_message", "typing", "read_messages", "sync", "heartbeat")
+    typing_timeout = TYPING_TIMEOUT
+    
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.room_name = None
         self.user = None
+        self.conversation = None
+        self.receiver = None
+        self.presence = get_presence()
+        self.typing_tracker = TypingTracker(self.typing_timeout)
+        self.typing_task = None
         
     @classmethod
     def encode_json(cls, content):
-        return json.dumps(content, cls=UUIDEncoder)
+        return encode_json(content)
         
     def connect(self):
         try:
@@ -40,7 +49,8 @@ class ChatConsumer(JsonWebsocketConsumer):
             return
         self.accept()
         self.conversation_name = f"{self.scope['url_route']['kwargs']['conversation_name']}"
-        self.conversation, created = Conversation.objects.get_or_create(name=self.conversation_name)
+        self.conversation, created = services.get_or_create_conversation(self.conversation_name)
+        self.receiver = self.get_receiver()
         async_to_sync(self.channel_layer.group_add)(
             self.conversation_name,
             self.channel_name,
@@ -55,113 +65,136 @@ class ChatConsumer(JsonWebsocketConsumer):
         self.send_json(
             {
                 "type": "online_user_list",
-                "users": [user.username for user in self.conversation.online.all()],
-            }
-        )
-        async_to_sync(self.channel_layer.group_send)(
-            self.conversation_name,
-            {
-                "type": "user_join",
-                "user": self.user.username,
+                "users": async_to_sync(self.presence.online)(self.conversation.presence_key),
             }
         )
-        self.conversation.online.add(self.user)
-        
-        messages = self.conversation.messages.all().order_by("-timestamp")[0:50]
-        message_count = self.conversation.messages.all().count()
-        self.send_json(
-            {
-                "type": "last_50_messages",
-                "messages": MessageSerializer(messages, many=True).data,
-                "has_more": message_count > 50,
-            }
+        went_online = async_to_sync(self.presence.join)(
+            self.conversation.presence_key, self.user.username, self.channel_name
         )
-        
-    def disconnect(self, code):
-        print("Disconnected!")
-        if self.user.is_authenticated:
+        if went_online:
             async_to_sync(self.channel_layer.group_send)(
                 self.conversation_name,
-                {
-                    "type": "user_leave",
+                encode_event({
+                    "type": "user_join",
                     "user": self.user.username,
-                },
+                })
+            )
+        
+        since = parse_qs(self.scope["query_string"].decode()).get("since", [None])[0]
+        self.send_json(services.get_messages_frame(self.conversation, since))
+        
+    def disconnect(self, code):
+        async_to_sync(self.cancel_typing_expiry)()
+        if self.conversation is not None:
+            self.set_typing(False)
+            went_offline = async_to_sync(self.presence.leave)(
+                self.conversation.presence_key, self.user.username, self.channel_name
             )
-            self.conversation.online.remove(self.user)
+            if went_offline:
+                async_to_sync(self.channel_layer.group_send)(
+                    self.conversation_name,
+                    encode_event({
+                        "type": "user_leave",
+                        "user": self.user.username,
+                    }),
+                )
         return super().disconnect(code)
     
     def receive_json(self, content, **kwargs):
         message_type = content['type']
+        if self.rate_limited(content):
+            return
         if message_type == "chat_message":
-            message = Message.objects.create(
-                from_user = self.user,
-                to_user = self.get_receiver(),
-                content = content["message"],
-                conversation = self.conversation
+            self.set_typing(False)
+            message, receiver = services.create_message(
+                self.conversation, self.user, content["message"], self.receiver
             )
-            
-            async_to_sync(self.channel_layer.group_send)(
-                self.conversation_name,
-                {
+            async_to_sync(group_send_many)(self.channel_layer, [
+                (self.conversation_name, encode_event({
                     "type": "chat_message_echo",
                     "username": self.user.username,
-                    "message": MessageSerializer(message).data
-                },
-            )
-            notification_group_name = self.get_receiver().username + "__notifications"
-            async_to_sync(self.channel_layer.group_send)(
-                notification_group_name,
-                {
+                    "message": message
+                })),
+                (receiver.username + "__notifications", encode_event({
                     "type": "new_message_notification",
                     "name": self.user.username,
-                    "message": MessageSerializer(message).data
-                }
-            )
+                    "message": message
+                })),
+            ])
         elif message_type == "typing":
-            async_to_sync(self.channel_layer.group_send)(
-                self.conversation_name,
-                {
-                    "type": "typing",
-                    "user": self.user.username,
-                    "typing": content["typing"]
-                },
-            )
+            self.set_typing(bool(content["typing"]))
+        elif message_type == "sync":
+            self.send_json(services.get_messages_frame(self.conversation, content.get("since")))
         elif message_type == "read_messages":
-            messages_to_me = self.conversation.messages.filter(to_user=self.user)
-            messages_to_me.update(read=True)
-            
-            unread_count = Message.objects.filter(to_user=self.user, read=False).count()
+            unread_count = services.read_messages(self.conversation, self.user)
             async_to_sync(self.channel_layer.group_send)(
                 self.user.username + "__notifications",
-                {
+                encode_event({
                     "type": "unread_count",
                     "unread_count": unread_count
-                },
+                }),
             )
             
         return super().receive_json(content, **kwargs)
     
+    def set_typing(self, typing):
+        """Broadcast typing state changes, stop typing on timeout"""
+        if self.typing_tracker.update(typing):
+            self.send_typing(typing)
+            if typing:
+                async_to_sync(self.schedule_typing_expiry)()
+    
+    async def schedule_typing_expiry(self):
+        """
+        Start a task on the consumer's event loop that sends a typing_expire
+        event to the consumer's own channel once typing times out, so the
+        timeout is handled in order with the consumer's other events.
+        """
+        await self.cancel_typing_expiry()
+        self.typing_task = asyncio.create_task(self.typing_expiry())
+    
+    async def cancel_typing_expiry(self):
+        if self.typing_task is not None:
+            self.typing_task.cancel()
+    
+    async def typing_expiry(self):
+        await asyncio.sleep(self.typing_tracker.seconds_left())
+        await self.channel_layer.send(self.channel_name, {"type": "typing_expire"})
+    
+    def typing_expire(self, event):
+        if self.typing_tracker.expire():
+            self.send_typing(False)
+        elif self.typing_tracker.typing:
+            async_to_sync(self.schedule_typing_expiry)()
+    
+    def send_typing(self, typing):
+        async_to_sync(self.channel_layer.group_send)(
+            self.conversation_name,
+            encode_event({
+                "type": "typing",
+                "user": self.user.username,
+                "typing": typing,
+            }),
+        )
+    
     def chat_message_echo(self, event):
-        self.send_json(event)
+        self.send_event(event)
         
     def user_join(self, event):
-        self.send_json(event)
+        self.send_event(event)
     
     def user_leave(self, event):
-        self.send_json(event)
+        self.send_event(event)
         
     def typing(self, event):
-        self.send_json(event)
+        self.send_event(event)
         
     def new_message_notification(self, event):
-        self.send_json(event)
+        self.send_event(event)
         
     def unread_count(self, event):
-        self.send_json(event)
+        self.send_event(event)
         
     def get_receiver(self):
-        usernames = self.conversation_name.split('__')
-        for username in usernames:
-            if username != self.user.username:
-                return User.objects.get(username=username)
+        return services.get_receiver(self.conversation, self.user)
 
@@ -0,0 +1,160 @@
+"""
+Materialized unread counters.
+
+UnreadCounter rows hold the number of unread messages per user and
+conversation, UnreadTotal rows hold their per-user sums. Both are updated
+incrementally when messages are created or read, so the notification
+socket reads the totals with a single primary key lookup.
+"""
+from datetime import datetime, timezone
+from django.db import transaction
+from django.db.models import F, Count, DateTimeField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from chat.models import UnreadCounter, UnreadTotal, Message, GroupMessage, GroupMembership
+
+
+def _total_field(group_conversation):
+    return "unread_group_count" if group_conversation is not None else "unread_count"
+
+
+def _ensure_rows(user_ids, conversation, group_conversation):
+    existing = set(
+        UnreadCounter.objects.filter(
+            user_id__in=user_ids,
+            conversation=conversation,
+            group_conversation=group_conversation,
+        ).values_list("user_id", flat=True)
+    )
+    missing = [user_id for user_id in user_ids if user_id not in existing]
+    if not missing:
+        return
+    UnreadCounter.objects.bulk_create(
+        [
+            UnreadCounter(
+                user_id=user_id,
+                conversation=conversation,
+                group_conversation=group_conversation,
+            )
+            for user_id in missing
+        ],
+        ignore_conflicts=True,
+    )
+    UnreadTotal.objects.bulk_create(
+        [UnreadTotal(user_id=user_id) for user_id in missing],
+        ignore_conflicts=True,
+    )
+
+
+def increment(user_ids, conversation=None, group_conversation=None, by=1):
+    """Add `by` unread messages in the conversation for every user in user_ids"""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    field = _total_field(group_conversation)
+    with transaction.atomic():
+        _ensure_rows(user_ids, conversation, group_conversation)
+        UnreadCounter.objects.filter(
+            user_id__in=user_ids,
+            conversation=conversation,
+            group_conversation=group_conversation,
+        ).update(count=F("count") + by)
+        UnreadTotal.objects.filter(user_id__in=user_ids).update(**{field: F(field) + by})
+
+
+def reset(user, conversation=None, group_conversation=None):
+    """
+    Mark everything in the conversation as read for user.
+    Return the number of messages that were unread and the new user total.
+    """
+    field = _total_field(group_conversation)
+    with transaction.atomic():
+        counter = (
+            UnreadCounter.objects.select_for_update()
+            .filter(user=user, conversation=conversation, group_conversation=group_conversation)
+            .first()
+        )
+        if counter is None or counter.count == 0:
+            return 0, getattr(get_totals(user), field)
+        unread = counter.count
+        counter.count = 0
+        counter.save(update_fields=["count"])
+        total, _ = UnreadTotal.objects.select_for_update().get_or_create(user=user)
+        setattr(total, field, max(getattr(total, field) - unread, 0))
+        total.save(update_fields=[field])
+        return unread, getattr(total, field)
+
+
+def drop(user, group_conversation):
+    """Forget user's counter of a group, e.g. when user leaves it"""
+    unread, _ = reset(user, group_conversation=group_conversation)
+    UnreadCounter.objects.filter(user=user, group_conversation=group_conversation).delete()
+    return unread
+
+
+def get_totals(user):
+    """Return UnreadTotal of user, unsaved and empty if user has none yet"""
+    try:
+        return UnreadTotal.objects.get(user=user)
+    except UnreadTotal.DoesNotExist:
+        return UnreadTotal(user=user)
+
+
+def rebuild():
+    """Recompute all counters and totals from messages"""
+    counters = {}
+    private_unread = (
+        Message.objects.filter(read=False)
+                       .values("to_user", "conversation")
+                       .annotate(unread=Count("id"))
+                       .order_by()
+    )
+    for row in private_unread:
+        counters[(row["to_user"], row["conversation"], None)] = row["unread"]
+
+    # Unread group messages of a member are the messages of others
+    # newer than the member's read watermark.
+    never_read = Value(datetime.min.replace(tzinfo=timezone.utc), output_field=DateTimeField())
+    group_unread = (
+        GroupMessage.objects.filter(
+            group_conversation=OuterRef("group_conversation"),
+            timestamp__gt=Coalesce(OuterRef("last_read_at"), never_read),
+        )
+        .exclude(from_user=OuterRef("user"))
+        .order_by()
+        .values("group_conversation")
+        .annotate(unread=Count("id"))
+        .values("unread")
+    )
+    memberships = (
+        GroupMembership.objects.annotate(unread=Subquery(group_unread))
+                               .filter(unread__gt=0)
+                               .values_list("user", "group_conversation", "unread")
+    )
+    for user_id, group_id, unread in memberships.iterator():
+        counters[(user_id, None, group_id)] = unread
+
+    totals = {}
+    for (user_id, conversation_id, group_id), unread in counters.items():
+        total = totals.setdefault(user_id, UnreadTotal(user_id=user_id))
+        if group_id is None:
+            total.unread_count += unread
+        else:
+            total.unread_group_count += unread
+
+    with transaction.atomic():
+        UnreadCounter.objects.all().delete()
+        UnreadTotal.objects.all().delete()
+        UnreadCounter.objects.bulk_create(
+            [
+                UnreadCounter(
+                    user_id=user_id,
+                    conversation_id=conversation_id,
+                    group_conversation_id=group_id,
+                    count=unread,
+                )
+                for (user_id, conversation_id, group_id), unread in counters.items()
+            ],
+            batch_size=1000,
+        )
+        UnreadTotal.objects.bulk_create(totals.values(), batch_size=1000)
+    return len(counters), len(totals)
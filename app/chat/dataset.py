@@ -0,0 +1,279 @@
+"""
+Synthetic chat data for scale testing, generated by
+``python manage.py generate_chat_dataset [options]``.
+
+Every user has private conversations with --conversations-per-user others
+on average, preferring popular users, and --groups groups get uniform or
+Pareto distributed sizes. --messages and --group-messages are spread over
+conversations and groups with a heavy tail, so most have a few messages
+and some have thousands, and conversations that were active recently
+outnumber those that went quiet long ago.
+
+Conversations are generated newest message first, which makes read state
+cheap to decide: a participant who is not caught up (1 - --read-share of
+them) has their first messages unread, and a group member's read
+watermark is one of the newest group messages. Unread counters are
+rebuilt from the generated rows at the end.
+
+Rows are written with bulk_create in batches of --batch-size, so memory
+grows with users, conversations and group members but not with messages.
+The same options give the same dataset, primary keys included (except
+users'), as long as --end is given.
+"""
+import bisect
+import collections
+import itertools
+import random
+import time
+import uuid
+from array import array
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import reset_queries
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from chat import counters
+from chat.models import Conversation, GroupConversation, GroupMembership, GroupMessage, Message
+
+User = get_user_model()
+
+WORDS = (
+    "hi", "hey", "ok", "sure", "thanks", "yes", "no", "maybe", "later", "today", "tomorrow",
+    "meeting", "lunch", "call", "me", "you", "we", "the", "a", "is", "are", "will", "be",
+    "there", "at", "in", "on", "soon", "done", "see", "what", "about", "this", "that",
+)
+
+
+def add_arguments(parser):
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--conversations-per-user", type=float, default=4)
+    parser.add_argument("--messages", type=int, default=1000000, help="Private messages in total")
+    parser.add_argument("--groups", type=int, default=1000)
+    parser.add_argument("--group-size-distribution", choices=["uniform", "pareto"], default="pareto")
+    parser.add_argument("--min-group-size", type=int, default=3)
+    parser.add_argument("--max-group-size", type=int, default=500)
+    parser.add_argument("--group-messages", type=int, default=1000000, help="Group messages in total")
+    parser.add_argument("--days", type=float, default=365, help="Time span of the messages")
+    parser.add_argument("--end", default=None, help="ISO timestamp of the newest messages, now by default")
+    parser.add_argument("--read-share", type=float, default=0.8, help="Share of caught up participants")
+    parser.add_argument("--popularity", type=float, default=1.0, help="Zipf exponent of user popularity")
+    parser.add_argument("--prefix", default="synthetic_", help="Username and group name prefix")
+    parser.add_argument("--password", default=None, help="Password of every user, unusable by default")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+class BatchWriter:
+    """Buffer model instances and bulk_create them batch_size at a time"""
+
+    def __init__(self, model, batch_size, after=()):
+        self.model = model
+        self.batch_size = batch_size
+        # Writers of rows that rows of this one reference, flushed first
+        self.after = after
+        self.objects = []
+        self.count = 0
+
+    def add(self, obj):
+        self.objects.append(obj)
+        if len(self.objects) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for writer in self.after:
+            writer.flush()
+        if self.objects:
+            self.model.objects.bulk_create(self.objects)
+            self.count += len(self.objects)
+            self.objects = []
+            # With DEBUG on, the connection keeps the SQL of every query
+            reset_queries()
+
+
+class DatasetGenerator:
+    def __init__(self, options):
+        self.options = options
+        self.random = random.Random(f"{options['seed']}:{options['prefix']}")
+        self.end = parse_datetime(options["end"]) if options.get("end") else timezone.now()
+        if timezone.is_naive(self.end):
+            self.end = timezone.make_aware(self.end)
+        self.span = timedelta(days=options["days"]).total_seconds()
+        self.user_ids = array("q")
+        self.popularity = list(itertools.accumulate(
+            1 / (rank + 1) ** options["popularity"] for rank in range(options["users"])
+        ))
+
+    def generate(self, stdout):
+        started = time.perf_counter()
+        for name, step in (
+            ("users", self.create_users),
+            ("private conversations", self.create_conversations),
+            ("groups", self.create_groups),
+            ("last messages and unread counters", self.finish),
+        ):
+            count = step()
+            stdout.write(f"{name}: {count if count is not None else 'done'} ({time.perf_counter() - started:.1f} s)")
+
+    def uuid(self):
+        return uuid.UUID(int=self.random.getrandbits(128), version=4)
+
+    def username(self, index):
+        return f"{self.options['prefix']}{index}"
+
+    def popular_user(self):
+        """Index of a user, the lower the more likely"""
+        return bisect.bisect_left(self.popularity, self.random.random() * self.popularity[-1])
+
+    def split(self, total, weights):
+        """Split total into counts proportional to weights, summing up to total"""
+        weight_sum = sum(weights) or 1
+        counts = array("q", (int(total * weight / weight_sum) for weight in weights))
+        for index in self.random.sample(range(len(counts)), min(total - sum(counts), len(counts))):
+            counts[index] += 1
+        return counts
+
+    def unread_count(self):
+        """Number of newest messages a participant has not read"""
+        if self.random.random() < self.options["read_share"]:
+            return 0
+        return int(self.random.expovariate(1 / 5)) + 1
+
+    def timestamps(self, count):
+        """
+        Yield count timestamps of one conversation, newest first. The
+        conversation was last active at a time skewed towards the end of
+        the span and started at a random time before that.
+        """
+        last_active = self.span * self.random.random() ** 3
+        length = (self.span - last_active) * self.random.random()
+        # Descending order statistics of count uniform samples, without keeping them
+        position = 1.0
+        for remaining in range(count, 0, -1):
+            position *= self.random.random() ** (1 / remaining)
+            yield self.end - timedelta(seconds=last_active + length * (1 - position))
+
+    def content(self):
+        return " ".join(self.random.choices(WORDS, k=self.random.randint(1, 12)))
+
+    def create_users(self):
+        password = make_password(self.options["password"])
+        writer = BatchWriter(User, self.options["batch_size"])
+        for index in range(self.options["users"]):
+            writer.add(User(username=self.username(index), first_name=f"User {index}", password=password))
+        writer.flush()
+        # Users' ids are assigned by the database, read them back in creation order
+        users = User.objects.filter(username__startswith=self.options["prefix"]).values_list("username", "id")
+        ids = dict(users.iterator(chunk_size=self.options["batch_size"]))
+        self.user_ids.extend(ids[self.username(index)] for index in range(self.options["users"]))
+        return writer.count
+
+    def pick_pairs(self):
+        users = self.options["users"]
+        target = min(int(users * self.options["conversations_per_user"] / 2), users * (users - 1) // 2)
+        pairs = set()
+        while len(pairs) < target:
+            first, second = self.random.randrange(users), self.popular_user()
+            if first != second:
+                pairs.add((min(first, second), max(first, second)))
+        return sorted(pairs)
+
+    def create_conversations(self):
+        batch_size = self.options["batch_size"]
+        conversations = BatchWriter(Conversation, batch_size)
+        participants = BatchWriter(Conversation.participants.through, batch_size, after=[conversations])
+        messages = BatchWriter(Message, batch_size, after=[conversations])
+        pairs = self.pick_pairs()
+        counts = self.split(self.options["messages"], [self.random.paretovariate(1.2) for _ in pairs])
+        for (first, second), count in zip(pairs, counts):
+            user_ids = (self.user_ids[first], self.user_ids[second])
+            conversation = Conversation(
+                id=self.uuid(),
+                name=f"{self.username(first)}__{self.username(second)}",
+                pair_key=Conversation.make_pair_key(*user_ids),
+            )
+            conversations.add(conversation)
+            for user_id in user_ids:
+                participants.add(Conversation.participants.through(conversation_id=conversation.id, user_id=user_id))
+            unread = [self.unread_count(), self.unread_count()]
+            for timestamp in self.timestamps(count):
+                sender = self.random.randrange(2)
+                messages.add(Message(
+                    id=self.uuid(), conversation_id=conversation.id, from_user_id=user_ids[sender],
+                    to_user_id=user_ids[1 - sender], content=self.content(), timestamp=timestamp,
+                    read=unread[1 - sender] <= 0,
+                ))
+                unread[1 - sender] -= 1
+                # Everything older than a participant's own message is read
+                unread[sender] = 0
+        for writer in (participants, messages):
+            writer.flush()
+        return conversations.count
+
+    def group_size(self):
+        high = min(self.options["max_group_size"], self.options["users"])
+        low = min(self.options["min_group_size"], high)
+        if self.options["group_size_distribution"] == "uniform":
+            return self.random.randint(low, high)
+        return min(int(low * self.random.paretovariate(1.5)), high)
+
+    def create_groups(self):
+        batch_size = self.options["batch_size"]
+        groups = BatchWriter(GroupConversation, batch_size)
+        messages = BatchWriter(GroupMessage, batch_size, after=[groups])
+        memberships = BatchWriter(GroupMembership, batch_size, after=[groups, messages])
+        members = []
+        for _ in range(self.options["groups"]):
+            group_members = {self.random.randrange(self.options["users"])}
+            size = self.group_size()
+            while len(group_members) < size:
+                group_members.add(self.popular_user())
+            members.append(array("q", sorted(group_members)))
+        counts = self.split(
+            self.options["group_messages"],
+            [len(group_members) * self.random.paretovariate(1.2) for group_members in members],
+        )
+        for index, (group_members, count) in enumerate(zip(members, counts)):
+            member_ids = [self.user_ids[member] for member in group_members]
+            group = GroupConversation(
+                id=self.uuid(), name=f"{self.options['prefix']}group_{index}",
+                admin_id=self.random.choice(member_ids), members_count=len(member_ids),
+            )
+            groups.add(group)
+            # Members by how many of the newest messages they have not read
+            unread = collections.defaultdict(list)
+            for member_id in member_ids:
+                unread[self.unread_count()].append(member_id)
+            watermarks = {}
+            for position, timestamp in enumerate(self.timestamps(count)):
+                message = GroupMessage(
+                    id=self.uuid(), group_conversation_id=group.id, from_user_id=self.random.choice(member_ids),
+                    content=self.content(), timestamp=timestamp,
+                )
+                messages.add(message)
+                # Everything up to a member's own message is read
+                for member_id in [message.from_user_id, *unread.pop(position, ())]:
+                    watermarks.setdefault(member_id, message)
+            for member_id in member_ids:
+                last_read = watermarks.get(member_id)
+                memberships.add(GroupMembership(
+                    group_conversation_id=group.id, user_id=member_id,
+                    last_read_at=last_read.timestamp if last_read else None,
+                    last_read_message_id=last_read.id if last_read else None,
+                ))
+        memberships.flush()
+        return groups.count
+
+    def finish(self):
+        prefix = self.options["prefix"]
+        for model, message_model, field, names in (
+            (Conversation, Message, "conversation", {"name__startswith": prefix}),
+            (GroupConversation, GroupMessage, "group_conversation", {"name__startswith": f"{prefix}group_"}),
+        ):
+            last_message = message_model.objects.filter(**{field: OuterRef("id")}).order_by("-timestamp", "-id")
+            model.objects.filter(**names).update(
+                last_message=Subquery(last_message.values("id")[:1]),
+                last_message_at=Subquery(last_message.values("timestamp")[:1]),
+            )
+        counters.rebuild()
@@ -0,0 +1,61 @@
+"""
+JSON encoding of websocket frames.
+
+The encoder is a backend selected by settings.CHAT_JSON_ENCODER (see
+chat.backends). The default JSONEncoder produces exactly what consumers
+have always sent; OrjsonEncoder is faster but needs the optional orjson
+package, emits compact JSON without spaces after separators and dashed
+UUIDs.
+"""
+import json
+from typing import Any
+from uuid import UUID
+from chat.backends import get_backend
+
+
+class UUIDEncoder(json.JSONEncoder):
+    def default(self, obj) -> Any:
+        if isinstance(obj, UUID):
+            return obj.hex
+        return json.JSONEncoder.default(self, obj)
+
+
+class JSONEncoder:
+    """Stdlib json, with one reused encoder instead of one per frame"""
+
+    def __init__(self):
+        self.encoder = UUIDEncoder()
+
+    def encode(self, content):
+        return self.encoder.encode(content)
+
+
+class OrjsonEncoder:
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+
+    def encode(self, content):
+        return self.orjson.dumps(content).decode()
+
+
+def get_encoder():
+    return get_backend("CHAT_JSON_ENCODER", "chat.encoders.JSONEncoder", "chat.encoders.JSONEncoder")
+
+
+def encode_json(content):
+    return get_encoder().encode(content)
+
+
+def encode_event(event):
+    """
+    Channel layer event carrying its frame already encoded, so the frame is
+    encoded once per broadcast instead of once per receiving socket.
+    """
+    return {"type": event["type"], "text": encode_json(event)}
+
+
+def frame_text(event):
+    """Text frame of an event, encoding events sent without encode_event"""
+    text = event.get("text")
+    return text if text is not None else encode_json(event)
@@ -0,0 +1,210 @@
+"""
+Ring buffers of the most recent message payloads per conversation.
+
+Socket snapshots and the first page of the message API are served from
+here instead of the database. A buffer holds the `size` newest payloads,
+newest first, plus one more message or an end marker, which is how
+has_more is answered without counting. Buffers are filled from the
+database on the first miss and extended by every new message; pushes to
+a missing buffer are dropped, so a buffer never has gaps. Buffers expire
+after `ttl` seconds without new messages.
+
+Buffers are versioned like the member lists of chat.membership: get()
+returns the conversation's version along with the payloads, every push()
+bumps it, and fill() stores payloads only under the version they were
+read with. A fill from a query that raced a new message is dropped, and
+the next miss reads the database again.
+
+Group message payloads are stored without "read", which depends on the
+members' watermarks at the time they are read. Private message payloads
+are stored as they were when buffered and never rewritten; mark_read()
+records the time a user read the conversation and payloads sent to them
+before that are returned as read.
+
+Configure with settings.CHAT_HISTORY, see chat.backends.
+"""
+import json
+import time
+from collections import OrderedDict
+from chat.backends import get_backend, get_connection, redis_key
+from chat.payloads import set_read
+
+DEFAULT_SIZE = 50
+DEFAULT_TTL = 24 * 60 * 60
+END = "end"
+
+
+class BaseHistory:
+    def __init__(self, size=DEFAULT_SIZE, ttl=DEFAULT_TTL):
+        self.size = size
+        self.ttl = ttl
+
+    def _entries(self, payloads):
+        """Entries to store for the newest payloads of a conversation"""
+        entries = list(payloads[:self.size + 1])
+        if len(entries) <= self.size:
+            entries.append(END)
+        return entries
+
+    def _result(self, entries, count, read_watermarks):
+        if not entries:
+            return None
+        complete = entries[-1] == END
+        if complete:
+            entries = entries[:-1]
+        if read_watermarks:
+            set_read(entries[:count], read_watermarks)
+        return entries[:count], len(entries) > count or not complete
+
+    async def get(self, conversation_key, count):
+        """
+        Return the conversation's version and the count newest payloads and
+        whether older messages exist, or None if the conversation is not
+        buffered or count exceeds size.
+        """
+        raise NotImplementedError
+
+    async def fill(self, conversation_key, version, payloads):
+        """
+        Buffer the newest payloads read from the database after get() returned
+        version, unless the conversation is buffered already or has a newer
+        version. Pass at least size + 1 payloads if there are that many messages.
+        """
+        raise NotImplementedError
+
+    async def push(self, conversation_key, payload):
+        """Add a new message payload to a buffered conversation, bump its version"""
+        raise NotImplementedError
+
+    async def mark_read(self, conversation_key, username):
+        """Return buffered private messages sent to username until now as read"""
+        raise NotImplementedError
+
+
+class LocalHistory(BaseHistory):
+    """In-process buffers of the most recently used conversations"""
+
+    def __init__(self, max_conversations=10000, **kwargs):
+        super().__init__(**kwargs)
+        self.max_conversations = max_conversations
+        # conversation key: (expires, version, entries or None, read watermarks)
+        self.conversations = OrderedDict()
+
+    def _buffer(self, conversation_key):
+        """Return the version, entries or None and read watermarks of a conversation"""
+        expires, version, entries, read_watermarks = self.conversations.get(
+            conversation_key, (None, 0, None, None)
+        )
+        if entries is not None and expires <= time.monotonic():
+            entries = read_watermarks = None
+            self._store(conversation_key, version, entries, read_watermarks)
+        elif conversation_key in self.conversations:
+            self.conversations.move_to_end(conversation_key)
+        return version, entries, read_watermarks
+
+    def _store(self, conversation_key, version, entries, read_watermarks):
+        expires = None if entries is None else time.monotonic() + self.ttl
+        self.conversations[conversation_key] = (expires, version, entries, read_watermarks)
+        self.conversations.move_to_end(conversation_key)
+        while len(self.conversations) > self.max_conversations:
+            self.conversations.popitem(last=False)
+
+    async def get(self, conversation_key, count):
+        version, entries, read_watermarks = self._buffer(conversation_key)
+        if entries is None or count > self.size:
+            return version, None
+        return version, self._result(
+            [entry if entry == END else dict(entry) for entry in entries], count, read_watermarks
+        )
+
+    async def fill(self, conversation_key, version, payloads):
+        current, entries, _ = self._buffer(conversation_key)
+        if entries is None and current == version:
+            self._store(conversation_key, version, self._entries([dict(payload) for payload in payloads]), {})
+
+    async def push(self, conversation_key, payload):
+        version, entries, read_watermarks = self._buffer(conversation_key)
+        if entries is not None:
+            entries = [dict(payload)] + entries[:self.size]
+        self._store(conversation_key, version + 1, entries, read_watermarks)
+
+    async def mark_read(self, conversation_key, username):
+        _, entries, read_watermarks = self._buffer(conversation_key)
+        if entries is not None:
+            read_watermarks[username] = time.time()
+
+
+class RedisHistory(BaseHistory):
+    """
+    Buffers in the channel layer Redis: one list of JSON payloads per
+    conversation, newest first, trimmed to size + 1 entries, a hash of read
+    watermarks and the version counter next to it, on the same node.
+    """
+
+    # KEYS[1] - list, KEYS[2] - version counter, ARGV - ttl, version, entries
+    FILL_SCRIPT = """
+        if redis.call('EXISTS', KEYS[1]) == 1 or (redis.call('GET', KEYS[2]) or '0') ~= ARGV[2] then
+            return 0
+        end
+        redis.call('RPUSH', KEYS[1], unpack(ARGV, 3))
+        redis.call('EXPIRE', KEYS[1], ARGV[1])
+        return 1
+    """
+
+    def _key(self, conversation_key):
+        return redis_key("history", conversation_key)
+
+    def _read_key(self, conversation_key):
+        return redis_key("history", conversation_key, "read")
+
+    def _version_key(self, conversation_key):
+        return redis_key("history", conversation_key, "version")
+
+    async def get(self, conversation_key, count):
+        key = self._key(conversation_key)
+        pipe = get_connection(key).pipeline()
+        pipe.get(self._version_key(conversation_key))
+        if count <= self.size:
+            pipe.lrange(key, 0, -1)
+            pipe.hgetall(self._read_key(conversation_key))
+        version, *buffer = await pipe.execute()
+        version = int(version or 0)
+        if not buffer:
+            return version, None
+        entries, read_watermarks = buffer
+        return version, self._result(
+            [END if entry.decode() == END else json.loads(entry) for entry in entries], count,
+            {username.decode(): float(read_at) for username, read_at in read_watermarks.items()},
+        )
+
+    async def fill(self, conversation_key, version, payloads):
+        key = self._key(conversation_key)
+        entries = [entry if entry == END else json.dumps(entry) for entry in self._entries(payloads)]
+        await get_connection(key).eval(
+            self.FILL_SCRIPT, 2, key, self._version_key(conversation_key), self.ttl, version, *entries
+        )
+
+    async def push(self, conversation_key, payload):
+        key = self._key(conversation_key)
+        version_key = self._version_key(conversation_key)
+        pipe = get_connection(key).pipeline()
+        pipe.incr(version_key)
+        pipe.expire(version_key, self.ttl)
+        pipe.lpushx(key, json.dumps(payload))
+        pipe.ltrim(key, 0, self.size)
+        pipe.expire(key, self.ttl)
+        pipe.expire(self._read_key(conversation_key), self.ttl)
+        await pipe.execute()
+
+    async def mark_read(self, conversation_key, username):
+        # Kept even if the conversation is not buffered, a concurrent fill may have read it unread
+        key = self._key(conversation_key)
+        read_key = self._read_key(conversation_key)
+        pipe = get_connection(key).pipeline()
+        pipe.hset(read_key, username, repr(time.time()))
+        pipe.expire(read_key, self.ttl)
+        await pipe.execute()
+
+
+def get_history():
+    return get_backend("CHAT_HISTORY", "chat.history.RedisHistory", "chat.history.LocalHistory")
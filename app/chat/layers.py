@@ -0,0 +1,193 @@
+"""
+Channel layers sending a batch of group messages at once.
+
+group_send_many(layer, messages) delivers (group, message) pairs, e.g.
+a chat message echo and its notifications. RedisChannelLayer reads the
+channels of every group of the batch with one pipeline and writes every
+message with one script call per Redis host, which is two round trips for
+the whole batch where group_send makes four per group. InMemoryChannelLayer
+is the stand-in for tests and development; other layers fall back to one
+group_send per message.
+
+Both layers return the number of channels every message was delivered
+to, which chat.metrics records as the fan-out of the message.
+
+Group messages of both layers are delivered with the group they were sent
+to under "to_group", so a socket subscribed to several groups with one
+channel (chat.consumers.MultiplexConsumer) can tell them apart.
+
+ShardedRedisChannelLayer spreads groups, channels and the realtime state
+of chat.backends over its hosts with a hash ring, so adding a host moves
+only the keys the new host takes over.
+"""
+import bisect
+import collections
+import hashlib
+import logging
+import time
+from channels.layers import InMemoryChannelLayer as BaseInMemoryChannelLayer
+from channels_redis.core import RedisChannelLayer as BaseRedisChannelLayer
+
+logger = logging.getLogger(__name__)
+
+
+async def group_send_many(layer, messages):
+    """
+    Send (group, message) pairs, in one batch if the layer supports it.
+    Return the number of channels of every group, or None if the layer
+    does not tell.
+    """
+    send_many = getattr(layer, "group_send_many", None)
+    if send_many is not None:
+        return await send_many(messages)
+    for group, message in messages:
+        await layer.group_send(group, message)
+
+
+class InMemoryChannelLayer(BaseInMemoryChannelLayer):
+    async def group_send(self, group, message):
+        await super().group_send(group, dict(message, to_group=group))
+
+    async def group_send_many(self, messages):
+        recipients = []
+        for group, message in messages:
+            await self.group_send(group, message)
+            recipients.append(len(self.groups.get(group, ())))
+        return recipients
+
+
+class RedisChannelLayer(BaseRedisChannelLayer):
+    # KEYS - channel keys, ARGV - messages, capacities, now, expiry.
+    # Messages of one batch get increasing scores, so a channel receiving
+    # several of them gets them in batch order.
+    GROUP_SEND_MANY_SCRIPT = """
+        local now, expiry = tonumber(ARGV[#ARGV - 1]), tonumber(ARGV[#ARGV])
+        local over_capacity = 0
+        for i = 1, #KEYS do
+            redis.call('ZREMRANGEBYSCORE', KEYS[i], 0, now - expiry)
+            if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[#KEYS + i]) then
+                redis.call('ZADD', KEYS[i], now + i / 1000000, ARGV[i])
+                redis.call('EXPIRE', KEYS[i], expiry)
+            else
+                over_capacity = over_capacity + 1
+            end
+        end
+        return over_capacity
+    """
+
+    async def group_send(self, group, message):
+        await super().group_send(group, dict(message, to_group=group))
+
+    async def get_group_channels(self, groups):
+        """Return channel names of every group, one pipeline per Redis host"""
+        hosts = collections.defaultdict(list)
+        for index, group in enumerate(groups):
+            assert self.valid_group_name(group), "Group name not valid"
+            hosts[self.consistent_hash(group)].append(index)
+        channels = [None] * len(groups)
+        oldest = int(time.time()) - self.group_expiry
+        for host, indexes in hosts.items():
+            pipe = self.connection(host).pipeline(transaction=False)
+            for index in indexes:
+                key = self._group_key(groups[index])
+                pipe.zremrangebyscore(key, min=0, max=oldest)
+                pipe.zrange(key, 0, -1)
+            results = await pipe.execute()
+            for index, members in zip(indexes, results[1::2]):
+                channels[index] = [member.decode("utf8") for member in members]
+        return channels
+
+    async def group_send_many(self, messages):
+        messages = list(messages)
+        group_channels = await self.get_group_channels([group for group, message in messages])
+        keys = collections.defaultdict(list)
+        payloads = collections.defaultdict(list)
+        capacities = collections.defaultdict(list)
+        for (group, message), channel_names in zip(messages, group_channels):
+            host_keys, key_payloads, key_capacities = self._map_channel_keys_to_connection(
+                channel_names, dict(message, to_group=group)
+            )
+            for host, channel_keys in host_keys.items():
+                for key in channel_keys:
+                    keys[host].append(key)
+                    payloads[host].append(key_payloads[key])
+                    capacities[host].append(key_capacities[key])
+        for host, host_keys in keys.items():
+            over_capacity = await self.connection(host).eval(
+                self.GROUP_SEND_MANY_SCRIPT, len(host_keys), *host_keys,
+                *payloads[host], *capacities[host], time.time(), self.expiry,
+            )
+            if over_capacity > 0:
+                logger.info(
+                    "%s of %s channels over capacity in a batch of %s groups",
+                    over_capacity, len(host_keys), len(messages),
+                )
+        return [len(channel_names) for channel_names in group_channels]
+
+
+class HashRing:
+    """
+    Consistent hashing of keys to node indexes. Every node gets replicas
+    points on the ring placed by its name, a key belongs to the node of
+    the first point at or after the key's hash. Adding a node to n others
+    moves about 1/(n + 1) of the keys, all of them to the new node.
+    """
+
+    def __init__(self, names, replicas=100):
+        points = sorted(
+            (self.hash(f"{name}#{replica}"), index)
+            for index, name in enumerate(names)
+            for replica in range(replicas)
+        )
+        self.points = [point for point, index in points]
+        self.indexes = [index for point, index in points]
+
+    @staticmethod
+    def hash(value):
+        if isinstance(value, str):
+            value = value.encode("utf8")
+        return int.from_bytes(hashlib.md5(value).digest()[:8], "big")
+
+    def get(self, key):
+        position = bisect.bisect_left(self.points, self.hash(key))
+        return self.indexes[position % len(self.points)]
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    RedisChannelLayer placing keys on its hosts with a HashRing instead of
+    channels_redis' hash of the key modulo the number of hosts.
+
+    Hosts are named by their address or "host:port", optionally with a
+    "name" key in a host dict, so the ring does not depend on the order
+    of the hosts. Process-local channels ("specific.<client>!<channel>")
+    are placed by their "specific.<client>!" part, which is the key the
+    receiving process reads them from.
+    """
+
+    def __init__(self, hosts=None, replicas=100, **kwargs):
+        hosts = [dict(host) if isinstance(host, dict) else host for host in hosts or ()]
+        names = [
+            host.pop("name", None) if isinstance(host, dict) else None for host in hosts
+        ]
+        super().__init__(hosts=hosts, **kwargs)
+        self.ring = HashRing(
+            [name or self.host_name(host) for name, host in zip(names, self.hosts)], replicas
+        )
+
+    @staticmethod
+    def host_name(host):
+        if "address" in host:
+            return host["address"]
+        if "master_name" in host:
+            return host["master_name"]
+        return f"{host.get('host', 'localhost')}:{host.get('port', 6379)}"
+
+    def consistent_hash(self, value):
+        if self.ring_size == 1:
+            return 0
+        if isinstance(value, bytes):
+            value = value.decode("utf8")
+        if "!" in value:
+            value = self.non_local_name(value)
+        return self.ring.get(value)
@@ -0,0 +1,16 @@
+from importlib import import_module
+from django.core.management.base import BaseCommand
+from chat.benchmarks import SUITES
+
+
+class Command(BaseCommand):
+    help = "Run a chat benchmark suite"
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest="suite", required=True)
+        for name in SUITES:
+            import_module(f"chat.benchmarks.{name}").add_arguments(subparsers.add_parser(name))
+
+    def handle(self, *args, **options):
+        suite = import_module(f"chat.benchmarks.{options['suite']}")
+        suite.run(options, self.stdout)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from chat import dataset
+
+
+class Command(BaseCommand):
+    help = "Generate synthetic users, conversations and messages for scale testing"
+
+    def add_arguments(self, parser):
+        dataset.add_arguments(parser)
+
+    def handle(self, *args, **options):
+        dataset.DatasetGenerator(options).generate(self.stdout)
+        self.stdout.write(self.style.SUCCESS("Generated the dataset"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from chat import counters
+
+
+class Command(BaseCommand):
+    help = "Rebuild unread message counters from scratch"
+
+    def handle(self, *args, **options):
+        counter_count, user_count = counters.rebuild()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Rebuilt {counter_count} unread counters for {user_count} users"
+            )
+        )
@@ -0,0 +1,109 @@
+"""
+Cached member lists of group conversations.
+
+Group sockets send the member list on connect, so they read the list from
+here instead of querying the members every time. A list is filled from
+the database on the first miss and invalidated by add_member /
+remove_member once their transaction has committed.
+
+Lists are versioned: get() returns the group's current version along with
+the list, set() stores a list under the version it was read with, and
+invalidate() bumps the version. A list filled from a query that raced a
+membership change is stored under the old version and never served.
+Entries expire after `ttl` seconds.
+
+Configure with settings.CHAT_MEMBERSHIP, see chat.backends.
+"""
+import json
+import time
+from collections import OrderedDict
+from chat.backends import get_backend, get_connection, redis_key
+
+DEFAULT_TTL = 60 * 60
+
+
+class BaseMembership:
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+
+    async def get(self, group_key):
+        """Return the group's version and its cached member payloads or None"""
+        raise NotImplementedError
+
+    async def set(self, group_key, version, members):
+        """Cache members read from the database after get() returned version"""
+        raise NotImplementedError
+
+    async def invalidate(self, group_key):
+        raise NotImplementedError
+
+
+class LocalMembership(BaseMembership):
+    """In-process lists of the most recently used groups"""
+
+    def __init__(self, max_groups=10000, **kwargs):
+        super().__init__(**kwargs)
+        self.max_groups = max_groups
+        # group key: (expires, version, members or None)
+        self.groups = OrderedDict()
+
+    def _store(self, group_key, entry):
+        self.groups[group_key] = entry
+        self.groups.move_to_end(group_key)
+        while len(self.groups) > self.max_groups:
+            self.groups.popitem(last=False)
+
+    async def get(self, group_key):
+        expires, version, members = self.groups.get(group_key, (None, 0, None))
+        if members is None:
+            return version, None
+        if expires <= time.monotonic():
+            self._store(group_key, (None, version, None))
+            return version, None
+        self.groups.move_to_end(group_key)
+        return version, list(members)
+
+    async def set(self, group_key, version, members):
+        if self.groups.get(group_key, (None, 0, None))[1] == version:
+            self._store(group_key, (time.monotonic() + self.ttl, version, list(members)))
+
+    async def invalidate(self, group_key):
+        self._store(group_key, (None, self.groups.get(group_key, (None, 0, None))[1] + 1, None))
+
+
+class RedisMembership(BaseMembership):
+    """
+    Lists in the channel layer Redis: the version counter of a group and a
+    JSON string per version, on the host of the counter.
+    """
+
+    # KEYS[1] - version counter, the list of a version is KEYS[1]:<version>
+    GET_SCRIPT = """
+        local version = redis.call('GET', KEYS[1]) or '0'
+        return {version, redis.call('GET', KEYS[1] .. ':' .. version)}
+    """
+
+    def _key(self, group_key):
+        return redis_key("members", group_key)
+
+    async def get(self, group_key):
+        key = self._key(group_key)
+        version, members = await get_connection(key).eval(self.GET_SCRIPT, 1, key)
+        return int(version), None if members is None else json.loads(members)
+
+    async def set(self, group_key, version, members):
+        key = self._key(group_key)
+        await get_connection(key).set(f"{key}:{version}", json.dumps(members), ex=self.ttl)
+
+    async def invalidate(self, group_key):
+        key = self._key(group_key)
+        pipe = get_connection(key).pipeline()
+        pipe.incr(key)
+        pipe.expire(key, self.ttl)
+        await pipe.execute()
+
+
+def get_membership():
+    return get_backend(
+        "CHAT_MEMBERSHIP", "chat.membership.RedisMembership", "chat.membership.LocalMembership"
+    )
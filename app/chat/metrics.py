@@ -0,0 +1,329 @@
+"""
+Process-local metrics in the Prometheus text exposition format.
+
+Consumers get socket, event and channel layer metrics from
+ConsumerMetricsMixin / AsyncConsumerMetricsMixin, REST views from
+MetricsMiddleware, and everything is served by metrics_view on /metrics.
+Queries are attributed to the event or request running them through a
+context variable, which follows database_sync_to_async into its thread.
+Every worker process exposes its own values.
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse
+from chat.layers import group_send_many
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def format_labels(self, labels, extra=()):
+        pairs = list(zip(self.labelnames, labels)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (
+            (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+            for name, value in pairs
+        )
+        return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+    def samples(self):
+        raise NotImplementedError
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            lines.extend(f"{name}{labels} {value}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, by=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + by
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name, self.format_labels(labels), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, by=1):
+        self.inc(*labels, by=-by)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts, total = self.values.get(labels, ([0] * (len(self.buckets) + 1), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self.values[labels] = (counts, total + value)
+
+    def samples(self):
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", self.format_labels(labels, [("le", bound)]), cumulative
+            yield f"{self.name}_sum", self.format_labels(labels), total
+            yield f"{self.name}_count", self.format_labels(labels), cumulative
+
+
+class Collected(Metric):
+    """Metric of state kept elsewhere, read from collect() when exposed"""
+
+    def __init__(self, name, documentation, kind, collect, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in sorted(self.collect().items()):
+            yield self.name, self.format_labels(labels), value
+
+
+def _token_cache_lookups():
+    from chat.middleware import get_token_cache
+    stats = get_token_cache().stats()
+    return {("hit",): stats["hits"], ("miss",): stats["misses"]}
+
+
+def _token_cache_size():
+    from chat.middleware import get_token_cache
+    return {(): get_token_cache().stats()["size"]}
+
+
+REGISTRY = []
+
+sockets_active = Gauge("chat_sockets_active", "Open websockets", ["consumer"])
+connects = Counter("chat_connects_total", "Accepted websocket connections", ["consumer"])
+disconnects = Counter("chat_disconnects_total", "Closed websocket connections", ["consumer"])
+event_seconds = Histogram(
+    "chat_event_seconds", "Time to handle an incoming frame", ["consumer", "type"]
+)
+event_queries = Counter(
+    "chat_event_queries_total", "Database queries run by incoming frame handlers", ["consumer", "type"]
+)
+event_query_seconds = Counter(
+    "chat_event_query_seconds_total", "Database time of incoming frame handlers", ["consumer", "type"]
+)
+group_send_seconds = Histogram("chat_group_send_seconds", "Channel layer group_send latency", ["type"])
+fanout_size = Histogram(
+    "chat_fanout_size", "Channels a group_send_many message is delivered to", ["type"], buckets=SIZE_BUCKETS
+)
+rate_limited = Counter("chat_rate_limited_total", "Frames dropped by rate limits", ["type"])
+request_seconds = Histogram("chat_http_request_seconds", "REST request latency", ["view", "method"])
+request_queries = Counter("chat_http_queries_total", "Database queries of REST requests", ["view", "method"])
+request_query_seconds = Counter(
+    "chat_http_query_seconds_total", "Database time of REST requests", ["view", "method"]
+)
+token_cache_lookups = Collected(
+    "chat_token_cache_lookups_total", "Websocket token cache lookups", "counter", _token_cache_lookups, ["result"]
+)
+token_cache_size = Collected("chat_token_cache_size", "Users in the websocket token cache", "gauge", _token_cache_size)
+
+_query_stats = contextvars.ContextVar("chat_query_stats", default=None)
+
+
+def count_queries(execute, sql, params, many, context):
+    stats = _query_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats[0] += 1
+        stats[1] += time.perf_counter() - started
+
+
+@receiver(connection_created)
+def install_query_counter(connection, **kwargs):
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+
+@contextmanager
+def measure(histogram, queries, query_seconds, *labels):
+    """Time the block and attribute the queries it runs to labels"""
+    stats = [0, 0.0]
+    token = _query_stats.set(stats)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started, *labels)
+        _query_stats.reset(token)
+        queries.inc(*labels, by=stats[0])
+        query_seconds.inc(*labels, by=stats[1])
+
+
+class MeasuredChannelLayer:
+    """Channel layer proxy timing group_send and group_send_many"""
+
+    def __init__(self, layer):
+        self.layer = layer
+
+    def __getattr__(self, name):
+        return getattr(self.layer, name)
+
+    async def group_send(self, group, message):
+        started = time.perf_counter()
+        try:
+            return await self.layer.group_send(group, message)
+        finally:
+            group_send_seconds.observe(time.perf_counter() - started, message.get("type", ""))
+
+    async def group_send_many(self, messages):
+        """Send (group, message) pairs in one batch, see chat.layers"""
+        messages = list(messages)
+        # Batches are labelled by their message types, e.g. "chat_message_echo+new_message_notification"
+        label = "+".join(dict.fromkeys(message.get("type", "") for group, message in messages))
+        started = time.perf_counter()
+        try:
+            recipients = await group_send_many(self.layer, messages)
+        finally:
+            group_send_seconds.observe(time.perf_counter() - started, label)
+        for (group, message), count in zip(messages, recipients or ()):
+            fanout_size.observe(count, message.get("type", ""))
+        return recipients
+
+
+_measured_layers = {}
+
+
+class BaseConsumerMetricsMixin:
+    metrics_accepted = False
+    # Frame types measured separately, others are measured as "other"
+    metrics_event_types = ()
+
+    @property
+    def channel_layer(self):
+        return self.__dict__.get("channel_layer")
+
+    @channel_layer.setter
+    def channel_layer(self, layer):
+        if layer is not None and not isinstance(layer, MeasuredChannelLayer):
+            if layer not in _measured_layers:
+                _measured_layers[layer] = MeasuredChannelLayer(layer)
+            layer = _measured_layers[layer]
+        self.__dict__["channel_layer"] = layer
+
+    @property
+    def metrics_name(self):
+        return type(self).__name__
+
+    def metrics_connected(self):
+        self.metrics_accepted = True
+        sockets_active.inc(self.metrics_name)
+        connects.inc(self.metrics_name)
+
+    def metrics_disconnected(self):
+        if self.metrics_accepted:
+            self.metrics_accepted = False
+            sockets_active.dec(self.metrics_name)
+            disconnects.inc(self.metrics_name)
+
+    def measure_event(self, content):
+        event_type = content.get("type") if isinstance(content, dict) else None
+        if event_type not in self.metrics_event_types:
+            event_type = "other"
+        return measure(event_seconds, event_queries, event_query_seconds, self.metrics_name, event_type)
+
+
+class ConsumerMetricsMixin(BaseConsumerMetricsMixin):
+    """Metrics of a JsonWebsocketConsumer, list it before the consumer base class"""
+
+    def accept(self, *args, **kwargs):
+        super().accept(*args, **kwargs)
+        self.metrics_connected()
+
+    def websocket_disconnect(self, message):
+        self.metrics_disconnected()
+        super().websocket_disconnect(message)
+
+    def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if text_data is None:
+            return super().receive(text_data, bytes_data, **kwargs)
+        content = self.decode_json(text_data)
+        with self.measure_event(content):
+            self.receive_json(content, **kwargs)
+
+
+class AsyncConsumerMetricsMixin(BaseConsumerMetricsMixin):
+    """Metrics of an AsyncJsonWebsocketConsumer, list it before the consumer base class"""
+
+    async def accept(self, *args, **kwargs):
+        await super().accept(*args, **kwargs)
+        self.metrics_connected()
+
+    async def websocket_disconnect(self, message):
+        self.metrics_disconnected()
+        await super().websocket_disconnect(message)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if text_data is None:
+            return await super().receive(text_data, bytes_data, **kwargs)
+        content = await self.decode_json(text_data)
+        with self.measure_event(content):
+            await self.receive_json(content, **kwargs)
+
+
+class MetricsMiddleware:
+    """Latency and queries of HTTP requests per resolved view"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = [0, 0.0]
+        token = _query_stats.set(stats)
+        started = time.perf_counter()
+        try:
+            return self.get_response(request)
+        finally:
+            _query_stats.reset(token)
+            match = getattr(request, "resolver_match", None)
+            if match is not None and match.view_name != "metrics":
+                labels = (match.view_name, request.method)
+                request_seconds.observe(time.perf_counter() - started, *labels)
+                request_queries.inc(*labels, by=stats[0])
+                request_query_seconds.inc(*labels, by=stats[1])
+
+
+def expose():
+    return "\n".join(metric.expose() for metric in REGISTRY) + "\n"
+
+
+def metrics_view(request):
+    return HttpResponse(expose(), content_type="text/plain; version=0.0.4; charset=utf-8")
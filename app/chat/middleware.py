@@ -1,9 +1,20 @@
-from typing import Any
+from collections import OrderedDict
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.authtoken.models import Token
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
 from urllib.parse import parse_qs
 from channels.db import database_sync_to_async
+from chat.backends import get_backend
+import threading
+import time
 
 User = get_user_model()
 
@@ -43,14 +54,103 @@ class TokenAuthentication:
         
         return token.user
     
+class TokenCache:
+    """
+    Bounded LRU of token key -> user with entries expiring after ttl seconds.
+    
+    Entries are dropped when their token is deleted or their user is
+    saved (e.g. deactivated) in this process; ttl bounds how long changes
+    made by other processes go unnoticed.
+    """
+    
+    def __init__(self, ttl=60, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def set(self, key, user):
+        with self.lock:
+            self.entries[key] = (user, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+    
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+    
+    def invalidate_user(self, user_id):
+        with self.lock:
+            for key in [key for key, (user, _) in self.entries.items() if user.id == user_id]:
+                del self.entries[key]
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+    
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+def get_token_cache():
+    return get_backend("CHAT_TOKEN_CACHE", "chat.middleware.TokenCache", "chat.middleware.TokenCache")
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_token(instance, **kwargs):
+    get_token_cache().invalidate(instance.key)
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_tokens(instance, **kwargs):
+    get_token_cache().invalidate_user(instance.id)
+
+
+def is_jwt(token):
+    return token.count(".") == 2
+
+
+def get_jwt_user(token):
+    """
+    Return the user of a valid access token, built from its claims without
+    touching the database (see chat.serializers.TokenObtainPairSerializer),
+    or None when the token carries no username claim.
+    """
+    try:
+        validated_token = AccessToken(token)
+    except TokenError:
+        raise AuthenticationFailed(_("Invalid token."))
+    if "username" not in validated_token:
+        return None
+    user = User(
+        username=validated_token["username"],
+        first_name=validated_token.get("first_name", ""),
+    )
+    setattr(user, jwt_settings.USER_ID_FIELD, validated_token[jwt_settings.USER_ID_CLAIM])
+    user._state.adding = False
+    return user
+
+
 @database_sync_to_async
 def get_user(scope):
     """
     Return the user model instance associated with the given scope.
     If no user is retrieved, return an instance of `AnonymousUser`.
     """
-    from django.contrib.auth.models import AnonymousUser
-    
     if "token" not in scope:
         raise ValueError(
             "Cannot find token in scope. You should wrap your consumer in "
@@ -59,15 +159,21 @@ def get_user(scope):
     token = scope['token']
     user = None
     try:
-        auth = TokenAuthentication()
-        user = auth.authenticate_credentials(token)
-    except AuthenticationFailed:
+        if is_jwt(token):
+            user = JWTAuthentication().get_user(AccessToken(token))
+        else:
+            auth = TokenAuthentication()
+            user = auth.authenticate_credentials(token)
+    except (AuthenticationFailed, TokenError):
         pass
     return user or AnonymousUser()
 
 class TokenAuthMiddleware:
     """
     Custom middleware that takes a token from the query string and authenticates via Django Rest Framework authtoken.
+    
+    Users of authtoken keys are cached (see TokenCache), so reconnecting sockets
+    skip the database. Simplejwt access tokens are verified without it.
     """
     def __init__(self, app) -> None:
         # Store the ASGI application we were passed
@@ -80,5 +186,22 @@ class TokenAuthMiddleware:
         query_params = parse_qs(scope["query_string"].decode())
         token = query_params["token"][0]
         scope["token"] = token
-        scope["user"] = await get_user(scope)
-        return await self.app(scope, receive, send)
\ No newline at end of file
+        scope["user"] = await self.authenticate(scope)
+        return await self.app(scope, receive, send)
+    
+    async def authenticate(self, scope):
+        token = scope["token"]
+        if is_jwt(token):
+            try:
+                user = get_jwt_user(token)
+            except AuthenticationFailed:
+                return AnonymousUser()
+            return user if user is not None else await get_user(scope)
+        
+        cache = get_token_cache()
+        user = cache.get(token)
+        if user is None:
+            user = await get_user(scope)
+            if user.is_authenticated:
+                cache.set(token, user)
+        return user
\ No newline at end of file
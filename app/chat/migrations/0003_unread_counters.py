@@ -0,0 +1,104 @@
+# Generated by Django 4.2.2 on 2026-10-18 06:19
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Exists, OuterRef, Subquery
+import django.db.models.deletion
+
+
+def backfill_unread_counters(apps, schema_editor):
+    """Count unread messages like chat.counters.rebuild(), with the read state of this schema"""
+    Message = apps.get_model('chat', 'Message')
+    GroupConversation = apps.get_model('chat', 'GroupConversation')
+    GroupMessage = apps.get_model('chat', 'GroupMessage')
+    UnreadCounter = apps.get_model('chat', 'UnreadCounter')
+    UnreadTotal = apps.get_model('chat', 'UnreadTotal')
+    Member = GroupConversation.members.through
+    Read = GroupMessage.read.through
+    counters = {}
+    private_unread = (
+        Message.objects.filter(read=False)
+                       .values('to_user', 'conversation')
+                       .annotate(unread=Count('id'))
+                       .order_by()
+    )
+    for row in private_unread:
+        counters[(row['to_user'], row['conversation'], None)] = row['unread']
+
+    # Unread group messages of a member are the messages of others the member is not in read of
+    group_unread = (
+        GroupMessage.objects.filter(group_conversation=OuterRef('groupconversation'))
+                            .exclude(from_user=OuterRef('user'))
+                            .filter(~Exists(Read.objects.filter(groupmessage=OuterRef('id'), user=OuterRef(OuterRef('user')))))
+                            .order_by()
+                            .values('group_conversation')
+                            .annotate(unread=Count('id'))
+                            .values('unread')
+    )
+    members = (
+        Member.objects.annotate(unread=Subquery(group_unread))
+                      .filter(unread__gt=0)
+                      .values_list('user', 'groupconversation', 'unread')
+    )
+    for user_id, group_id, unread in members.iterator():
+        counters[(user_id, None, group_id)] = unread
+
+    totals = {}
+    for (user_id, conversation_id, group_id), unread in counters.items():
+        total = totals.setdefault(user_id, UnreadTotal(user_id=user_id))
+        if group_id is None:
+            total.unread_count += unread
+        else:
+            total.unread_group_count += unread
+    UnreadCounter.objects.bulk_create(
+        [
+            UnreadCounter(
+                user_id=user_id,
+                conversation_id=conversation_id,
+                group_conversation_id=group_id,
+                count=unread,
+            )
+            for (user_id, conversation_id, group_id), unread in counters.items()
+        ],
+        batch_size=1000,
+    )
+    UnreadTotal.objects.bulk_create(totals.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0002_groupconversation_groupmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadTotal',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='unread_total', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('unread_group_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UnreadCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('conversation', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='unread_counters', to='chat.conversation')),
+                ('group_conversation', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='unread_counters', to='chat.groupconversation')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='unread_counters', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='unreadcounter',
+            constraint=models.UniqueConstraint(fields=('user', 'conversation'), name='unique_unread_counter_conversation'),
+        ),
+        migrations.AddConstraint(
+            model_name='unreadcounter',
+            constraint=models.UniqueConstraint(fields=('user', 'group_conversation'), name='unique_unread_counter_group_conversation'),
+        ),
+        migrations.RunPython(backfill_unread_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.2 on 2026-10-18 06:21
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    """
+    Turn the auto-created GroupConversation.members table into the
+    GroupMembership model and add read watermark columns to it.
+    """
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0003_unread_counters'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='GroupMembership',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('group_conversation', models.ForeignKey(db_column='groupconversation_id', on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='chat.groupconversation')),
+                        ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='group_memberships', to=settings.AUTH_USER_MODEL)),
+                    ],
+                    options={
+                        'db_table': 'chat_groupconversation_members',
+                        'unique_together': {('group_conversation', 'user')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='groupconversation',
+                    name='members',
+                    field=models.ManyToManyField(blank=True, related_name='group_members', through='chat.GroupMembership', to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='groupmembership',
+            name='last_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='groupmembership',
+            name='last_read_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.groupmessage'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 4.2.2 on 2026-10-18 06:21
+
+from django.db import migrations
+from django.db.models import OuterRef, Q, Subquery
+
+
+def compact_read_to_watermarks(apps, schema_editor):
+    """Set each member's watermark to the latest message the member read or sent"""
+    GroupMembership = apps.get_model('chat', 'GroupMembership')
+    GroupMessage = apps.get_model('chat', 'GroupMessage')
+    last_read = (
+        GroupMessage.objects.filter(group_conversation=OuterRef('group_conversation'))
+                            .filter(Q(read=OuterRef('user')) | Q(from_user=OuterRef('user')))
+                            .order_by('-timestamp')
+    )
+    memberships = GroupMembership.objects.annotate(
+        read_message_id=Subquery(last_read.values('id')[:1]),
+        read_at=Subquery(last_read.values('timestamp')[:1]),
+    )
+    batch = []
+    for membership in memberships.iterator(chunk_size=1000):
+        membership.last_read_message_id = membership.read_message_id
+        membership.last_read_at = membership.read_at
+        batch.append(membership)
+        if len(batch) == 1000:
+            GroupMembership.objects.bulk_update(batch, ['last_read_message', 'last_read_at'])
+            batch = []
+    GroupMembership.objects.bulk_update(batch, ['last_read_message', 'last_read_at'])
+
+
+def expand_watermarks_to_read(apps, schema_editor):
+    GroupMembership = apps.get_model('chat', 'GroupMembership')
+    GroupMessage = apps.get_model('chat', 'GroupMessage')
+    Read = GroupMessage.read.through
+    for membership in GroupMembership.objects.exclude(last_read_at=None).iterator():
+        message_ids = (
+            GroupMessage.objects.filter(
+                group_conversation=membership.group_conversation_id,
+                timestamp__lte=membership.last_read_at,
+            )
+            .exclude(from_user=membership.user_id)
+            .values_list('id', flat=True)
+        )
+        Read.objects.bulk_create(
+            [Read(groupmessage_id=message_id, user_id=membership.user_id) for message_id in message_ids],
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_groupmembership'),
+    ]
+
+    operations = [
+        migrations.RunPython(compact_read_to_watermarks, expand_watermarks_to_read),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.2 on 2026-10-18 06:21
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_compact_group_message_read'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='groupmessage',
+            name='read',
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.2 on 2026-10-18 06:23
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_remove_groupmessage_read'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='conversation',
+            name='online',
+        ),
+        migrations.RemoveField(
+            model_name='groupconversation',
+            name='online',
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.2.2 on 2026-10-18 06:33
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_participants(apps, schema_editor):
+    """Resolve participants and pair keys from user1__user2 conversation names"""
+    Conversation = apps.get_model('chat', 'Conversation')
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    Participant = Conversation.participants.through
+    pair_keys = set()
+    for conversation in Conversation.objects.iterator(chunk_size=1000):
+        usernames = conversation.name.split('__')
+        user_ids = sorted(User.objects.filter(username__in=usernames).values_list('id', flat=True))
+        Participant.objects.bulk_create(
+            [Participant(conversation_id=conversation.id, user_id=user_id) for user_id in user_ids],
+            ignore_conflicts=True,
+        )
+        if len(user_ids) == 2:
+            pair_key = "{}:{}".format(*user_ids)
+            if pair_key not in pair_keys: # Duplicated conversations of a pair keep no key
+                pair_keys.add(pair_key)
+                conversation.pair_key = pair_key
+                conversation.save(update_fields=['pair_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0008_message_timestamp_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='pair_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='participants',
+            field=models.ManyToManyField(blank=True, related_name='private_conversations', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(backfill_participants, migrations.RunPython.noop),
+    ]
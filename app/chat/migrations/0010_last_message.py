@@ -0,0 +1,50 @@
+# Generated by Django 4.2.2 on 2026-10-18 06:34
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def backfill_last_message(apps, schema_editor):
+    for conversation_model, message_model, field in (
+        ('Conversation', 'Message', 'conversation'),
+        ('GroupConversation', 'GroupMessage', 'group_conversation'),
+    ):
+        Conversation = apps.get_model('chat', conversation_model)
+        Message = apps.get_model('chat', message_model)
+        last_message = Message.objects.filter(**{field: OuterRef('id')}).order_by('-timestamp', '-id')
+        Conversation.objects.update(
+            last_message=Subquery(last_message.values('id')[:1]),
+            last_message_at=Subquery(last_message.values('timestamp')[:1]),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_conversation_participants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='groupconversation',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.groupmessage'),
+        ),
+        migrations.AddField(
+            model_name='groupconversation',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(backfill_last_message, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.2 on 2026-10-18 07:04
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_members_count(apps, schema_editor):
+    GroupConversation = apps.get_model('chat', 'GroupConversation')
+    GroupMembership = apps.get_model('chat', 'GroupMembership')
+    members_count = (
+        GroupMembership.objects.filter(group_conversation=OuterRef('id'))
+                               .values('group_conversation')
+                               .annotate(count=Count('id'))
+                               .values('count')
+    )
+    GroupConversation.objects.update(members_count=Coalesce(Subquery(members_count[:1]), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_message_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='groupconversation',
+            name='members_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='groupconversation',
+            name='online_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_members_count, migrations.RunPython.noop),
+    ]
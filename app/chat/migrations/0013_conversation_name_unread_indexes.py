@@ -0,0 +1,27 @@
+# Generated by Django 4.2.2 on 2026-10-18 07:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_group_member_counts'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='conversation',
+            name='name',
+            field=models.CharField(db_index=True, max_length=128),
+        ),
+        migrations.AlterField(
+            model_name='groupconversation',
+            name='name',
+            field=models.CharField(db_index=True, max_length=128),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('read', False)), fields=['to_user', 'conversation'], name='message_unread_idx'),
+        ),
+    ]
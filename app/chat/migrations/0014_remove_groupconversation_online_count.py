@@ -0,0 +1,17 @@
+# Generated by Django 4.2.2 on 2026-10-18 07:54
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_conversation_name_unread_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='groupconversation',
+            name='online_count',
+        ),
+    ]
@@ -1,39 +1,73 @@
 from typing import Any
 from django.db import models
 from django.contrib.auth import get_user_model
+from django.utils import timezone
+from asgiref.sync import async_to_sync
+from chat.presence import get_presence
 import uuid
 
 User = get_user_model()
 
 class AbstractConversation(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    name = models.CharField(max_length=128)
-    online = models.ManyToManyField(to=User, blank=True)
+    name = models.CharField(max_length=128, db_index=True)
+    
+    @property
+    def presence_key(self):
+        """Key of the conversation's online set, see chat.presence"""
+        return str(self.id)
+    
+    @property
+    def history_key(self):
+        """Key of the conversation's recent messages buffer, see chat.history"""
+        return str(self.id)
     
     def get_online_count(self):
-        return self.online.count()
+        return async_to_sync(get_presence().count)(self.presence_key)
     
-    def join(self, user):
-        self.online.add(user)
-        self.save()
-        
-    def leave(self, user):
-        self.online.remove(user)
-        self.save()
+    def set_last_message(self, message):
+        """Point last_message at message unless a newer one is already there"""
+        type(self).objects.filter(id=self.id).filter(
+            models.Q(last_message_at__isnull=True) | models.Q(last_message_at__lte=message.timestamp)
+        ).update(last_message=message, last_message_at=message.timestamp)
+        self.last_message, self.last_message_at = message, message.timestamp
         
     def __str__(self) -> str:
-        return f"{self.name} ({self.get_online_count()})"
+        return self.name
     
     class Meta:
         abstract = True
 
 class Conversation(AbstractConversation):
+    participants = models.ManyToManyField(
+        to=User, blank=True, related_name="private_conversations"
+    )
+    pair_key = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
+    last_message = models.ForeignKey(
+        to="Message", null=True, blank=True, on_delete=models.SET_NULL, related_name="+"
+    )
+    last_message_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    
     def __init__(self, *args: Any, **kwargs: Any) -> None:
         super().__init__(*args, **kwargs)
         self.user = None
         self.conversation_name = None
         self.conversation = None
     
+    @staticmethod
+    def make_pair_key(first_user_id, second_user_id):
+        """Canonical key of a user pair, the same for both orders"""
+        return "{}:{}".format(*sorted((first_user_id, second_user_id)))
+    
+    @staticmethod
+    def get_participant_usernames(name):
+        return name.split("__")
+    
+    def get_other_participant(self, user):
+        for participant in self.participants.all():
+            if participant.id != user.id:
+                return participant
+    
 class Message(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     conversation = models.ForeignKey(
@@ -46,31 +80,90 @@ class Message(models.Model):
         User, on_delete=models.CASCADE, related_name="messages_to_me"
     )
     content = models.CharField(max_length=512)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     read = models.BooleanField(default=False)
     
     def __str__(self) -> str:
         return f"From {self.from_user.username} to {self.to_user.username}: {self.content} [{self.timestamp}]"
     
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["conversation", "timestamp", "id"], name="message_conversation_time_idx"
+            ),
+            # Unread messages of a receiver, partial where the database supports it
+            models.Index(
+                fields=["to_user", "conversation"], condition=models.Q(read=False),
+                name="message_unread_idx",
+            ),
+        ]
+    
 class GroupConversation(AbstractConversation):
-    members = models.ManyToManyField(to=User, blank=True, related_name="group_members")
+    members = models.ManyToManyField(
+        to=User, blank=True, related_name="group_members", through="GroupMembership"
+    )
     admin = models.ForeignKey(
         to=User, on_delete=models.CASCADE, related_name="group_chat_admin"
     )
+    last_message = models.ForeignKey(
+        to="GroupMessage", null=True, blank=True, on_delete=models.SET_NULL, related_name="+"
+    )
+    last_message_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # Denormalized, kept by join_group / leave_group
+    members_count = models.PositiveIntegerField(default=0)
+    
+    @staticmethod
+    def make_notification_group(conversation_id):
+        """Channel layer group of the members' notification sockets"""
+        return f"{conversation_id}__group_notifications"
+    
+    @property
+    def notification_group(self):
+        return self.make_notification_group(self.id)
+    
+    @property
+    def membership_key(self):
+        """Key of the group's cached member list, see chat.membership"""
+        return str(self.id)
     
     def get_members_count(self):
-        return self.members.count()
+        return self.members_count
+    
+    def _add_members_count(self, delta):
+        GroupConversation.objects.filter(id=self.id).update(members_count=models.F("members_count") + delta)
+        self.members_count += delta
     
     def join_group(self, user):
-        self.members.add(user)
-        self.save()
+        """Add user to the group, return False if user is a member already"""
+        membership, created = GroupMembership.objects.get_or_create(
+            group_conversation=self, user=user, defaults={"last_read_at": timezone.now()}
+        )
+        if created:
+            self._add_members_count(1)
+        return created
         
     def leave_group(self, user):
-        self.members.remove(user)
-        self.save()
+        """Remove user from the group, return False if user is not a member"""
+        deleted, _ = self.memberships.filter(user=user).delete()
+        if deleted:
+            self._add_members_count(-1)
+        return bool(deleted)
+    
+    def get_read_watermarks(self):
+        """
+        Return (user id, last read timestamp) of every member ordered by user id.
+        Uses prefetched memberships when there are some.
+        """
+        if "memberships" in getattr(self, "_prefetched_objects_cache", {}):
+            return sorted(
+                (membership.user_id, membership.last_read_at) for membership in self.memberships.all()
+            )
+        return list(
+            self.memberships.order_by("user_id").values_list("user_id", "last_read_at")
+        )
     
     def __str__(self) -> str:
-        return f"{self.name} (members-{self.get_members_count()}, online-{self.get_online_count()})"        
+        return f"{self.name} (members-{self.get_members_count()})"        
 
 class GroupMessage(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -81,19 +174,95 @@ class GroupMessage(models.Model):
         User, on_delete=models.CASCADE, related_name="messages_from_user"
     )
     content = models.CharField(max_length=512)
-    timestamp = models.DateTimeField(auto_now_add=True)
-    read = models.ManyToManyField(to=User, blank=True)
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     
     def __str__(self) -> str:
         return f"Group conversation {self.group_conversation} message from {self.from_user} : {self.content} [{self.timestamp}]"
     
     def read_message(self, user):
-        if not self.get_read_status(user):
-            self.read.add(user)
+        GroupMembership.objects.filter(
+            group_conversation=self.group_conversation_id,
+            user=user,
+        ).filter(
+            models.Q(last_read_at__isnull=True) | models.Q(last_read_at__lt=self.timestamp)
+        ).update(last_read_at=self.timestamp, last_read_message=self)
     
     def get_read_status(self, user):
-        if self.from_user == user:
+        if self.from_user_id == user.id:
             return True
-        if len(self.read.filter(id=user.id)) == 0:
-            return False
-        return True
\ No newline at end of file
+        return GroupMembership.objects.filter(
+            group_conversation=self.group_conversation_id,
+            user=user,
+            last_read_at__gte=self.timestamp,
+        ).exists()
+    
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["group_conversation", "timestamp", "id"], name="groupmessage_group_time_idx"
+            ),
+        ]
+    
+class GroupMembership(models.Model):
+    """
+    Member of a group conversation with the member's read watermark:
+    every group message up to last_read_at is read by the member.
+    """
+    group_conversation = models.ForeignKey(
+        GroupConversation, on_delete=models.CASCADE, related_name="memberships",
+        db_column="groupconversation_id",
+    )
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="group_memberships"
+    )
+    last_read_at = models.DateTimeField(null=True, blank=True)
+    last_read_message = models.ForeignKey(
+        GroupMessage, on_delete=models.SET_NULL, null=True, blank=True, related_name="+"
+    )
+    
+    def __str__(self) -> str:
+        return f"{self.user} in {self.group_conversation.name} (read up to {self.last_read_at})"
+    
+    class Meta:
+        db_table = "chat_groupconversation_members"
+        unique_together = [("group_conversation", "user")]
+
+class UnreadCounter(models.Model):
+    """
+    Materialized number of unread messages of a user in one conversation.
+    Exactly one of conversation / group_conversation is set.
+    """
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="unread_counters"
+    )
+    conversation = models.ForeignKey(
+        Conversation, on_delete=models.CASCADE, null=True, blank=True, related_name="unread_counters"
+    )
+    group_conversation = models.ForeignKey(
+        GroupConversation, on_delete=models.CASCADE, null=True, blank=True, related_name="unread_counters"
+    )
+    count = models.PositiveIntegerField(default=0)
+    
+    def __str__(self) -> str:
+        return f"{self.user} unread in {self.conversation or self.group_conversation}: {self.count}"
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "conversation"], name="unique_unread_counter_conversation"
+            ),
+            models.UniqueConstraint(
+                fields=["user", "group_conversation"], name="unique_unread_counter_group_conversation"
+            ),
+        ]
+        
+class UnreadTotal(models.Model):
+    """Per-user sums of UnreadCounter rows, so totals are read in O(1)"""
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, primary_key=True, related_name="unread_total"
+    )
+    unread_count = models.PositiveIntegerField(default=0)
+    unread_group_count = models.PositiveIntegerField(default=0)
+    
+    def __str__(self) -> str:
+        return f"{self.user} unread: {self.unread_count}, group unread: {self.unread_group_count}"
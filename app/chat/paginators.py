@@ -1,11 +1,124 @@
-from rest_framework.pagination import PageNumberPagination
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
-class MessagePagination(PageNumberPagination):
+
+class KeysetPagination(BasePagination):
+    """
+    Newest first pagination over (timestamp, id) without OFFSET and COUNT.
+
+    Cursors are message ids: ?before=<id> returns messages older than the
+    message, ?after=<id> returns newer ones. Each page costs a primary key
+    lookup of the cursor plus a range scan of the (conversation, timestamp)
+    index, however deep it is. The first page can also be served from
+    already serialized recent messages with get_recent_response().
+    """
     page_size = 50
     page_size_query_param = "page_size"
     max_page_size = 100
-    
-class GroupMessagePagination(PageNumberPagination):
-    page_size = 50
-    page_size_query_param = "page_size"
-    max_page_size = 100
\ No newline at end of file
+    before_query_param = "before"
+    after_query_param = "after"
+    invalid_cursor_message = "Invalid cursor"
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_cursor_position(self, queryset, cursor):
+        try:
+            timestamp = queryset.filter(id=cursor).values_list("timestamp", flat=True).first()
+        except ValidationError:
+            timestamp = None
+        if timestamp is None:
+            raise NotFound(self.invalid_cursor_message)
+        return timestamp, cursor
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        before = request.query_params.get(self.before_query_param)
+        after = request.query_params.get(self.after_query_param)
+
+        if after is not None:
+            timestamp, id = self.get_cursor_position(queryset, after)
+            queryset = queryset.filter(
+                Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=id)
+            ).order_by("timestamp", "id")
+        else:
+            if before is not None:
+                timestamp, id = self.get_cursor_position(queryset, before)
+                queryset = queryset.filter(
+                    Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=id)
+                )
+            queryset = queryset.order_by("-timestamp", "-id")
+
+        results = list(queryset[:page_size + 1])
+        has_more = len(results) > page_size
+        results = results[:page_size]
+        if after is not None:
+            results.reverse()
+            self.has_next = bool(results)
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = before is not None and bool(results)
+        self.page_ids = [result.id for result in results]
+        return results
+
+    def get_first_page_size(self, request):
+        """Return the page size if the first page is requested, else None"""
+        params = request.query_params
+        if self.before_query_param in params or self.after_query_param in params:
+            return None
+        return self.get_page_size(request)
+
+    def get_recent_response(self, request, data, has_more):
+        """First page response of serialized newest first data"""
+        self.request = request
+        self.page_ids = [item["id"] for item in data]
+        self.has_next = has_more
+        self.has_previous = False
+        return self.get_paginated_response(data)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.after_query_param)
+        return replace_query_param(url, self.before_query_param, self.page_ids[-1])
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.before_query_param)
+        return replace_query_param(url, self.after_query_param, self.page_ids[0])
+
+    def get_paginated_response(self, data):
+        return Response({
+            "next": self.get_next_link(),
+            "previous": self.get_previous_link(),
+            "results": data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "previous": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+
+class MessagePagination(KeysetPagination):
+    pass
+
+
+class GroupMessagePagination(KeysetPagination):
+    pass
@@ -0,0 +1,142 @@
+"""
+Persistence of chat messages sent over websockets.
+
+Messages get their id and timestamp when they are built, so consumers can
+broadcast them before they reach the database. The writer backend,
+configured by settings.CHAT_PERSISTENCE (see chat.backends), decides when
+they are stored:
+
+* StrictWriter stores every message before it is broadcast (default).
+* BufferedWriter queues messages and stores them from a background thread
+  with bulk_create in batches of at most batch_size messages, written at
+  least every flush_interval seconds. Queued messages are written on
+  graceful shutdown; a crashed process loses at most the messages of the
+  last flush_interval. Until a message is written, it is missing from the
+  API and from the history of newly opened sockets.
+
+Either way, a message is stored together with its unread counters, its
+conversation's last_message and, for group messages, the sender's read
+watermark, in one transaction per batch.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from django.db import close_old_connections, transaction
+from chat import counters
+from chat.backends import get_backend
+from chat.models import Message, GroupMessage
+
+logger = logging.getLogger(__name__)
+
+
+def _latest(messages, key):
+    latest = {}
+    for message in messages:
+        if key(message) not in latest or latest[key(message)].timestamp <= message.timestamp:
+            latest[key(message)] = message
+    return latest.values()
+
+
+def store_messages(messages):
+    """Insert private and group chat messages with their side effects"""
+    private_messages = [message for message in messages if isinstance(message, Message)]
+    group_messages = [message for message in messages if isinstance(message, GroupMessage)]
+    with transaction.atomic():
+        Message.objects.bulk_create(private_messages)
+        GroupMessage.objects.bulk_create(group_messages)
+
+        unread = Counter((message.conversation, message.to_user_id) for message in private_messages)
+        for (conversation, user_id), count in unread.items():
+            counters.increment([user_id], conversation=conversation, by=count)
+        for message in _latest(private_messages, lambda message: message.conversation_id):
+            message.conversation.set_last_message(message)
+
+        unread = Counter((message.group_conversation, message.from_user_id) for message in group_messages)
+        for (conversation, from_user_id), count in unread.items():
+            receiver_ids = conversation.members.exclude(id=from_user_id).values_list("id", flat=True)
+            counters.increment(receiver_ids, group_conversation=conversation, by=count)
+        for message in _latest(group_messages, lambda message: message.group_conversation_id):
+            message.group_conversation.set_last_message(message)
+        for message in _latest(group_messages, lambda message: (message.group_conversation_id, message.from_user_id)):
+            message.read_message(message.from_user)
+
+
+class StrictWriter:
+    def save(self, message):
+        store_messages([message])
+
+    def flush(self):
+        pass
+
+
+class BufferedWriter:
+    def __init__(self, batch_size=100, flush_interval=0.05):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        atexit.register(self.flush)
+
+    def save(self, message):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name="chat-writer", daemon=True)
+                    self.thread.start()
+        self.queue.put(message)
+
+    def run(self):
+        stop = False
+        while not stop:
+            batch = [self.queue.get()]
+            if batch[0] is None:
+                return
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    message = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if message is None:
+                    stop = True
+                    break
+                batch.append(message)
+            close_old_connections()
+            self.write(batch)
+
+    def write(self, batch):
+        try:
+            store_messages(batch)
+        except Exception:
+            logger.exception("Failed to store a batch of %s messages, storing them one by one", len(batch))
+            for message in batch:
+                try:
+                    store_messages([message])
+                except Exception:
+                    logger.exception("Failed to store message %s", message.id)
+
+    def flush(self):
+        """Write all queued messages and stop the writer thread"""
+        with self.lock:
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread.join()
+                self.thread = None
+            batch = []
+            while True:
+                try:
+                    message = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if message is not None:
+                    batch.append(message)
+            if batch:
+                self.write(batch)
+
+
+def get_writer():
+    return get_backend("CHAT_PERSISTENCE", "chat.persistence.StrictWriter", "chat.persistence.StrictWriter")
@@ -0,0 +1,203 @@
+"""
+Online presence of users in conversations.
+
+Every open socket is an entry of the conversation's online set that
+expires after `ttl` seconds unless refreshed by a heartbeat, so entries of
+crashed workers disappear on their own. A user is online while at least
+one of the user's sockets is. join() and leave() report whether the user
+went online or offline, which is what consumers broadcast as
+user_join / user_leave diffs.
+
+Configure with settings.CHAT_PRESENCE, see chat.backends.
+"""
+import asyncio
+import time
+from asgiref.sync import async_to_sync
+from chat.backends import get_backend, get_connection, redis_key
+
+DEFAULT_TTL = 60
+DEFAULT_HEARTBEAT_INTERVAL = 20
+
+
+class BasePresence:
+    def __init__(self, ttl=DEFAULT_TTL, heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL):
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+
+    @staticmethod
+    def member(username, channel_name):
+        return f"{username}|{channel_name}"
+
+    async def join(self, conversation_key, username, channel_name):
+        """Add a socket of user, return True if user has just gone online"""
+        raise NotImplementedError
+
+    async def leave(self, conversation_key, username, channel_name):
+        """Remove a socket of user, return True if user has just gone offline"""
+        raise NotImplementedError
+
+    async def heartbeat(self, conversation_key, username, channel_name):
+        """Extend the socket's entry for another ttl seconds"""
+        raise NotImplementedError
+
+    async def online(self, conversation_key):
+        """Return sorted usernames of online users"""
+        raise NotImplementedError
+
+    async def count(self, conversation_key):
+        return len(await self.online(conversation_key))
+
+    async def counts(self, conversation_keys):
+        """Return the number of online users of every conversation, reading them concurrently"""
+        return await asyncio.gather(*(self.count(key) for key in conversation_keys))
+
+
+class LocalPresence(BasePresence):
+    """In-process presence, for tests and single worker development"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.conversations = {}
+
+    def _entries(self, conversation_key):
+        entries = self.conversations.setdefault(conversation_key, {})
+        now = time.time()
+        for member in [member for member, expires in entries.items() if expires <= now]:
+            del entries[member]
+        return entries
+
+    def _is_online(self, entries, username):
+        prefix = self.member(username, "")
+        return any(member.startswith(prefix) for member in entries)
+
+    async def join(self, conversation_key, username, channel_name):
+        entries = self._entries(conversation_key)
+        first = not self._is_online(entries, username)
+        entries[self.member(username, channel_name)] = time.time() + self.ttl
+        return first
+
+    async def leave(self, conversation_key, username, channel_name):
+        entries = self._entries(conversation_key)
+        if entries.pop(self.member(username, channel_name), None) is None:
+            return False
+        return not self._is_online(entries, username)
+
+    async def heartbeat(self, conversation_key, username, channel_name):
+        entries = self._entries(conversation_key)
+        member = self.member(username, channel_name)
+        if member in entries:
+            entries[member] = time.time() + self.ttl
+
+    async def online(self, conversation_key):
+        entries = self._entries(conversation_key)
+        return sorted({member.split("|", 1)[0] for member in entries})
+
+
+class RedisPresence(BasePresence):
+    """
+    Presence in the channel layer Redis: one sorted set per conversation
+    with "username|channel" members scored by their expiry time.
+    """
+
+    # KEYS[1] - set, ARGV - now, expiry, user prefix, member, key ttl
+    JOIN_SCRIPT = """
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+        local first = 1
+        for _, member in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+            if string.sub(member, 1, #ARGV[3]) == ARGV[3] then
+                first = 0
+                break
+            end
+        end
+        redis.call('ZADD', KEYS[1], ARGV[2], ARGV[4])
+        redis.call('EXPIRE', KEYS[1], ARGV[5])
+        return first
+    """
+    # KEYS[1] - set, ARGV - now, user prefix, member
+    LEAVE_SCRIPT = """
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+        if redis.call('ZREM', KEYS[1], ARGV[3]) == 0 then
+            return 0
+        end
+        for _, member in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+            if string.sub(member, 1, #ARGV[2]) == ARGV[2] then
+                return 0
+            end
+        end
+        return 1
+    """
+
+    def _key(self, conversation_key):
+        return redis_key("presence", conversation_key)
+
+    async def join(self, conversation_key, username, channel_name):
+        key = self._key(conversation_key)
+        now = time.time()
+        first = await get_connection(key).eval(
+            self.JOIN_SCRIPT, 1, key,
+            now, now + self.ttl, self.member(username, ""),
+            self.member(username, channel_name), self.ttl,
+        )
+        return bool(first)
+
+    async def leave(self, conversation_key, username, channel_name):
+        key = self._key(conversation_key)
+        last = await get_connection(key).eval(
+            self.LEAVE_SCRIPT, 1, key,
+            time.time(), self.member(username, ""), self.member(username, channel_name),
+        )
+        return bool(last)
+
+    async def heartbeat(self, conversation_key, username, channel_name):
+        key = self._key(conversation_key)
+        pipe = get_connection(key).pipeline()
+        pipe.zadd(key, {self.member(username, channel_name): time.time() + self.ttl}, xx=True)
+        pipe.expire(key, self.ttl)
+        await pipe.execute()
+
+    async def online(self, conversation_key):
+        key = self._key(conversation_key)
+        members = await get_connection(key).zrangebyscore(key, time.time(), "+inf")
+        return sorted({member.decode().split("|", 1)[0] for member in members})
+
+
+class HeartbeatMixin:
+    """
+    Presence heartbeats of a JsonWebsocketConsumer. A task on the consumer's event loop
+    sends a presence_heartbeat event to the consumer's own channel every
+    heartbeat interval, which the consumer handles in order with its other
+    events, so idle sockets stay online until they close. MultiplexConsumer
+    passes the event on to its streams.
+    """
+
+    async def __call__(self, scope, receive, send):
+        ticker = asyncio.create_task(self.heartbeat_ticker())
+        try:
+            return await super().__call__(scope, receive, send)
+        finally:
+            ticker.cancel()
+
+    async def heartbeat_ticker(self):
+        while True:
+            await asyncio.sleep(self.presence.heartbeat_interval)
+            await self.channel_layer.send(self.channel_name, {"type": "presence_heartbeat"})
+
+    def presence_heartbeat(self, event):
+        if self.conversation is not None:
+            async_to_sync(self.presence.heartbeat)(
+                self.conversation.presence_key, self.user.username, self.channel_name
+            )
+
+
+class AsyncHeartbeatMixin(HeartbeatMixin):
+    """Async version of HeartbeatMixin, for AsyncJsonWebsocketConsumer"""
+
+    async def presence_heartbeat(self, event):
+        if self.conversation is not None:
+            await self.presence.heartbeat(
+                self.conversation.presence_key, self.user.username, self.channel_name
+            )
+
+
+def get_presence():
+    return get_backend("CHAT_PRESENCE", "chat.presence.RedisPresence", "chat.presence.LocalPresence")
@@ -0,0 +1,132 @@
+"""
+Wire protocols of websocket frames, negotiated by websocket subprotocol.
+
+* chat.json (default, also used when the client asks for no subprotocol):
+  JSON text frames.
+* chat.compact: msgpack binary frames of [users, frame], where every user
+  dict ({"username", "first_name"}) of the frame is replaced by its index
+  in users, a list of [username, first_name]. A 50 message snapshot then
+  carries each participant once instead of twice per message.
+
+Clients always send JSON text frames. Needs msgpack, installed with
+channels_redis.
+"""
+from chat.encoders import frame_text
+import json
+
+JSON_SUBPROTOCOL = "chat.json"
+COMPACT_SUBPROTOCOL = "chat.compact"
+SUBPROTOCOLS = (JSON_SUBPROTOCOL, COMPACT_SUBPROTOCOL)
+USER_KEYS = {"username", "first_name"}
+# Keys holding users or lists of users in frames
+USER_FIELDS = ("from_user", "to_user", "users", "user")
+MAX_CACHED_FRAMES = 1000
+
+_compact_frames = {}
+
+
+def negotiate(scope):
+    """Return the first supported subprotocol the client asked for, if any"""
+    for subprotocol in scope.get("subprotocols") or ():
+        if subprotocol in SUBPROTOCOLS:
+            return subprotocol
+    return None
+
+
+def _replace_users(value, users, positions):
+    if isinstance(value, dict):
+        if value.keys() == USER_KEYS:
+            key = (value["username"], value["first_name"])
+            position = positions.get(key)
+            if position is None:
+                position = positions[key] = len(users)
+                users.append(list(key))
+            return position
+        return {name: _replace_users(item, users, positions) for name, item in value.items()}
+    if isinstance(value, list):
+        return [_replace_users(item, users, positions) for item in value]
+    return value
+
+
+def encode_compact(content):
+    import msgpack
+    users = []
+    frame = _replace_users(content, users, {})
+    return msgpack.packb([users, frame], use_bin_type=True)
+
+
+def decode_compact(data, user_fields=USER_FIELDS):
+    """Decode a compact frame, expanding users under the keys user_fields"""
+    import msgpack
+    users, frame = msgpack.unpackb(data, raw=False)
+
+    def expand(value, key=None):
+        if key in user_fields and isinstance(value, int):
+            return {"username": users[value][0], "first_name": users[value][1]}
+        if isinstance(value, dict):
+            return {name: expand(item, name) for name, item in value.items()}
+        if isinstance(value, list):
+            return [expand(item, key) for item in value]
+        return value
+
+    return expand(frame)
+
+
+def compact_event_frame(event):
+    """
+    Compact frame of a channel layer event. Broadcast events carry JSON
+    text (see chat.encoders.encode_event), converted once per process.
+    """
+    text = event.get("text")
+    if text is None:
+        return encode_compact(event)
+    frame = _compact_frames.get(text)
+    if frame is None:
+        if len(_compact_frames) >= MAX_CACHED_FRAMES:
+            _compact_frames.clear()
+        frame = _compact_frames[text] = encode_compact(json.loads(text))
+    return frame
+
+
+class ProtocolMixin:
+    """Subprotocol negotiation of a JsonWebsocketConsumer, list it before the consumer base class"""
+    compact = False
+
+    def accept(self, subprotocol=None):
+        subprotocol = subprotocol or negotiate(self.scope)
+        self.compact = subprotocol == COMPACT_SUBPROTOCOL
+        super().accept(subprotocol)
+
+    def send_json(self, content, close=False):
+        if self.compact:
+            return self.send(bytes_data=encode_compact(content), close=close)
+        return super().send_json(content, close)
+
+    def send_event(self, event):
+        """Forward a channel layer event to the client"""
+        if self.compact:
+            self.send(bytes_data=compact_event_frame(event))
+        else:
+            self.send(text_data=frame_text(event))
+
+
+class AsyncProtocolMixin:
+    """Subprotocol negotiation of an AsyncJsonWebsocketConsumer, list it before the consumer base class"""
+    compact = False
+
+    async def accept(self, subprotocol=None):
+        subprotocol = subprotocol or negotiate(self.scope)
+        self.compact = subprotocol == COMPACT_SUBPROTOCOL
+        await super().accept(subprotocol)
+
+    async def send_json(self, content, close=False):
+        if self.compact:
+            return await self.send(bytes_data=encode_compact(content), close=close)
+        return await super().send_json(content, close)
+
+    async def send_event(self, event):
+        """Forward a channel layer event to the client"""
+        if self.compact:
+            await self.send(bytes_data=compact_event_frame(event))
+        else:
+            await self.send(text_data=frame_text(event))
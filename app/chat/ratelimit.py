@@ -0,0 +1,141 @@
+"""
+Token bucket rate limits of incoming websocket frames.
+
+Every user has one bucket per limited frame type, shared by all of the
+user's sockets. A bucket holds up to `burst` tokens and refills at `rate`
+tokens per second; each frame takes a token, and frames finding the
+bucket empty are dropped with an error frame telling the client when to
+retry:
+
+    {"type": "error", "code": "rate_limited", "message_type": "chat_message", "retry_after": 0.2}
+
+Frame types missing from `rates` are not limited. Configure with
+settings.CHAT_RATE_LIMITS, see chat.backends.
+"""
+import time
+from collections import OrderedDict
+from asgiref.sync import async_to_sync
+from chat import metrics
+from chat.backends import get_backend, get_connection, redis_key
+
+# Frame type: (tokens per second, burst)
+DEFAULT_RATES = {
+    "chat_message": (5, 20),
+    "read_messages": (2, 10),
+    "read_group_messages": (2, 10),
+    "add_member": (1, 5),
+    "remove_member": (1, 5),
+    "sync": (1, 5),
+    "subscribe": (5, 50),
+}
+
+
+class BaseRateLimiter:
+    def __init__(self, rates=None):
+        self.rates = {
+            message_type: (float(rate), float(burst))
+            for message_type, (rate, burst) in (DEFAULT_RATES if rates is None else rates).items()
+        }
+
+    async def acquire(self, user_key, message_type):
+        """Take a token from the bucket, return 0 or seconds until a token is available"""
+        raise NotImplementedError
+
+
+class LocalRateLimiter(BaseRateLimiter):
+    """In-process buckets, for tests and single worker development"""
+
+    def __init__(self, max_buckets=100000, **kwargs):
+        super().__init__(**kwargs)
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+
+    async def acquire(self, user_key, message_type):
+        rate, burst = self.rates[message_type]
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop((user_key, message_type), (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens >= 1:
+            tokens, wait = tokens - 1, 0
+        else:
+            wait = (1 - tokens) / rate
+        self.buckets[(user_key, message_type)] = (tokens, now)
+        if len(self.buckets) > self.max_buckets:
+            self.buckets.popitem(last=False)
+        return wait
+
+
+class RedisRateLimiter(BaseRateLimiter):
+    """Buckets in the channel layer Redis: one hash of tokens and update time per bucket"""
+
+    # KEYS[1] - bucket, ARGV - now, rate, burst
+    ACQUIRE_SCRIPT = """
+        local now, rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(bucket[1]) or burst
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(wait)
+    """
+
+    async def acquire(self, user_key, message_type):
+        rate, burst = self.rates[message_type]
+        key = redis_key("ratelimit", user_key, message_type)
+        wait = await get_connection(key).eval(self.ACQUIRE_SCRIPT, 1, key, time.time(), rate, burst)
+        return float(wait)
+
+
+def get_rate_limiter():
+    return get_backend(
+        "CHAT_RATE_LIMITS", "chat.ratelimit.RedisRateLimiter", "chat.ratelimit.LocalRateLimiter"
+    )
+
+
+def rate_limit_error(message_type, wait):
+    metrics.rate_limited.inc(message_type)
+    return {
+        "type": "error",
+        "code": "rate_limited",
+        "message_type": message_type,
+        "retry_after": round(wait, 3),
+    }
+
+
+class RateLimitMixin:
+    """Rate limits of a JsonWebsocketConsumer"""
+
+    def rate_limited(self, content):
+        """Send an error and return True if the frame exceeds the user's limits"""
+        limiter = get_rate_limiter()
+        message_type = content.get("type")
+        if message_type not in limiter.rates:
+            return False
+        wait = async_to_sync(limiter.acquire)(self.scope["user"].username, message_type)
+        if not wait:
+            return False
+        self.send_json(rate_limit_error(message_type, wait))
+        return True
+
+
+class AsyncRateLimitMixin:
+    """Rate limits of an AsyncJsonWebsocketConsumer"""
+
+    async def rate_limited(self, content):
+        """Send an error and return True if the frame exceeds the user's limits"""
+        limiter = get_rate_limiter()
+        message_type = content.get("type")
+        if message_type not in limiter.rates:
+            return False
+        wait = await limiter.acquire(self.scope["user"].username, message_type)
+        if not wait:
+            return False
+        await self.send_json(rate_limit_error(message_type, wait))
+        return True
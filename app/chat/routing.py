@@ -1,8 +1,23 @@
+from django.conf import settings
 from django.urls import path
-from chat.consumers import ChatConsumer, NotificationConsumer, GroupChatConsumer
+from chat.consumers import ChatConsumer, NotificationConsumer, GroupChatConsumer, \
+                           AsyncChatConsumer, AsyncNotificationConsumer, AsyncGroupChatConsumer, \
+                           MultiplexConsumer
+
+# settings.CHAT_CONSUMERS selects the consumer implementation: "async" or "sync"
+CONSUMERS = {
+    "sync": (ChatConsumer, NotificationConsumer, GroupChatConsumer),
+    "async": (AsyncChatConsumer, AsyncNotificationConsumer, AsyncGroupChatConsumer),
+}
+chat_consumer, notification_consumer, group_chat_consumer = CONSUMERS[settings.CHAT_CONSUMERS]
 
 websocket_urlpatterns = [
-    path("chats/<conversation_name>/", ChatConsumer.as_asgi()),
-    path("notifications/", NotificationConsumer.as_asgi()),
-    path("group_chats/<group_chat_name>/", GroupChatConsumer.as_asgi()),
-]
\ No newline at end of file
+    path("chats/<conversation_name>/", chat_consumer.as_asgi()),
+    path("notifications/", notification_consumer.as_asgi()),
+    path("group_chats/<group_chat_name>/", group_chat_consumer.as_asgi()),
+]
+
+# Streams of the multiplexed socket are the paths of the sockets above
+websocket_urlpatterns.append(
+    path("multiplex/", MultiplexConsumer.as_asgi(streams=list(websocket_urlpatterns)))
+)
\ No newline at end of file
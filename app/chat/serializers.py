@@ -1,5 +1,6 @@
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer as BaseTokenObtainPairSerializer
 from .models import Message, Conversation, GroupMessage
 
 User = get_user_model()
@@ -28,7 +29,7 @@ class MessageSerializer(serializers.ModelSerializer):
         )
         
     def get_conversation(self, obj):
-        return str(obj.conversation.id)
+        return str(obj.conversation_id)
     
     def get_from_user(self, obj):
         return UserSerializer(obj.from_user).data
@@ -37,6 +38,10 @@ class MessageSerializer(serializers.ModelSerializer):
         return UserSerializer(obj.to_user).data
     
 class ConversationSerializer(serializers.ModelSerializer):
+    """
+    Inbox row. Select last_message with its users and prefetch participants
+    (see ConversationViewSet) to serialize a list in constant queries.
+    """
     other_user = serializers.SerializerMethodField()
     last_message = serializers.SerializerMethodField()
     
@@ -45,23 +50,24 @@ class ConversationSerializer(serializers.ModelSerializer):
         fields = ("id", "name", "other_user", "last_message")
         
     def get_last_message(self, obj):
-        messages = obj.messages.all().order_by("-timestamp")
-        if not messages.exists():
+        if obj.last_message is None:
             return None
-        message = messages[0]
-        return MessageSerializer(message).data    
+        return MessageSerializer(obj.last_message).data    
         
     def get_other_user(self, obj):
-        usernames = obj.name.split('__')
-        context = {}
-        for username in usernames:
-            if username != self.context['user'].username:
-                other_user = User.objects.get(username=username)
-                return UserSerializer(other_user, context=context).data
+        other_user = obj.get_other_participant(self.context['user'])
+        if other_user is not None:
+            return UserSerializer(other_user).data
             
 class GroupMessageSerializer(serializers.ModelSerializer):
+    """
+    Group message with ids of members who have read it.
+    Pass members' read watermarks as context["read_watermarks"]
+    (see GroupConversation.get_read_watermarks) to avoid a query per message.
+    """
     from_user = serializers.SerializerMethodField()
     group_conversation = serializers.SerializerMethodField()
+    read = serializers.SerializerMethodField()
     
     class Meta:
         model = GroupMessage
@@ -74,28 +80,57 @@ class GroupMessageSerializer(serializers.ModelSerializer):
             "read",
         )
     def get_group_conversation(self, obj):
-        return str(obj.group_conversation.id)
+        return str(obj.group_conversation_id)
     
     def get_from_user(self, obj):
         return UserSerializer(obj.from_user).data
+    
+    def get_read(self, obj):
+        watermarks = self.context.get("read_watermarks")
+        if watermarks is None:
+            watermarks = obj.group_conversation.get_read_watermarks()
+        return [
+            user_id for user_id, last_read_at in watermarks
+            if last_read_at is not None and last_read_at >= obj.timestamp
+        ]
 
 class GroupConversationSerializer(ConversationSerializer):
     members = serializers.SerializerMethodField()
     admin = serializers.SerializerMethodField()
+    members_count = serializers.IntegerField(read_only=True)
+    online_count = serializers.SerializerMethodField()
     class Meta:
         model = Conversation
-        fields = ("id", "name", "last_message", "members", "admin")
+        fields = ("id", "name", "last_message", "members", "admin", "members_count", "online_count")
     
     def get_last_message(self, obj):
-        messages = obj.group_messages.all().order_by("-timestamp")
-        if not messages.exists():
+        if obj.last_message is None:
             return None
-        message = messages[0]
-        return GroupMessageSerializer(message).data  
+        return GroupMessageSerializer(
+            obj.last_message, context={"read_watermarks": obj.get_read_watermarks()}
+        ).data  
+    
+    def get_online_count(self, obj):
+        """Online members from presence, pass context["online_counts"] by id to read them at once"""
+        online_counts = self.context.get("online_counts", {})
+        if obj.id in online_counts:
+            return online_counts[obj.id]
+        return obj.get_online_count()
     
     def get_members(self, obj):
-        members = obj.members.all()
+        members = [membership.user for membership in obj.memberships.all()]
         return UserSerializer(members, many=True).data   
     
     def get_admin(self, obj):
-        return UserSerializer(obj.admin).data
\ No newline at end of file
+        return UserSerializer(obj.admin).data
+
+
+class TokenObtainPairSerializer(BaseTokenObtainPairSerializer):
+    """JWT pair with the claims chat.middleware builds websocket users from"""
+    
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token["username"] = user.username
+        token["first_name"] = user.first_name
+        return token
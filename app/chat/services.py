@@ -0,0 +1,331 @@
+"""
+Database work shared by the sync and async chat consumers.
+
+Every function here is plain synchronous ORM code that returns data ready
+to be sent over the websocket, so the async consumers can run the DB part
+of an event in a single ``database_sync_to_async`` hop. Message payloads
+are built by chat.payloads rather than the DRF serializers.
+"""
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from chat import counters, payloads
+from chat.history import get_history
+from chat.membership import get_membership
+from chat.persistence import get_writer
+from chat.models import Conversation, Message, GroupConversation, GroupMessage
+import uuid
+
+User = get_user_model()
+
+LAST_MESSAGES_COUNT = 50
+
+
+def get_receiver(conversation, user):
+    """Return the other participant of a private conversation"""
+    return conversation.get_other_participant(user)
+
+
+def get_or_create_conversation(conversation_name):
+    """
+    Return the private conversation and whether it has been created.
+    A new conversation gets its participants and pair key from the name.
+    """
+    conversation = Conversation.objects.filter(name=conversation_name).first()
+    if conversation is not None:
+        return conversation, False
+    users = list(User.objects.filter(
+        username__in=Conversation.get_participant_usernames(conversation_name)
+    ))
+    pair_key = Conversation.make_pair_key(*[user.id for user in users]) if len(users) == 2 else None
+    try:
+        with transaction.atomic():
+            conversation = Conversation.objects.create(name=conversation_name, pair_key=pair_key)
+            conversation.participants.set(users)
+    except IntegrityError: # The same pair has just been created by another connection
+        return Conversation.objects.get(pair_key=pair_key), False
+    return conversation, True
+
+
+def get_last_messages(conversation, count=LAST_MESSAGES_COUNT):
+    """
+    Return the last serialized messages and whether older ones exist,
+    from the recent messages buffer when possible.
+    """
+    history = get_history()
+    version, recent = async_to_sync(history.get)(conversation.history_key, count)
+    if recent is not None:
+        return recent
+    messages = list(
+        conversation.messages.select_related("from_user", "to_user")
+                             .order_by("-timestamp", "-id")[:max(count, history.size) + 1]
+    )
+    message_payloads = payloads.message_payloads(messages)
+    async_to_sync(history.fill)(conversation.history_key, version, message_payloads)
+    return message_payloads[:count], len(messages) > count
+
+
+def _get_since(conversation, messages, since, count, buffered, serialize):
+    """
+    Return payloads of messages newer than the message since, newest first,
+    or None if it is not a message of the conversation or more than count
+    messages are newer. buffered completes payloads from the recent messages
+    buffer, serialize builds payloads of messages from the database.
+    """
+    try:
+        since = str(uuid.UUID(str(since)))
+    except ValueError:
+        return None
+    history = get_history()
+    _, recent = async_to_sync(history.get)(conversation.history_key, history.size)
+    if recent is not None:
+        recent_payloads, has_more = recent
+        ids = [payload["id"] for payload in recent_payloads]
+        if since in ids:
+            index = ids.index(since)
+            return buffered(recent_payloads[:index]) if index <= count else None
+        if not has_more:
+            return None
+    timestamp = messages.filter(id=since).values_list("timestamp", flat=True).first()
+    if timestamp is None:
+        return None
+    newer = list(
+        messages.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=since))
+                .order_by("timestamp", "id")[:count + 1]
+    )
+    if len(newer) > count:
+        return None
+    newer.reverse()
+    return serialize(newer)
+
+
+def get_messages_since(conversation, since, count=LAST_MESSAGES_COUNT):
+    """Return serialized messages after the message since, see _get_since"""
+    return _get_since(
+        conversation, conversation.messages.select_related("from_user", "to_user"), since, count,
+        buffered=lambda message_payloads: message_payloads,
+        serialize=payloads.message_payloads,
+    )
+
+
+def get_messages_frame(conversation, since=None):
+    """
+    Return the frame bringing a client's messages up to date: the messages
+    it has missed since the message since, or the last messages snapshot
+    if since is not given, unknown or too far behind. caught_up tells a
+    resuming client whether its messages continue without a gap.
+    """
+    if since:
+        messages = get_messages_since(conversation, since)
+        if messages is not None:
+            return {"type": "missed_messages", "messages": messages, "caught_up": True}
+    messages, has_more = get_last_messages(conversation)
+    frame = {"type": "last_50_messages", "messages": messages, "has_more": has_more}
+    if since:
+        frame["caught_up"] = False
+    return frame
+
+
+def create_message(conversation, from_user, content, receiver=None):
+    """Store a private message, return its payload and the receiver"""
+    if receiver is None:
+        receiver = get_receiver(conversation, from_user)
+    message = Message(
+        from_user=from_user,
+        to_user=receiver,
+        content=content,
+        conversation=conversation,
+    )
+    get_writer().save(message)
+    message_payload = payloads.message_payload(message)
+    async_to_sync(get_history().push)(conversation.history_key, message_payload)
+    return message_payload, receiver
+
+
+def read_messages(conversation, user):
+    """Mark conversation messages sent to user as read, return unread count"""
+    with transaction.atomic():
+        unread, unread_count = counters.reset(user, conversation=conversation)
+        if unread:
+            conversation.messages.filter(to_user=user, read=False).update(read=True)
+    if unread:
+        async_to_sync(get_history().mark_read)(conversation.history_key, user.username)
+    return unread_count
+
+
+def get_next_group_conversation_id(user):
+    group_conversation_count = GroupConversation.objects.filter(admin=user).count()
+    return group_conversation_count + 1
+
+
+def get_or_create_group_conversation(conversation_name, admin):
+    conv = GroupConversation.objects.filter(name=conversation_name)
+    if len(conv) == 0:
+        conversation = GroupConversation.objects.create(
+            name=conversation_name, admin=admin
+        )
+        conversation.join_group(admin)
+        return conversation, True
+    return conv[0], False
+
+
+def get_last_group_messages(conversation, count=LAST_MESSAGES_COUNT):
+    """
+    Return the last serialized group messages and whether older ones exist,
+    from the recent messages buffer when possible.
+    """
+    history = get_history()
+    read_watermarks = conversation.get_read_watermarks()
+    version, recent = async_to_sync(history.get)(conversation.history_key, count)
+    if recent is not None:
+        group_message_payloads, has_more = recent
+        return payloads.set_group_read(group_message_payloads, read_watermarks), has_more
+    group_messages = list(
+        conversation.group_messages.select_related("from_user")
+                                   .order_by("-timestamp", "-id")[:max(count, history.size) + 1]
+    )
+    group_message_payloads = payloads.group_message_payloads(group_messages, read_watermarks)
+    async_to_sync(history.fill)(
+        conversation.history_key, version, [_without_read(payload) for payload in group_message_payloads]
+    )
+    return group_message_payloads[:count], len(group_messages) > count
+
+
+def get_group_messages_since(conversation, since, count=LAST_MESSAGES_COUNT):
+    """Return serialized group messages after the message since, see _get_since"""
+    read_watermarks = conversation.get_read_watermarks()
+    return _get_since(
+        conversation, conversation.group_messages.select_related("from_user"), since, count,
+        buffered=lambda group_message_payloads: payloads.set_group_read(group_message_payloads, read_watermarks),
+        serialize=lambda group_messages: payloads.group_message_payloads(group_messages, read_watermarks),
+    )
+
+
+def get_group_messages_frame(conversation, since=None):
+    """Group chat version of get_messages_frame"""
+    if since:
+        group_messages = get_group_messages_since(conversation, since)
+        if group_messages is not None:
+            return {"type": "missed_group_messages", "group_messages": group_messages, "caught_up": True}
+    group_messages, has_more = get_last_group_messages(conversation)
+    frame = {"type": "last_50_group_messages", "group_messages": group_messages, "has_more": has_more}
+    if since:
+        frame["caught_up"] = False
+    return frame
+
+
+def _without_read(group_message_payload):
+    return {key: value for key, value in group_message_payload.items() if key != "read"}
+
+
+def _push_group_message(conversation, group_message_payload):
+    async_to_sync(get_history().push)(conversation.history_key, _without_read(group_message_payload))
+    return group_message_payload
+
+
+def get_members(conversation):
+    """Return serialized group members, from the membership cache when possible"""
+    membership = get_membership()
+    version, members = async_to_sync(membership.get)(conversation.membership_key)
+    if members is None:
+        members = [payloads.user_payload(user) for user in conversation.members.all()]
+        async_to_sync(membership.set)(conversation.membership_key, version, members)
+    return members
+
+
+def get_notification_groups(user):
+    """Return notification groups of the group conversations user is a member of"""
+    return [
+        GroupConversation.make_notification_group(conversation_id)
+        for conversation_id in user.group_members.values_list("id", flat=True)
+    ]
+
+
+def _create_group_message(conversation, from_user, content):
+    """Store a group message and count it as unread for other members"""
+    message = GroupMessage.objects.create(
+        from_user=from_user,
+        content=content,
+        group_conversation=conversation,
+    )
+    receiver_ids = conversation.members.exclude(id=from_user.id).values_list("id", flat=True)
+    counters.increment(receiver_ids, group_conversation=conversation)
+    conversation.set_last_message(message)
+    return message
+
+
+def create_group_message(conversation, from_user, content):
+    """Store a group message read by its sender, return its payload"""
+    message = GroupMessage(
+        from_user=from_user,
+        content=content,
+        group_conversation=conversation,
+    )
+    get_writer().save(message)
+    read_watermarks = [ # The sender's watermark may not be written yet
+        (user_id, message.timestamp if user_id == from_user.id else last_read_at)
+        for user_id, last_read_at in conversation.get_read_watermarks()
+    ]
+    return _push_group_message(conversation, payloads.group_message_payload(message, read_watermarks))
+
+
+def add_member(conversation, username):
+    """
+    Add user to the group and store a service message about it.
+    Return the message payload and the member's payload,
+    or None if there is no such user.
+    """
+    user = User.objects.filter(username=username)
+    if len(user) == 0:
+        return None
+    user = user[0]
+    with transaction.atomic():
+        conversation.join_group(user)
+        message = _create_group_message(
+            conversation, conversation.admin, f"User {user.username} was added to the chat"
+        )
+    async_to_sync(get_membership().invalidate)(conversation.membership_key)
+    message_payload = _push_group_message(
+        conversation, payloads.group_message_payload(message, conversation.get_read_watermarks())
+    )
+    return message_payload, payloads.user_payload(user)
+
+
+def remove_member(conversation, username):
+    """
+    Remove user from the group and store a service message about it.
+    Return the message payload and the member's payload,
+    or None if there is no such user.
+    """
+    user = User.objects.filter(username=username)
+    if len(user) == 0:
+        return None
+    user = user[0]
+    with transaction.atomic():
+        conversation.leave_group(user)
+        counters.drop(user, conversation)
+        message = _create_group_message(
+            conversation, conversation.admin, f"User {user.username} was removed from the chat"
+        )
+    async_to_sync(get_membership().invalidate)(conversation.membership_key)
+    message_payload = _push_group_message(
+        conversation, payloads.group_message_payload(message, conversation.get_read_watermarks())
+    )
+    return message_payload, payloads.user_payload(user)
+
+
+def get_unread_counts(user):
+    """Return unread private and group message totals of user"""
+    totals = counters.get_totals(user)
+    return totals.unread_count, totals.unread_group_count
+
+
+def read_group_messages(conversation, user):
+    """Mark all group messages as read by user, return unread group count"""
+    with transaction.atomic():
+        unread, unread_group_count = counters.reset(user, group_conversation=conversation)
+        last_message = conversation.group_messages.order_by("-timestamp").first()
+        if last_message is not None:
+            last_message.read_message(user)
+    return unread_group_count
@@ -2,13 +2,49 @@ from rest_framework.test import APITestCase
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, transaction
+from django.core.management import call_command
+from django.urls import path
 from channels.testing import WebsocketCommunicator
+from channels.layers import get_channel_layer, InMemoryChannelLayer as BaseInMemoryChannelLayer
+from channels.routing import URLRouter
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
 from chat.consumers.group_chat_consumer import GroupChatConsumer
 from chat.consumers.private_chat_consumer import ChatConsumer
 from chat.consumers.notification_consumer import NotificationConsumer
-from chat.middleware import TokenAuthMiddleware
+from chat.consumers.async_group_chat_consumer import AsyncGroupChatConsumer
+from chat.consumers.async_private_chat_consumer import AsyncChatConsumer
+from chat.consumers.async_notification_consumer import AsyncNotificationConsumer
+from chat.consumers.multiplex_consumer import MultiplexConsumer
+from chat.middleware import TokenAuthMiddleware, get_token_cache
+from chat.models import Conversation, Message, GroupConversation, GroupMessage, GroupMembership, UnreadTotal
+from chat.serializers import MessageSerializer, GroupMessageSerializer, TokenObtainPairSerializer
+from chat.encoders import UUIDEncoder, encode_json
+from chat import metrics, payloads, routing, services
+from chat.presence import LocalPresence, get_presence
+from chat.history import LocalHistory, RedisHistory
+from chat.membership import get_membership
+from chat.protocols import COMPACT_SUBPROTOCOL, decode_compact, encode_compact
+from chat.backends import reset_backends
+from chat.layers import HashRing, InMemoryChannelLayer, ShardedRedisChannelLayer, group_send_many
+from chat.persistence import get_writer
+from chat.benchmarks.load import LoadBenchmark
+from io import StringIO
+from unittest import skipUnless
+from unittest.mock import patch
+from datetime import timedelta
+from django.utils import timezone
+import asyncio
 import json
+import re
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
 
 User = get_user_model()
 
@@ -18,10 +54,26 @@ class AuthWebsocketCommunicator(WebsocketCommunicator):
         if user is not None:
             self.scope['user'] = user
 
-class ChatTest(TestCase):
+class LocalBackendsMixin:
+    """
+    Empty in-process recent message buffers, member lists and rate limits
+    for every test, caches of rolled back tests would serve their rows.
+    """
+    def setUp(self):
+        super().setUp()
+        backends = override_settings(
+            CHAT_HISTORY={"BACKEND": "chat.history.LocalHistory"},
+            CHAT_MEMBERSHIP={"BACKEND": "chat.membership.LocalMembership"},
+            CHAT_RATE_LIMITS={"BACKEND": "chat.ratelimit.LocalRateLimiter"},
+        )
+        backends.enable()
+        self.addCleanup(backends.disable)
+
+class ChatTest(LocalBackendsMixin, TestCase):
     fixtures = ['users.json', 'conversations.json', 'messages.json', 
                 'group_conversations.json', 'group_messages.json']
     conversation_name = "test__test2"
+    consumer_class = ChatConsumer
     
     @classmethod
     def setUpTestData(cls):
@@ -31,7 +83,7 @@ class ChatTest(TestCase):
     async def test_1_chat_consumer_without_credentials(self):
 
         communicator = AuthWebsocketCommunicator(
-            application=ChatConsumer.as_asgi(),
+            application=self.consumer_class.as_asgi(),
             path=f'/chats/{self.conversation_name}/'
         )
         connected, subprotocol = await communicator.connect()
@@ -40,7 +92,7 @@ class ChatTest(TestCase):
     async def test_2_chat_consumer_create_new_chat(self):
         conversation_name = "test__test3"
         communicator = AuthWebsocketCommunicator(
-            application=ChatConsumer.as_asgi(),
+            application=self.consumer_class.as_asgi(),
             path=f'/chats/{conversation_name}/',
             user=self.token.user
         )
@@ -56,7 +108,7 @@ class ChatTest(TestCase):
         
         test_message = "Test message!"
         communicator = AuthWebsocketCommunicator(
-            application=ChatConsumer.as_asgi(),
+            application=self.consumer_class.as_asgi(),
             path=f'/chats/{self.conversation_name}/',
             user=self.token.user
         )
@@ -83,12 +135,217 @@ class ChatTest(TestCase):
         
         await communicator.disconnect()
         
-class GroupChatTest(TestCase):
+    async def test_4_chat_consumer_presence(self):
+        user2 = await User.objects.aget(username="test2")
+        conversation = await Conversation.objects.aget(name=self.conversation_name)
+        communicators = []
+        for user in (self.token.user, user2):
+            communicator = AuthWebsocketCommunicator(
+                application=self.consumer_class.as_asgi(),
+                path=f'/chats/{self.conversation_name}/',
+                user=user
+            )
+            communicator.scope['url_route'] = {'kwargs':{"conversation_name": self.conversation_name}}
+            connected, subprotocol = await communicator.connect()
+            assert connected
+            communicators.append(communicator)
+        first, second = communicators
+        
+        response = await second.receive_json_from()
+        assert response == {"type": "online_user_list", "users": ["test"]}
+        while response["type"] != "last_50_messages":
+            response = await second.receive_json_from()
+        
+        assert await get_presence().online(conversation.presence_key) == ["test", "test2"]
+        
+        await second.disconnect()
+        assert await get_presence().online(conversation.presence_key) == ["test"]
+        await first.disconnect()
+        
+    async def test_5_chat_consumer_forwards_encoded_frames(self):
+        communicator = AuthWebsocketCommunicator(
+            application=self.consumer_class.as_asgi(),
+            path=f'/chats/{self.conversation_name}/',
+            user=self.token.user
+        )
+        communicator.scope['url_route'] = {'kwargs':{"conversation_name": self.conversation_name}}
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        response = await communicator.receive_json_from()
+        while response["type"] != "last_50_messages":
+            response = await communicator.receive_json_from()
+        
+        text = '{"type":"chat_message_echo","encoded":"once"}'
+        await get_channel_layer().group_send(
+            self.conversation_name, {"type": "chat_message_echo", "text": text}
+        )
+        frames = [await communicator.receive_from(), await communicator.receive_from()]
+        assert text in frames
+        await communicator.disconnect()
+        
+    async def test_6_chat_consumer_coalesces_typing(self):
+        communicator = AuthWebsocketCommunicator(
+            application=self.consumer_class.as_asgi(),
+            path=f'/chats/{self.conversation_name}/',
+            user=self.token.user
+        )
+        communicator.scope['url_route'] = {'kwargs':{"conversation_name": self.conversation_name}}
+        with patch.object(self.consumer_class, "typing_timeout", 0.2):
+            connected, subprotocol = await communicator.connect()
+        assert connected
+        response = await communicator.receive_json_from()
+        while response["type"] != "user_join":
+            response = await communicator.receive_json_from()
+        
+        for typing in [True] * 20 + [False] * 5 + [True] * 20:
+            await communicator.send_json_to({"type": "typing", "typing": typing})
+        await communicator.send_json_to({"type": "chat_message", "message": "Test message!"})
+        await communicator.send_json_to({"type": "typing", "typing": True})
+        frames = []
+        while await communicator.receive_nothing(timeout=0.5) is False:
+            frames.append(await communicator.receive_json_from())
+        assert [(frame["type"], frame.get("typing")) for frame in frames] == [
+            ("typing", True), ("typing", False), ("typing", True), ("typing", False),
+            ("chat_message_echo", None), ("typing", True), ("typing", False),
+        ]
+        await communicator.disconnect()
+        
+    async def test_7_chat_consumer_resumes_from_cursor(self):
+        conversation = await Conversation.objects.aget(name=self.conversation_name)
+        last_seen = await conversation.messages.order_by("-timestamp", "-id").afirst()
+        for i in range(2):
+            await database_sync_to_async(services.create_message)(conversation, self.token.user, f"Missed {i}")
+        
+        frames = []
+        for since in (last_seen.id, "c2c280b2-4cf9-4bb7-bc9d-b8ae9c7e7d97"):
+            communicator = AuthWebsocketCommunicator(
+                application=self.consumer_class.as_asgi(),
+                path=f'/chats/{self.conversation_name}/?since={since}',
+                user=self.token.user
+            )
+            communicator.scope['url_route'] = {'kwargs':{"conversation_name": self.conversation_name}}
+            connected, subprotocol = await communicator.connect()
+            assert connected
+            response = await communicator.receive_json_from()
+            while response["type"] not in ("missed_messages", "last_50_messages"):
+                response = await communicator.receive_json_from()
+            frames.append(response)
+            await communicator.disconnect()
+        missed, snapshot = frames
+        assert missed["type"] == "missed_messages" and missed["caught_up"]
+        assert [message["content"] for message in missed["messages"]] == ["Missed 1", "Missed 0"]
+        assert snapshot["type"] == "last_50_messages" and not snapshot["caught_up"]
+        assert snapshot["messages"][:2] == missed["messages"]
+        
+    async def test_8_chat_consumer_compact_protocol(self):
+        conversation = await Conversation.objects.aget(name=self.conversation_name)
+        snapshot = await database_sync_to_async(services.get_messages_frame)(conversation)
+        communicator = AuthWebsocketCommunicator(
+            application=self.consumer_class.as_asgi(),
+            path=f'/chats/{self.conversation_name}/',
+            subprotocols=["chat.v2", COMPACT_SUBPROTOCOL],
+            user=self.token.user
+        )
+        communicator.scope['url_route'] = {'kwargs':{"conversation_name": self.conversation_name}}
+        connected, subprotocol = await communicator.connect()
+        assert connected and subprotocol == COMPACT_SUBPROTOCOL
+        response = decode_compact(await communicator.receive_from())
+        while response["type"] != "last_50_messages":
+            response = decode_compact(await communicator.receive_from())
+        assert response == snapshot
+        assert len(encode_compact(snapshot)) < len(encode_json(snapshot).encode())
+        
+        await communicator.send_json_to({"type": "chat_message", "message": "Test message!"})
+        response = decode_compact(await communicator.receive_from())
+        while response["type"] != "chat_message_echo":
+            response = decode_compact(await communicator.receive_from())
+        assert response["message"]["from_user"] == {"username": "test", "first_name": ""}
+        await communicator.disconnect()
+        
+    async def test_9_chat_consumer_rate_limits(self):
+        rate_limits = override_settings(CHAT_RATE_LIMITS={
+            "BACKEND": "chat.ratelimit.LocalRateLimiter", "CONFIG": {"rates": {"chat_message": (0.01, 2)}},
+        })
+        rate_limits.enable()
+        self.addCleanup(rate_limits.disable)
+        communicator = AuthWebsocketCommunicator(
+            application=self.consumer_class.as_asgi(),
+            path=f'/chats/{self.conversation_name}/',
+            user=self.token.user
+        )
+        communicator.scope['url_route'] = {'kwargs':{"conversation_name": self.conversation_name}}
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        response = await communicator.receive_json_from()
+        while response["type"] != "user_join":
+            response = await communicator.receive_json_from()
+        
+        for i in range(3):
+            await communicator.send_json_to({"type": "chat_message", "message": f"Message {i}"})
+        frames = []
+        while await communicator.receive_nothing(timeout=0.2) is False:
+            frames.append(await communicator.receive_json_from())
+        await communicator.disconnect()
+        # Echoes come through the channel layer, so the error may overtake them
+        assert [frame["type"] for frame in frames].count("chat_message_echo") == 2
+        errors = [frame for frame in frames if frame["type"] == "error"]
+        assert len(errors) == 1
+        assert errors[0]["code"] == "rate_limited" and errors[0]["message_type"] == "chat_message"
+        assert 0 < errors[0]["retry_after"] <= 100
+    
+    async def test_10_idle_socket_stays_online(self):
+        presence = override_settings(CHAT_PRESENCE={
+            "BACKEND": "chat.presence.LocalPresence", "CONFIG": {"ttl": 0.3, "heartbeat_interval": 0.1},
+        })
+        presence.enable()
+        self.addCleanup(presence.disable)
+        communicator = AuthWebsocketCommunicator(
+            application=self.consumer_class.as_asgi(),
+            path=f'/chats/{self.conversation_name}/',
+            user=self.token.user
+        )
+        communicator.scope['url_route'] = {'kwargs':{"conversation_name": self.conversation_name}}
+        conversation = await Conversation.objects.aget(name=self.conversation_name)
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        # Three times the ttl without a frame from the client
+        await asyncio.sleep(0.9)
+        online = await get_presence().online(conversation.presence_key)
+        await communicator.disconnect()
+        assert online == ["test"]
+        assert await get_presence().online(conversation.presence_key) == []
+    
+    async def test_11_typing_stops_on_disconnect(self):
+        communicator = AuthWebsocketCommunicator(
+            application=self.consumer_class.as_asgi(),
+            path=f'/chats/{self.conversation_name}/',
+            user=self.token.user
+        )
+        communicator.scope['url_route'] = {'kwargs':{"conversation_name": self.conversation_name}}
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        response = await communicator.receive_json_from()
+        while response["type"] != "user_join":
+            response = await communicator.receive_json_from()
+        channel_layer = get_channel_layer()
+        listener = await channel_layer.new_channel()
+        await channel_layer.group_add(self.conversation_name, listener)
+        await communicator.send_json_to({"type": "typing", "typing": True})
+        assert json.loads((await channel_layer.receive(listener))["text"])["typing"] is True
+        await communicator.disconnect()
+        events = [json.loads((await channel_layer.receive(listener))["text"]) for _ in range(2)]
+        assert [(event["type"], event.get("typing")) for event in events] == [("typing", False), ("user_leave", None)]
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(channel_layer.receive(listener), 0.2)
+        await channel_layer.group_discard(self.conversation_name, listener)
+        
+class GroupChatTest(LocalBackendsMixin, TestCase):
     fixtures = ['users.json', 'conversations.json', 'messages.json', 
                 'group_conversations.json', 'group_messages.json']
     group_conversation_name_new = "group_chat_with__test__2"
     group_conversation_name = "group_chat_with__test__1"
     test_message = "Test message!"
+    consumer_class = GroupChatConsumer
     
     @classmethod
     def setUpTestData(cls):
@@ -97,7 +354,7 @@ class GroupChatTest(TestCase):
         
     def create_communicator(self, group_name=group_conversation_name):
         communicator = AuthWebsocketCommunicator(
-            application=GroupChatConsumer.as_asgi(),
+            application=self.consumer_class.as_asgi(),
             path=f'/group_chats/{group_name}/',
             user=self.token.user
         )
@@ -132,7 +389,7 @@ class GroupChatTest(TestCase):
         await communicator.send_json_to({"type": "add_member", "name": "test4"})
         
         response = await communicator.receive_json_from()
-        assert 'members_list' in response.values()
+        assert response == {"type": "member_added", "user": {"username": "test4", "first_name": ""}}
         
         response = await communicator.receive_json_from()
         assert 'User test4 was added to the chat' in response['message']['content']
@@ -156,7 +413,7 @@ class GroupChatTest(TestCase):
         await communicator.send_json_to({"type": "remove_member", "name": "test3"})
         
         response = await communicator.receive_json_from()
-        assert 'members_list' in response.values()
+        assert response == {"type": "member_removed", "user": {"username": "test3", "first_name": ""}}
         
         response = await communicator.receive_json_from()
         assert 'User test3 was removed from the chat' in response['message']['content']
@@ -184,10 +441,12 @@ class GroupChatTest(TestCase):
 
         await communicator.disconnect()
         
-class NotificationTest(TestCase):
+class NotificationTest(LocalBackendsMixin, TestCase):
     fixtures = ['users.json', 'conversations.json', 'messages.json', 
                 'group_conversations.json', 'group_messages.json']
     group_notification_name = "test__notifications"
+    consumer_class = NotificationConsumer
+    group_consumer_class = GroupChatConsumer
 
     @classmethod
     def setUpTestData(cls):
@@ -196,7 +455,7 @@ class NotificationTest(TestCase):
         
     def create_communicator(self, group_name=group_notification_name):
         communicator = AuthWebsocketCommunicator(
-            application=NotificationConsumer.as_asgi(),
+            application=self.consumer_class.as_asgi(),
             path=f'/notifications/{group_name}/',
             user=self.token.user
         )
@@ -216,8 +475,353 @@ class NotificationTest(TestCase):
         
         await communicator.disconnect()
         
+    async def test_2_group_notifications_follow_membership(self):
+        notifications = {}
+        for username in ("test", "test2", "test4"):
+            communicator = AuthWebsocketCommunicator(
+                application=self.consumer_class.as_asgi(),
+                path='/notifications/',
+                user=await User.objects.aget(username=username)
+            )
+            connected, subprotocol = await communicator.connect()
+            assert connected
+            await communicator.receive_json_from()# unread count
+            await communicator.receive_json_from()# unread group count
+            notifications[username] = communicator
+        group_name = "group_chat_with__test__1"
+        communicator = AuthWebsocketCommunicator(
+            application=self.group_consumer_class.as_asgi(),
+            path=f'/group_chats/{group_name}/',
+            user=self.token.user
+        )
+        communicator.scope['url_route'] = {'kwargs':{"group_chat_name": group_name}}
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        
+        await communicator.send_json_to({"type": "chat_message", "message": "Before"})
+        response = await notifications["test2"].receive_json_from()
+        assert response["type"] == "new_message_group_notification"
+        assert response["message"]["content"] == "Before"
+        assert await notifications["test4"].receive_nothing()
+        
+        await communicator.send_json_to({"type": "add_member", "name": "test4"})
+        for username in ("test2", "test4"):
+            response = await notifications[username].receive_json_from()
+            assert response["message"]["content"] == "User test4 was added to the chat"
+        await communicator.send_json_to({"type": "chat_message", "message": "After"})
+        for username in ("test2", "test4"):
+            response = await notifications[username].receive_json_from()
+            assert response["message"]["content"] == "After"
+        assert await notifications["test"].receive_nothing()
+        
+        await communicator.disconnect()
+        for communicator in notifications.values():
+            await communicator.disconnect()
+        
+
+class AsyncChatTest(ChatTest):
+    consumer_class = AsyncChatConsumer
+
+
+class AsyncGroupChatTest(GroupChatTest):
+    consumer_class = AsyncGroupChatConsumer
+
+
+class AsyncNotificationTest(NotificationTest):
+    consumer_class = AsyncNotificationConsumer
+    group_consumer_class = AsyncGroupChatConsumer
+        
 
-class TestApi(APITestCase):
+class MultiplexTest(LocalBackendsMixin, TestCase):
+    fixtures = ['users.json', 'conversations.json', 'messages.json', 
+                'group_conversations.json', 'group_messages.json']
+    
+    async def receive_until(self, communicator, *expected):
+        """Receive (stream, frame type) pairs until all expected ones have arrived"""
+        frames = []
+        while not set(expected) <= set(frames):
+            response = await communicator.receive_json_from()
+            frames.append((response["stream"], response["payload"]["type"]))
+        return frames
+    
+    async def test_1_streams_share_one_socket(self):
+        user = await User.objects.aget(username="test")
+        communicator = AuthWebsocketCommunicator(
+            application=URLRouter(routing.websocket_urlpatterns), path='/multiplex/', user=user
+        )
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        
+        await communicator.send_json_to({"type": "subscribe", "stream": "notifications/"})
+        await communicator.send_json_to({"type": "subscribe", "stream": "chats/test__test2/?since=bad"})
+        await self.receive_until(
+            communicator, ("notifications/", "unread_group_count"), ("chats/test__test2/", "user_join")
+        )
+        
+        await communicator.send_json_to({
+            "stream": "chats/test__test2/", "payload": {"type": "chat_message", "message": "Test message!"},
+        })
+        await self.receive_until(communicator, ("chats/test__test2/", "chat_message_echo"))
+        await communicator.send_json_to({"type": "unsubscribe", "stream": "chats/test__test2/"})
+        await self.receive_until(communicator, ("chats/test__test2/", "unsubscribed"))
+        
+        await communicator.send_json_to({"type": "subscribe", "stream": "unknown/"})
+        assert await self.receive_until(communicator, ("unknown/", "unsubscribed")) == [
+            ("unknown/", "error"), ("unknown/", "unsubscribed"),
+        ]
+        await communicator.disconnect()
+    
+    @override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "chat.layers.InMemoryChannelLayer"}})
+    async def test_2_streams_share_one_channel(self):
+        user = await User.objects.aget(username="test")
+        for consumers in ("sync", "async"):
+            chat_consumer, notification_consumer, group_chat_consumer = routing.CONSUMERS[consumers]
+            application = MultiplexConsumer.as_asgi(streams=[
+                path("chats/<conversation_name>/", chat_consumer.as_asgi()),
+                path("notifications/", notification_consumer.as_asgi()),
+                path("group_chats/<group_chat_name>/", group_chat_consumer.as_asgi()),
+            ])
+            communicator = AuthWebsocketCommunicator(application=application, path='/multiplex/', user=user)
+            connected, subprotocol = await communicator.connect()
+            assert connected
+            for stream in ("notifications/", "chats/test__test2/", "chats/test__test3/",
+                           "group_chats/group_chat_with__test__1/"):
+                await communicator.send_json_to({"type": "subscribe", "stream": stream})
+            await self.receive_until(
+                communicator, ("notifications/", "unread_group_count"),
+                ("chats/test__test2/", "last_50_messages"), ("chats/test__test3/", "last_50_messages"),
+                ("group_chats/group_chat_with__test__1/", "members_list"),
+            )
+            layer = get_channel_layer()
+            assert len({channel for channels in layer.groups.values() for channel in channels}) == 1
+            
+            # Events of a group reach only the streams subscribed to it
+            await communicator.send_json_to({
+                "stream": "chats/test__test2/", "payload": {"type": "chat_message", "message": "Test message!"},
+            })
+            frames = await self.receive_until(communicator, ("chats/test__test2/", "chat_message_echo"))
+            assert ("chats/test__test3/", "chat_message_echo") not in frames
+            await communicator.send_json_to({"type": "unsubscribe", "stream": "chats/test__test3/"})
+            await self.receive_until(communicator, ("chats/test__test3/", "unsubscribed"))
+            assert "test__test3" not in layer.groups and "test__test2" in layer.groups
+            await communicator.disconnect()
+            assert not any(layer.groups.values())
+
+
+class UnreadCounterTest(LocalBackendsMixin, TestCase):
+    fixtures = ['users.json', 'conversations.json', 'messages.json', 
+                'group_conversations.json', 'group_messages.json']
+    
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.get(username="test")
+        self.user2 = User.objects.get(username="test2")
+        self.user3 = User.objects.get(username="test3")
+    
+    def test_1_rebuild_unread_counters(self):
+        call_command("rebuild_unread_counters", stdout=StringIO())
+        self.assertEqual(services.get_unread_counts(self.user), (0, 0))
+        self.assertEqual(services.get_unread_counts(self.user2), (1, 0))
+        self.assertEqual(UnreadTotal.objects.get(user=self.user3).unread_count, 1)
+        
+    def test_2_private_message_counters(self):
+        conversation = Conversation.objects.get(name="test__test2")
+        services.create_message(conversation, self.user, "Test message!")
+        services.create_message(conversation, self.user, "Test message!")
+        self.assertEqual(services.get_unread_counts(self.user2), (2, 0))
+        self.assertEqual(services.get_unread_counts(self.user), (0, 0))
+        
+        self.assertEqual(services.read_messages(conversation, self.user2), 0)
+        self.assertFalse(conversation.messages.filter(to_user=self.user2, read=False).exists())
+        
+    def test_3_group_message_counters(self):
+        conversation = GroupConversation.objects.get(name="group_chat_with__test__1")
+        services.create_group_message(conversation, self.user, "Test message!")
+        self.assertEqual(services.get_unread_counts(self.user2), (0, 1))
+        self.assertEqual(services.get_unread_counts(self.user3), (0, 1))
+        self.assertEqual(services.get_unread_counts(self.user), (0, 0))
+        
+        self.assertEqual(services.read_group_messages(conversation, self.user2), 0)
+        self.assertEqual(services.get_unread_counts(self.user3), (0, 1))
+        
+        services.remove_member(conversation, "test3")
+        self.assertEqual(services.get_unread_counts(self.user3), (0, 0))
+        
+    def test_4_group_read_watermark(self):
+        conversation = GroupConversation.objects.get(name="group_chat_with__test__1")
+        message = services.create_group_message(conversation, self.user, "Test message!")
+        self.assertEqual(message["read"], [self.user.id])
+        
+        with CaptureQueriesContext(connection) as queries:
+            services.read_group_messages(conversation, self.user2)
+        updates = [q["sql"] for q in queries if q["sql"].startswith('UPDATE "chat_groupconversation_members"')]
+        self.assertEqual(len(updates), 1)
+        
+        membership = conversation.memberships.get(user=self.user2)
+        self.assertEqual(str(membership.last_read_message_id), message["id"])
+        messages, has_more = services.get_last_group_messages(conversation)
+        self.assertEqual(messages[0]["read"], [self.user.id, self.user2.id])
+        self.assertFalse(has_more)
+        
+    def test_5_conversation_participants(self):
+        conversation, created = services.get_or_create_conversation("test2__test3")
+        self.assertTrue(created)
+        self.assertEqual(conversation.pair_key, Conversation.make_pair_key(self.user3.id, self.user2.id))
+        self.assertEqual(services.get_receiver(conversation, self.user2), self.user3)
+        self.assertEqual(services.get_or_create_conversation("test2__test3"), (conversation, False))
+        
+    def test_6_group_membership_cache(self):
+        def member_names(conversation):
+            return [member["username"] for member in services.get_members(conversation)]
+        conversation = GroupConversation.objects.get(name="group_chat_with__test__1")
+        self.assertEqual(member_names(conversation), ["test", "test2", "test3"])
+        with self.assertNumQueries(0):
+            self.assertEqual(len(services.get_members(conversation)), 3)
+        
+        # A list read before a membership change is not cached after it
+        membership = get_membership()
+        version, members = async_to_sync(membership.get)(conversation.membership_key)
+        services.add_member(conversation, "test4")
+        async_to_sync(membership.set)(conversation.membership_key, version, members)
+        self.assertEqual(async_to_sync(membership.get)(conversation.membership_key), (version + 1, None))
+        services.add_member(conversation, "test4")
+        self.assertEqual(member_names(conversation), ["test", "test2", "test3", "test4"])
+        services.remove_member(conversation, "test2")
+        self.assertEqual(member_names(conversation), ["test", "test3", "test4"])
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.get_members_count(), 3)
+        self.assertEqual(str(conversation), "group_chat_with__test__1 (members-3)")
+
+
+class HistoryTest(LocalBackendsMixin, TestCase):
+    fixtures = ['users.json', 'conversations.json', 'messages.json', 
+                'group_conversations.json', 'group_messages.json']
+    
+    async def test_1_ring_buffer(self):
+        history = LocalHistory(size=3)
+        payloads = [
+            {"id": "2", "to_user": {"username": "test"}, "timestamp": "2024-01-01T10:01:00Z", "read": False},
+            {"id": "1", "to_user": {"username": "test2"}, "timestamp": "2024-01-01T10:00:00Z", "read": False},
+        ]
+        version, recent = await history.get("conversation", 3)
+        assert recent is None
+        # A message pushed while payloads were read from the database
+        await history.push("conversation", {"id": "0"})
+        await history.fill("conversation", version, payloads)
+        assert await history.get("conversation", 3) == (version + 1, None)
+        
+        await history.fill("conversation", version + 1, payloads)
+        assert await history.get("conversation", 3) == (version + 1, (payloads, False))
+        assert await history.get("conversation", 1) == (version + 1, (payloads[:1], True))
+        await history.mark_read("conversation", "test")
+        version, (messages, has_more) = await history.get("conversation", 3)
+        assert messages[0]["read"] and not messages[1]["read"] and not payloads[0]["read"]
+        
+        newer = {"id": "3", "to_user": {"username": "test2"}, "timestamp": "2024-01-01T10:02:00Z", "read": False}
+        await history.push("conversation", newer)
+        assert await history.get("conversation", 3) == (version + 1, ([newer, *messages], False))
+        await history.push("conversation", dict(newer, id="4"))
+        version, (messages, has_more) = await history.get("conversation", 3)
+        assert [message["id"] for message in messages] == ["4", "3", "2"] and has_more
+        assert await history.get("conversation", 4) == (version, None)
+    
+    def test_2_snapshots_from_buffer(self):
+        user = User.objects.get(username="test")
+        conversation = Conversation.objects.get(name="test__test2")
+        group_conversation = GroupConversation.objects.get(name="group_chat_with__test__1")
+        services.get_last_messages(conversation)
+        services.get_last_group_messages(group_conversation)
+        message, receiver = services.create_message(conversation, user, "Test message!")
+        group_message = services.create_group_message(group_conversation, user, "Test message!")
+        
+        with self.assertNumQueries(0):
+            messages, has_more = services.get_last_messages(conversation)
+        with self.assertNumQueries(1):
+            group_messages, group_has_more = services.get_last_group_messages(group_conversation)
+        self.assertEqual(messages[0], message)
+        self.assertEqual(group_messages[0], group_message)
+        reset_backends(setting="CHAT_HISTORY")
+        self.assertEqual(services.get_last_messages(conversation), (messages, has_more))
+        self.assertEqual(
+            services.get_last_group_messages(group_conversation), (group_messages, group_has_more)
+        )
+        
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.get('/api/messages/?conversation=test__test2&page_size=2')
+        self.assertEqual(response.data["results"], messages[:2])
+        self.assertIn(f"before={messages[1]['id']}", response.data["next"])
+        services.read_messages(conversation, receiver)
+        self.assertTrue(services.get_last_messages(conversation)[0][0]["read"])
+        
+    def test_3_messages_since(self):
+        user = User.objects.get(username="test")
+        group_conversation = GroupConversation.objects.get(name="group_chat_with__test__1")
+        last_seen = group_conversation.group_messages.order_by("-timestamp", "-id").first()
+        missed = [services.create_group_message(group_conversation, user, f"Missed {i}") for i in range(3)]
+        
+        # Cold buffer, then from the buffer
+        for i in range(2):
+            frame = services.get_group_messages_frame(group_conversation, str(last_seen.id))
+            self.assertEqual(frame["group_messages"], missed[::-1])
+            self.assertTrue(frame["caught_up"])
+            services.get_last_group_messages(group_conversation)
+        self.assertIsNone(services.get_group_messages_since(group_conversation, str(last_seen.id), count=2))
+        self.assertEqual(services.get_group_messages_since(group_conversation, missed[-1]["id"]), [])
+        self.assertIsNone(services.get_group_messages_since(group_conversation, "not a message"))
+
+    @skipUnless(fakeredis, "fakeredis is not installed")
+    async def test_4_redis_read_watermarks(self):
+        server = fakeredis.FakeServer()
+        redis = fakeredis.FakeAsyncRedis(server=server)
+        with override_settings(CHANNEL_LAYERS={"default": {
+            "BACKEND": "chat.layers.ShardedRedisChannelLayer",
+            "CONFIG": {"hosts": [
+                {"connection_class": fakeredis.FakeAsyncConnection, "server": server, "host": "redis", "port": 6379}
+            ]},
+        }}):
+            history = RedisHistory(size=3)
+            key = history._key("conversation")
+            version, recent = await history.get("conversation", 3)
+            await history.push("conversation", {"id": "0"})
+            await history.fill("conversation", version, [{"id": "0"}])
+            self.assertEqual(await redis.exists(key), 0)
+            await history.fill("conversation", version + 1, [
+                {"id": "1", "to_user": {"username": "test"}, "timestamp": "2024-01-01T10:00:00Z", "read": False},
+            ])
+            await history.push("conversation", {
+                "id": "2", "to_user": {"username": "test2"}, "timestamp": "2024-01-01T10:01:00Z", "read": False,
+            })
+            stored = await redis.lrange(key, 0, -1)
+            await history.mark_read("conversation", "test")
+            await history.push("conversation", {
+                "id": "3", "to_user": {"username": "test"},
+                "timestamp": (timezone.now() + timedelta(minutes=1)).isoformat(), "read": False,
+            })
+            _, (messages, has_more) = await history.get("conversation", 3)
+            self.assertEqual([message["read"] for message in messages], [False, False, True])
+            # Buffered payloads keep their bytes
+            self.assertEqual((await redis.lrange(key, 0, -1))[1:], stored)
+
+
+class PresenceTest(TestCase):
+    
+    async def test_1_presence_diffs(self):
+        presence = LocalPresence()
+        assert await presence.join("conversation", "test", "channel1")
+        assert not await presence.join("conversation", "test", "channel2")
+        assert await presence.online("conversation") == ["test"]
+        assert not await presence.leave("conversation", "test", "channel1")
+        assert await presence.leave("conversation", "test", "channel2")
+        assert await presence.count("conversation") == 0
+    
+    async def test_2_presence_expiry(self):
+        presence = LocalPresence(ttl=0)
+        await presence.join("conversation", "test", "channel1")
+        assert await presence.online("conversation") == []
+        
+
+class TestApi(LocalBackendsMixin, APITestCase):
     fixtures = ['users.json', 'conversations.json', 'messages.json', 
                 'group_conversations.json', 'group_messages.json']
     
@@ -228,6 +832,7 @@ class TestApi(APITestCase):
         cls.token = Token.objects.create(user=user)
     
     def setUp(self) -> None:
+        super().setUp()
         self.client = APIClient()
         self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
         
@@ -259,6 +864,17 @@ class TestApi(APITestCase):
         self.assertContains(response, "43d80639-a10d-4b46-b872-b561c0c4b7b2")
         self.assertNotContains(response, "00d80639-a10d-4b46-b872-b561c0c4b7b2")
         
+        # Online members are read from presence, not stored
+        presence = get_presence()
+        async_to_sync(presence.join)("43d80639-a10d-4b46-b872-b561c0c4b7b2", "test2", "channel")
+        try:
+            for url in ('/api/group_conversations/', '/api/group_conversations/group_chat_with__test__1/'):
+                response = self.client.get(url).data
+                group_conversation = response[0] if isinstance(response, list) else response
+                self.assertEqual(group_conversation["online_count"], 1)
+        finally:
+            async_to_sync(presence.leave)("43d80639-a10d-4b46-b872-b561c0c4b7b2", "test2", "channel")
+        
     
     def test_5_get_group_message_viewset(self):
         group_conversation_name = "group_chat_with__test__1"
@@ -267,4 +883,426 @@ class TestApi(APITestCase):
         self.assertContains(response, "0ac284e4-b641-446c-85d4-87b36ece602e")
         self.assertContains(response, "0c2c0c9b-2c50-4b3a-ae7c-1a5ca1080805")
         self.assertContains(response, "0b5ac10c-9021-41d6-bacf-29374dc9a3c9")
-        self.assertNotContains(response, "0e8037be-39f2-4849-9121-89385eceaa02")
\ No newline at end of file
+        self.assertNotContains(response, "0e8037be-39f2-4849-9121-89385eceaa02")    
+    def test_6_message_viewset_keyset_pagination(self):
+        url = '/api/messages/?conversation=test__test2&page_size=2'
+        response = self.client.get(url)
+        newest = [message["id"] for message in response.data["results"]]
+        self.assertEqual(len(newest), 2)
+        self.assertNotIn("count", response.data)
+        self.assertIsNone(response.data["previous"])
+        self.assertIn(f"before={newest[-1]}", response.data["next"])
+        
+        response = self.client.get(response.data["next"])
+        older = [message["id"] for message in response.data["results"]]
+        self.assertTrue(older)
+        self.assertFalse(set(newest) & set(older))
+        self.assertIn(f"after={older[0]}", response.data["previous"])
+        
+        response = self.client.get(response.data["previous"])
+        self.assertEqual([message["id"] for message in response.data["results"]], newest)
+        
+        response = self.client.get(url + '&before=c2c280b2-4cf9-4bb7-bc9d-b8ae9c7e7d97')
+        self.assertEqual(response.status_code, 404)
+    
+    def test_7_conversation_viewset_other_user(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/conversations/')
+        self.assertEqual(response.data[0]["other_user"]["username"], "test2")
+        self.assertFalse(any("REGEXP" in query["sql"] for query in queries.captured_queries))
+        
+        response = self.client.get('/api/messages/?conversation=test3__tes2')
+        self.assertEqual(response.data["results"], [])
+    
+    def test_8_inbox_constant_queries(self):
+        user = User.objects.get(username="test")
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/conversations/')
+            self.client.get('/api/group_conversations/')
+        for username in ("test3", "test4"):
+            conversation, _ = services.get_or_create_conversation(f"test__{username}")
+            services.create_message(conversation, user, "Test message!")
+            group_conversation, _ = services.get_or_create_group_conversation(f"group_with__{username}", user)
+            services.add_member(group_conversation, username)
+        
+        with self.assertNumQueries(len(queries)):
+            conversations = self.client.get('/api/conversations/').data
+            group_conversations = self.client.get('/api/group_conversations/').data
+        self.assertEqual(
+            [conversation["name"] for conversation in conversations],
+            ["test__test4", "test__test3", "test__test2"],
+        )
+        self.assertEqual(group_conversations[0]["name"], "group_with__test4")
+        self.assertIn("test4", group_conversations[0]["last_message"]["content"])
+
+
+class QueryPlanTest(LocalBackendsMixin, APITestCase):
+    """
+    Every query of the REST endpoints and of the services behind the
+    consumers must use an index on tables large enough for it to matter.
+    Postgres is asked with sequential scans disabled, so a Seq Scan in its
+    plan means no index can serve the query.
+    """
+    users_count = 1000
+    contacts_count = 20
+    messages_per_conversation = 20
+    groups_count = 100
+    group_size = 10
+    messages_per_group = 50
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        users = User.objects.bulk_create(
+            User(username=f"user{i}", password="!") for i in range(cls.users_count)
+        )
+        cls.user = users[0]
+        # user0 talks to the first contacts, everybody else to a neighbour
+        pairs = [(cls.user, user) for user in users[1:cls.contacts_count + 1]] + [
+            (users[i], users[i + 1]) for i in range(cls.contacts_count + 1, cls.users_count - 1, 2)
+        ]
+        conversations = Conversation.objects.bulk_create(
+            Conversation(name=f"{first.username}__{second.username}", pair_key=Conversation.make_pair_key(first.id, second.id))
+            for first, second in pairs
+        )
+        Conversation.participants.through.objects.bulk_create(
+            Conversation.participants.through(conversation=conversation, user=user)
+            for conversation, pair in zip(conversations, pairs) for user in pair
+        )
+        Message.objects.bulk_create(
+            Message(
+                conversation=conversation, from_user=sender, to_user=receiver, content="Message",
+                timestamp=now - timedelta(minutes=i), read=i > 2,
+            )
+            for conversation, (first, second) in zip(conversations, pairs)
+            for i in range(cls.messages_per_conversation)
+            for sender, receiver in [(first, second) if i % 2 else (second, first)]
+        )
+        groups = GroupConversation.objects.bulk_create(
+            GroupConversation(name=f"group{i}", admin=users[i], members_count=cls.group_size)
+            for i in range(cls.groups_count)
+        )
+        GroupMembership.objects.bulk_create(
+            GroupMembership(group_conversation=group, user=users[(i + j) % cls.users_count], last_read_at=now)
+            for i, group in enumerate(groups) for j in range(cls.group_size)
+        )
+        GroupMessage.objects.bulk_create(
+            GroupMessage(
+                group_conversation=group, from_user=users[(i + j % cls.group_size) % cls.users_count],
+                content="Message", timestamp=now - timedelta(minutes=j),
+            )
+            for i, group in enumerate(groups) for j in range(cls.messages_per_group)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                cursor.execute(f"EXPLAIN {sql}")
+                return [row[0] for row in cursor.fetchall()]
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+            return [row[-1] for row in cursor.fetchall()]
+
+    def get_scans(self, queries):
+        """Return (table, query) of every sequential scan in the plans of queries"""
+        if connection.vendor == "postgresql":
+            scan = re.compile(r"Seq Scan on (\w+)")
+        else:
+            # Full scans of a table or index, not lookups through one
+            scan = re.compile(r"^SCAN (\w+)")
+        scans = []
+        for query in queries:
+            if not query["sql"].startswith(("SELECT", "UPDATE", "DELETE")):
+                continue
+            for line in self.explain(query["sql"]):
+                match = scan.search(line.strip())
+                if match:
+                    scans.append((match.group(1), query["sql"][:200]))
+        return scans
+
+    def assertIndexed(self, queries):
+        self.assertGreater(len(queries), 0)
+        self.assertEqual(self.get_scans(queries), [])
+
+    def test_1_endpoints(self):
+        message = Message.objects.filter(conversation__name="user0__user1").order_by("-timestamp")[10]
+        group_message = GroupMessage.objects.filter(group_conversation__name="group0").order_by("-timestamp")[10]
+        for path in (
+            "/api/conversations/",
+            "/api/messages/?conversation=user0__user1",
+            "/api/messages/?conversation=user0__user1&page_size=10",
+            f"/api/messages/?conversation=user0__user1&before={message.id}",
+            f"/api/messages/?conversation=user0__user1&after={message.id}",
+            "/api/group_conversations/",
+            "/api/group_conversations/group0/",
+            "/api/group_messages/?group_conversation=group0",
+            "/api/group_messages/?group_conversation=group0&page_size=10",
+            f"/api/group_messages/?group_conversation=group0&before={group_message.id}",
+        ):
+            with self.subTest(path=path), CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.client.get(path).status_code, 200)
+                self.assertIndexed(queries)
+
+    def test_2_consumer_services(self):
+        # The consumers reach the database through these services only
+        user2 = User.objects.get(username="user2")
+        with CaptureQueriesContext(connection) as queries:
+            conversation, _ = services.get_or_create_conversation("user0__user2")
+            services.get_receiver(conversation, self.user)
+            services.get_messages_frame(conversation)
+            services.create_message(conversation, user2, "Test message!")
+            services.read_messages(conversation, self.user)
+            services.get_unread_counts(self.user)
+            services.get_notification_groups(self.user)
+            services.get_next_group_conversation_id(self.user)
+        self.assertIndexed(queries)
+        
+        with CaptureQueriesContext(connection) as queries:
+            group_conversation, _ = services.get_or_create_group_conversation("group0", self.user)
+            services.get_group_messages_frame(group_conversation)
+            services.get_members(group_conversation)
+            services.create_group_message(group_conversation, self.user, "Test message!")
+            services.add_member(group_conversation, "user150")
+            services.remove_member(group_conversation, "user150")
+            services.read_group_messages(group_conversation, self.user)
+        self.assertIndexed(queries)
+
+
+class PayloadTest(TestCase):
+    fixtures = ['users.json', 'conversations.json', 'messages.json', 
+                'group_conversations.json', 'group_messages.json']
+    
+    def test_1_payloads_match_serializers(self):
+        messages = Message.objects.select_related("from_user", "to_user")
+        self.assertEqual(
+            encode_json(payloads.message_payloads(messages)),
+            json.dumps(MessageSerializer(messages, many=True).data, cls=UUIDEncoder),
+        )
+        conversation = GroupConversation.objects.get(name="group_chat_with__test__1")
+        watermarks = conversation.get_read_watermarks()
+        group_messages = conversation.group_messages.select_related("from_user")
+        self.assertEqual(
+            encode_json(payloads.group_message_payloads(group_messages, watermarks)),
+            json.dumps(
+                GroupMessageSerializer(group_messages, many=True, context={"read_watermarks": watermarks}).data,
+                cls=UUIDEncoder,
+            ),
+        )
+
+
+class TokenAuthMiddlewareTest(TestCase):
+    fixtures = ['users.json']
+    
+    def setUp(self):
+        self.user = User.objects.get(username="test")
+        self.token = Token.objects.create(user=self.user)
+        get_token_cache().clear()
+    
+    def authenticate(self, token):
+        scope = {"query_string": f"token={token}".encode()}
+        async def app(scope, receive, send):
+            pass
+        async_to_sync(TokenAuthMiddleware(app))(scope, None, None)
+        return scope["user"]
+    
+    def test_1_cached_token_user(self):
+        self.assertEqual(self.authenticate(self.token.key), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.authenticate(self.token.key), self.user)
+        self.assertEqual(get_token_cache().stats(), {"hits": 1, "misses": 1, "size": 1})
+        self.assertIn('chat_token_cache_lookups_total{result="hit"} 1\n', metrics.expose())
+        self.assertIn("chat_token_cache_size 1\n", metrics.expose())
+        
+        self.user.is_active = False
+        self.user.save()
+        self.assertFalse(self.authenticate(self.token.key).is_authenticated)
+        
+        self.user.is_active = True
+        self.user.save()
+        self.authenticate(self.token.key)
+        self.token.delete()
+        self.assertFalse(self.authenticate(self.token.key).is_authenticated)
+        
+    def test_2_jwt_user(self):
+        token = TokenObtainPairSerializer.get_token(self.user).access_token
+        with self.assertNumQueries(0):
+            user = self.authenticate(str(token))
+        self.assertEqual((user.id, user.username), (self.user.id, self.user.username))
+        self.assertTrue(user.is_authenticated)
+        self.assertFalse(self.authenticate(str(token)[:-2]).is_authenticated)
+
+
+@override_settings(CHAT_PERSISTENCE={
+    "BACKEND": "chat.persistence.BufferedWriter",
+    "CONFIG": {"batch_size": 2, "flush_interval": 0.01},
+})
+class BufferedPersistenceTest(LocalBackendsMixin, TransactionTestCase):
+    fixtures = ['users.json', 'conversations.json', 'messages.json', 
+                'group_conversations.json', 'group_messages.json']
+    
+    def test_1_buffered_messages_are_flushed(self):
+        user = User.objects.get(username="test")
+        conversation = Conversation.objects.get(name="test__test2")
+        group_conversation = GroupConversation.objects.get(name="group_chat_with__test__1")
+        sent = [services.create_message(conversation, user, "Test message!")[0] for i in range(3)]
+        group_payload = services.create_group_message(group_conversation, user, "Test message!")
+        self.assertIn(user.id, group_payload["read"])
+        get_writer().flush()
+        
+        self.assertEqual(
+            conversation.messages.filter(id__in=[payload["id"] for payload in sent]).count(), 3
+        )
+        self.assertEqual(services.get_unread_counts(User.objects.get(username="test2"))[0], 3)
+        conversation.refresh_from_db()
+        group_conversation.refresh_from_db()
+        self.assertEqual(str(conversation.last_message_id), sent[-1]["id"])
+        self.assertEqual(str(group_conversation.last_message_id), group_payload["id"])
+        self.assertTrue(group_conversation.last_message.get_read_status(user))
+
+
+class LayerTest(TestCase):
+    
+    async def test_1_group_send_many(self):
+        for layer in (InMemoryChannelLayer(), BaseInMemoryChannelLayer()):
+            channels = [await layer.new_channel() for _ in range(2)]
+            await layer.group_add("first", channels[0])
+            await layer.group_add("second", channels[0])
+            await layer.group_add("second", channels[1])
+            recipients = await group_send_many(layer, [("first", {"type": "one"}), ("second", {"type": "two"})])
+            assert recipients == ([1, 2] if isinstance(layer, InMemoryChannelLayer) else None)
+            assert [(await layer.receive(channels[0]))["type"] for _ in range(2)] == ["one", "two"]
+            assert (await layer.receive(channels[1]))["type"] == "two"
+
+    def test_2_hash_ring_moves_few_keys(self):
+        keys = [f"{i}__group_notifications" for i in range(3000)]
+        ring = HashRing(["redis1:6379", "redis2:6379", "redis3:6379"])
+        placed = [ring.get(key) for key in keys]
+        self.assertEqual(placed, [HashRing(["redis1:6379", "redis2:6379", "redis3:6379"]).get(key) for key in keys])
+        self.assertEqual(set(placed), {0, 1, 2})
+        ring = HashRing(["redis1:6379", "redis2:6379", "redis3:6379", "redis4:6379"])
+        moved = [(old, ring.get(key)) for old, key in zip(placed, keys) if ring.get(key) != old]
+        # Only keys taken over by the new node move, about a quarter of them
+        self.assertTrue(all(new == 3 for old, new in moved))
+        self.assertLess(len(moved), len(keys) * 0.35)
+
+    @skipUnless(fakeredis, "fakeredis is not installed")
+    async def test_3_sharded_layer(self):
+        servers = [fakeredis.FakeServer() for _ in range(3)]
+        layer = ShardedRedisChannelLayer(hosts=[
+            {"connection_class": fakeredis.FakeAsyncConnection, "server": server, "host": f"redis{i}", "port": 6379}
+            for i, server in enumerate(servers)
+        ])
+        channels = [await layer.new_channel() for _ in range(2)]
+        groups = [f"user{i}__notifications" for i in range(30)]
+        for group in groups:
+            await layer.group_add(group, channels[0])
+        await layer.group_add(groups[0], channels[1])
+        await layer.group_send(groups[0], {"type": "one"})
+        recipients = await layer.group_send_many([(group, {"type": "two"}) for group in groups])
+        self.assertEqual(recipients, [2] + [1] * 29)
+        await layer.send(channels[1], {"type": "three"})
+        self.assertEqual([(await layer.receive(channels[1]))["type"] for _ in range(3)], ["one", "two", "three"])
+        self.assertEqual([(await layer.receive(channels[0]))["type"] for _ in range(31)], ["one"] + ["two"] * 30)
+        # Group keys are spread over every node, each one on the node the ring places it on
+        for index, server in enumerate(servers):
+            keys = await fakeredis.FakeAsyncRedis(server=server).keys(f"{layer.prefix}:group:*")
+            self.assertTrue(keys)
+            self.assertTrue(all(layer.consistent_hash(key.decode().split(":group:")[1]) == index for key in keys))
+        await layer.flush()
+
+
+class LoadBenchmarkTest(TestCase):
+    consumers = "sync"
+    
+    def test_1_load_benchmark_delivers_every_message(self):
+        benchmark = LoadBenchmark({
+            "users": 4, "group_size": 2, "rate": 40, "duration": 0.25, "group_share": 0.5,
+            "consumers": self.consumers, "drain_timeout": 5, "seed": 0,
+        })
+        results = benchmark.run(benchmark.build_dataset())
+        self.assertEqual(results["connections"], 12)
+        self.assertEqual(results["deliveries_received"], results["deliveries_expected"])
+        self.assertGreater(results["queries"], 0)
+        self.assertIsNotNone(results["latency_ms"]["echo"])
+
+
+class AsyncLoadBenchmarkTest(LoadBenchmarkTest):
+    consumers = "async"
+
+
+class DatasetTest(TestCase):
+    options = {
+        "users": 50, "messages": 500, "groups": 5, "group_messages": 300,
+        "end": "2026-01-01T00:00:00Z", "batch_size": 100, "seed": 1,
+    }
+    
+    def generate(self):
+        call_command("generate_chat_dataset", stdout=StringIO(), **self.options)
+        return list(Message.objects.order_by("id").values_list("id", "conversation__name", "timestamp", "read"))
+    
+    def test_1_generate_dataset(self):
+        with transaction.atomic():
+            messages = self.generate()
+            transaction.set_rollback(True)
+        self.assertEqual(self.generate(), messages)
+        
+        self.assertEqual(User.objects.filter(username__startswith="synthetic_").count(), 50)
+        self.assertEqual(len(messages), 500)
+        self.assertEqual(GroupMessage.objects.count(), 300)
+        for conversation in Conversation.objects.all():
+            self.assertEqual(services.get_or_create_conversation(conversation.name), (conversation, False))
+            self.assertEqual(conversation.participants.count(), 2)
+        for group_conversation in GroupConversation.objects.all():
+            self.assertEqual(group_conversation.members_count, group_conversation.memberships.count())
+            last_message = group_conversation.group_messages.order_by("-timestamp").first()
+            self.assertEqual(group_conversation.last_message, last_message)
+        unread = sum(UnreadTotal.objects.values_list("unread_count", flat=True))
+        self.assertEqual(unread, Message.objects.filter(read=False).count())
+
+
+class MetricsTest(LocalBackendsMixin, APITestCase):
+    fixtures = ['users.json', 'conversations.json', 'messages.json', 
+                'group_conversations.json', 'group_messages.json']
+    
+    @override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "chat.layers.InMemoryChannelLayer"}})
+    async def test_1_consumer_metrics(self):
+        user = await User.objects.aget(username="test")
+        communicator = AuthWebsocketCommunicator(
+            application=AsyncChatConsumer.as_asgi(), path='/chats/test__test2/', user=user
+        )
+        communicator.scope['url_route'] = {'kwargs':{"conversation_name": "test__test2"}}
+        active = metrics.sockets_active.values.get(("AsyncChatConsumer",), 0)
+        await communicator.connect()
+        self.assertEqual(metrics.sockets_active.values[("AsyncChatConsumer",)], active + 1)
+        await communicator.send_json_to({"type": "chat_message", "message": "Test message!"})
+        response = await communicator.receive_json_from()
+        while response["type"] != "chat_message_echo":
+            response = await communicator.receive_json_from()
+        await communicator.send_json_to({"type": "unknown"})
+        await communicator.disconnect()
+        
+        self.assertEqual(metrics.sockets_active.values[("AsyncChatConsumer",)], active)
+        self.assertGreater(metrics.event_queries.values[("AsyncChatConsumer", "chat_message")], 0)
+        self.assertIn(("AsyncChatConsumer", "other"), metrics.event_seconds.values)
+        self.assertIn(("chat_message_echo+new_message_notification",), metrics.group_send_seconds.values)
+        self.assertIn(("chat_message_echo",), metrics.fanout_size.values)
+        self.assertIn(("new_message_notification",), metrics.fanout_size.values)
+    
+    def test_2_metrics_endpoint(self):
+        token = Token.objects.create(user=User.objects.get(username="test"))
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        self.client.get('/api/conversations/')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+        self.assertContains(response, "# TYPE chat_http_request_seconds histogram")
+        self.assertContains(
+            response, 'chat_http_request_seconds_count{view="api:conversation-list",method="GET"} '
+        )
+        self.assertContains(response, 'chat_http_queries_total{view="api:conversation-list",method="GET"} ')
@@ -0,0 +1,40 @@
+"""
+Typing indicator state of one user in one conversation.
+
+Clients send a typing frame on every keystroke burst; consumers feed them
+to a TypingTracker and broadcast only its transitions. Repeated frames of
+the same state just extend the timeout, and a user who stops sending them
+is switched to not typing once timeout seconds have passed.
+"""
+import time
+
+TYPING_TIMEOUT = 5
+
+
+class TypingTracker:
+    def __init__(self, timeout=TYPING_TIMEOUT):
+        self.timeout = timeout
+        self.typing = False
+        self.expires_at = 0
+
+    def update(self, typing, now=None):
+        """Record a typing frame, return True if the state has changed"""
+        now = time.monotonic() if now is None else now
+        if typing:
+            self.expires_at = now + self.timeout
+        if typing == self.typing:
+            return False
+        self.typing = typing
+        return True
+
+    def expire(self, now=None):
+        """Stop typing if the timeout has passed, return True if it has"""
+        now = time.monotonic() if now is None else now
+        if not self.typing or now < self.expires_at:
+            return False
+        self.typing = False
+        return True
+
+    def seconds_left(self, now=None):
+        now = time.monotonic() if now is None else now
+        return max(self.expires_at - now, 0)
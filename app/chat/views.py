@@ -6,12 +6,17 @@ from rest_framework.viewsets import GenericViewSet
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.views import TokenObtainPairView
 from rest_framework import status
 from django.contrib.auth import get_user_model
+from asgiref.sync import async_to_sync
+from django.db.models import F, Prefetch
 from .serializers import UserSerializer, ConversationSerializer, MessageSerializer, \
-                         GroupConversationSerializer, GroupMessageSerializer
+                         GroupConversationSerializer, GroupMessageSerializer, TokenObtainPairSerializer
 from .paginators import MessagePagination, GroupMessagePagination
-from .models import Conversation, Message, GroupConversation, GroupMessage
+from .models import Conversation, Message, GroupConversation, GroupMessage, GroupMembership
+from .presence import get_presence
+from . import services
 
 User = get_user_model()
 
@@ -37,8 +42,11 @@ class ConversationViewSet(ListModelMixin, RetrieveModelMixin, GenericViewSet):
     
     
     def get_queryset(self):
-        queryset = Conversation.objects.filter(
-            name__regex=fr"^({self.request.user.username}__)|(^.+__{self.request.user.username}$)"
+        queryset = (
+            Conversation.objects.filter(participants=self.request.user)
+            .select_related("last_message__from_user", "last_message__to_user")
+            .prefetch_related("participants")
+            .order_by(F("last_message_at").desc(nulls_last=True), "name")
         )
         return queryset
     
@@ -55,13 +63,23 @@ class MessageViewSet(ListModelMixin, GenericViewSet):
         conversation_name = self.request.GET.get("conversation")
         queryset = (
             Message.objects.filter(
-                conversation__name__regex=fr"^({self.request.user.username}__)|(^.+__{self.request.user.username}$)"
+                conversation__name=conversation_name,
+                conversation__participants=self.request.user,
             )
-            .filter(conversation__name=conversation_name)
-            .order_by("-timestamp")
+            .order_by("-timestamp", "-id")
         )
         return queryset
     
+    def list(self, request, *args, **kwargs):
+        page_size = self.paginator.get_first_page_size(request)
+        conversation = Conversation.objects.filter(
+            name=request.GET.get("conversation"), participants=request.user
+        ).first()
+        if page_size is None or conversation is None:
+            return super().list(request, *args, **kwargs)
+        messages, has_more = services.get_last_messages(conversation, page_size)
+        return self.paginator.get_recent_response(request, messages, has_more)
+    
 class GroupConversationViewSet(ListModelMixin, RetrieveModelMixin, GenericViewSet):
     permission_classes = [IsAuthenticated]
     serializer_class = GroupConversationSerializer
@@ -69,11 +87,31 @@ class GroupConversationViewSet(ListModelMixin, RetrieveModelMixin, GenericViewSe
     lookup_field = "name"
     
     def get_queryset(self):
-        queryset = GroupConversation.objects.filter(
-                members=self.request.user
+        queryset = (
+            GroupConversation.objects.filter(members=self.request.user)
+            .select_related("admin", "last_message__from_user")
+            .prefetch_related(
+                Prefetch(
+                    "memberships",
+                    queryset=GroupMembership.objects.select_related("user").order_by("user_id"),
+                )
+            )
+            .order_by(F("last_message_at").desc(nulls_last=True), "name")
         )
         return queryset
     
+    def list(self, request, *args, **kwargs):
+        group_conversations = list(self.filter_queryset(self.get_queryset()))
+        online_counts = async_to_sync(get_presence().counts)(
+            [group_conversation.presence_key for group_conversation in group_conversations]
+        )
+        context = self.get_serializer_context()
+        context["online_counts"] = dict(
+            zip([group_conversation.id for group_conversation in group_conversations], online_counts)
+        )
+        serializer = self.get_serializer(group_conversations, many=True, context=context)
+        return Response(serializer.data)
+    
     def get_serializer_context(self):
         return {"request": self.request, "user": self.request.user}
     
@@ -90,9 +128,28 @@ class GroupMessageViewSet(ListModelMixin, GenericViewSet):
                 group_conversation__name=group_conversation_name,
                 group_conversation__members=self.request.user,
             )
-            .order_by('-timestamp')
+            .order_by('-timestamp', '-id')
         )
         return queryset
+    
+    def list(self, request, *args, **kwargs):
+        page_size = self.paginator.get_first_page_size(request)
+        group_conversation = GroupConversation.objects.filter(
+            name=request.GET.get("group_conversation"), members=request.user
+        ).first()
+        if page_size is None or group_conversation is None:
+            return super().list(request, *args, **kwargs)
+        group_messages, has_more = services.get_last_group_messages(group_conversation, page_size)
+        return self.paginator.get_recent_response(request, group_messages, has_more)
+    
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        group_conversation = GroupConversation.objects.filter(
+            name=self.request.GET.get("group_conversation")
+        ).first()
+        if group_conversation is not None:
+            context["read_watermarks"] = group_conversation.get_read_watermarks()
+        return context
 
 class CustomObtainAuthTokenView(ObtainAuthToken):
     def post(self, request, *args, **kwargs):
@@ -100,4 +157,8 @@ class CustomObtainAuthTokenView(ObtainAuthToken):
         serializer.is_valid(raise_exception=True)
         user = serializer.validated_data["user"]
         token, created = Token.objects.get_or_create(user=user)
-        return Response({"token": token.key, "username": user.username})
\ No newline at end of file
+        return Response({"token": token.key, "username": user.username})
+
+
+class CustomTokenObtainPairView(TokenObtainPairView):
+    serializer_class = TokenObtainPairSerializer
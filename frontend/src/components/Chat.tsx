@@ -15,7 +15,6 @@ export function Chat() {
   const [messageHistory, setMessageHistory] = useState<any>([]);
   const { user } = useContext(AuthContext);
   const { conversationName } = useParams();
-  const [page, setPage] = useState(2);
   const [hasMoreMessages, setHasMoreMessages] = useState(false);
   const [participants, setParticipants] = useState<string[]>([]);
   const [conversation, setConversation] = useState<ConversationModel | null>(null);
@@ -149,7 +148,7 @@ export function Chat() {
 
   async function fetchMessages() {
     const apiRes = await fetch(
-      `http://127.0.0.1:8000/api/messages/?conversation=${conversationName}&page=${page}`,
+      `http://127.0.0.1:8000/api/messages/?conversation=${conversationName}&before=${messageHistory[messageHistory.length - 1].id}`,
       {
         method: "GET",
         headers: {
@@ -161,13 +160,11 @@ export function Chat() {
     );
     if (apiRes.status === 200) {
       const data: {
-        count: number;
         next: string | null; // URL
         previous: string | null; // URL
         results: MessageModel[];
       } = await apiRes.json();
       setHasMoreMessages(data.next !== null);
-      setPage(page + 1);
       setMessageHistory((prev: MessageModel[]) => prev.concat(data.results));
     }
   }
@@ -29,7 +29,6 @@ export function GroupChat() {
     const [messageHistory, setMessageHistory] = useState<any>([]);
     const { user } = useContext(AuthContext);
     const { groupConversationName } = useParams();
-    const [page, setPage] = useState(2);
     const [hasMoreMessages, setHasMoreMessages] = useState(false);
     const [participants, setParticipants] = useState<string[]>([]);
     const [members, setMembers] = useState<MemberResponse[]>([]);
@@ -140,6 +139,19 @@ export function GroupChat() {
                 case "members_list":
                     updateMembers(data.users);
                     break;
+                case "member_added":
+                    setMembers((prev: MemberResponse[]) => {
+                        if (prev.some((member) => member.username === data.user.username)) {
+                            return prev;
+                        }
+                        return [...prev, data.user];
+                    });
+                    break;
+                case "member_removed":
+                    setMembers((prev: MemberResponse[]) =>
+                        prev.filter((member) => member.username !== data.user.username)
+                    );
+                    break;
                 case "typing":
                     updateTyping(data);
                     break;
@@ -213,7 +225,7 @@ export function GroupChat() {
 
     async function fetchMessages() {
         const apiRes = await fetch(
-            `http://127.0.0.1:8000/api/group_messages/?group_conversation=${groupConversationName}&page=${page}`,
+            `http://127.0.0.1:8000/api/group_messages/?group_conversation=${groupConversationName}&before=${messageHistory[messageHistory.length - 1].id}`,
             {
                 method: "GET",
                 headers: {
@@ -225,13 +237,11 @@ export function GroupChat() {
         );
         if (apiRes.status === 200) {
             const data: {
-                count: number;
                 next: string | null; // URL
                 previous: string | null; // URL
                 results: GroupMessageModel[];
             } = await apiRes.json();
             setHasMoreMessages(data.next !== null);
-            setPage(page + 1);
             setMessageHistory((prev: GroupMessageModel[]) => prev.concat(data.results));
         }
     }
@@ -7,4 +7,6 @@ export interface GroupConversationModel {
   last_message: MessageModel | null;
   admin: UserModel;
   members: UserModel | null;
+  members_count: number;
+  online_count: number;
 }
\ No newline at end of file